@@ -0,0 +1,185 @@
+"""
+Alert rules evaluated on the stream of ingested readings.
+
+Rule kinds:
+
+    above   temperature above ``threshold``
+    below   temperature below ``threshold``
+    rate    temperature more than ``threshold`` degrees away from a reading
+            of the same sensor taken in the last ``window`` seconds
+    off     the sensor reported OFF after reporting ON
+
+A rule applies to readings of its building, floor and room, any of which may
+be None to match every value. The rules of each (building, floor, room) a
+reading comes from are merged once and memoized, so a reading costs one dict
+lookup plus its own rules, however many rules there are.
+
+State is kept per sensor in flat arrays indexed by a slot per sensor: the
+time and status of its latest reading and a ring of its last ``history``
+readings, which bounds the work of a rate rule. Readings older than their
+sensor's latest are ignored.
+
+An alert opens when a rule's condition becomes true for a sensor and stays
+open until a reading of that sensor makes it false again; readings that keep
+it true are only counted. A sensor stuck above a threshold therefore raises
+one alert, not one per reading.
+
+The state is per process. With several workers ingesting, each may see a
+rule become true for the same sensor; the alert table keeps one open alert
+per rule and sensor, and the readings of the others are counted on it.
+"""
+import array
+import collections
+
+KINDS = ('above', 'below', 'rate', 'off')
+
+Rule = collections.namedtuple('Rule', 'id kind building_id floor room threshold window')
+
+_NEVER = float('-inf')
+
+
+def timestamp(date, time):
+    """
+    Seconds of a reading's date and time, on an arbitrary fixed epoch.
+    """
+    return date.toordinal() * 86400 + time.hour * 3600 + time.minute * 60 + time.second
+
+
+class AlertEngine(object):
+
+    def __init__(self, rules=(), history=8):
+        self.history = history
+        self._slots = {}
+        self._last_time = array.array('d')
+        self._last_on = array.array('b')
+        self._ring_time = array.array('d')
+        self._ring_temp = array.array('d')
+        self._ring_next = array.array('l')
+        self._active = set()
+        self.load(rules)
+
+    def load(self, rules):
+        """
+        Replace the rules. Open alerts of rules that are gone are dropped
+        from the state.
+        """
+        self.rules = dict((rule.id, rule) for rule in rules)
+        self._by_scope = collections.defaultdict(list)
+        for rule in self.rules.values():
+            self._by_scope[(rule.building_id, rule.floor, rule.room)].append(rule)
+        self._matched = {}
+        self._active = set(key for key in self._active if key[0] in self.rules)
+
+    def restore(self, open_alerts):
+        """
+        Mark ``(rule_id, sensor_id)`` alerts as open, e.g. the ones persisted
+        before a restart, so they are not raised again.
+        """
+        self._active.update(key for key in open_alerts if key[0] in self.rules)
+
+    def _rules_for(self, building_id, floor, room):
+        scope = (building_id, floor, room)
+        matched = self._matched.get(scope)
+        if matched is None:
+            rules = []
+            for b in (building_id, None):
+                for f in (floor, None):
+                    for r in (room, None):
+                        rules.extend(self._by_scope.get((b, f, r), ()))
+            matched = self._matched[scope] = tuple(sorted(set(rules), key=lambda rule: rule.id))
+        return matched
+
+    def _slot(self, sensor_id):
+        slot = self._slots.get(sensor_id)
+        if slot is None:
+            slot = self._slots[sensor_id] = len(self._last_time)
+            self._last_time.append(_NEVER)
+            self._last_on.append(-1)
+            self._ring_time.extend([_NEVER] * self.history)
+            self._ring_temp.extend([0.0] * self.history)
+            self._ring_next.append(0)
+        return slot
+
+    def _rate(self, slot, now, temperature, window):
+        """
+        Largest temperature change against the sensor's readings of the last
+        ``window`` seconds, or None if there are none.
+        """
+        change = None
+        base = slot * self.history
+        for i in range(base, base + self.history):
+            if now - self._ring_time[i] <= window:
+                difference = abs(temperature - self._ring_temp[i])
+                if change is None or difference > change:
+                    change = difference
+        return change
+
+    def evaluate(self, rows):
+        """
+        Run the rules over reading ``rows`` (dicts with sensor_id,
+        building_id, floor, room, date, time, temperature and status).
+
+        Returns ``(changes, repeated)``. changes lists the alerts opened and
+        resolved, in order: ``('open', rule, row, value)`` and ``('resolve',
+        (rule_id, sensor_id), row, repeats)``. repeated maps the ``(rule_id,
+        sensor_id)`` of alerts still open to ``[count, row, value]``: how
+        many more readings kept them true, and the last one. ``repeats`` is
+        the same for the readings before the resolving one, or None.
+        """
+        changes, repeated = [], {}
+        active = self._active
+        matched = self._matched
+        for row in rows:
+            sensor_id = row['sensor_id']
+            if sensor_id is None:
+                continue
+            slot = self._slot(sensor_id)
+            now = timestamp(row['date'], row['time'])
+            if now < self._last_time[slot]:
+                continue
+            temperature = row['temperature']
+            on = 1 if row['status'] == 'ON' else 0
+            was_on = self._last_on[slot]
+            rules = matched.get((row['building_id'], row['floor'], row['room']))
+            if rules is None:
+                rules = self._rules_for(row['building_id'], row['floor'], row['room'])
+            for rule in rules:
+                kind = rule.kind
+                value = temperature
+                if kind == 'off':
+                    fired = not on and (was_on == 1 or (rule.id, sensor_id) in active)
+                elif temperature is None:
+                    continue
+                elif kind == 'above':
+                    fired = temperature > rule.threshold
+                elif kind == 'below':
+                    fired = temperature < rule.threshold
+                else:
+                    value = self._rate(slot, now, temperature, rule.window)
+                    if value is None:
+                        continue
+                    fired = value > rule.threshold
+                key = (rule.id, sensor_id)
+                if fired:
+                    if key in active:
+                        entry = repeated.get(key)
+                        if entry is None:
+                            repeated[key] = [1, row, value]
+                        else:
+                            entry[0] += 1
+                            entry[1] = row
+                            entry[2] = value
+                    else:
+                        active.add(key)
+                        changes.append(('open', rule, row, value))
+                elif key in active:
+                    active.discard(key)
+                    changes.append(('resolve', key, row, repeated.pop(key, None)))
+            self._last_time[slot] = now
+            self._last_on[slot] = on
+            if temperature is not None:
+                position = slot * self.history + self._ring_next[slot]
+                self._ring_time[position] = now
+                self._ring_temp[position] = temperature
+                self._ring_next[slot] = (self._ring_next[slot] + 1) % self.history
+        return changes, repeated
@@ -0,0 +1,252 @@
+"""
+Vectorized analytics over sensor readings.
+
+Readings are loaded straight from query result tuples into a ReadingFrame of
+NumPy columns (no ORM objects), and every statistic is computed with array
+operations over the whole frame:
+
+- group_stats: count, mean, std, min, max and ON ratio per group
+- percentiles: temperature percentiles, overall or per group
+- moving_average: per-sensor rolling mean over the last N readings
+- anomalies: per-sensor z-scores and out-of-range temperature flags
+"""
+import datetime
+
+import numpy as np
+
+# column order of the tuples frame_from_rows() expects
+ROW_COLUMNS = ('sensor_id', 'building_id', 'floor', 'room', 'date', 'time', 'temperature', 'status')
+GROUP_KEYS = ('sensor_id', 'building_id', 'floor', 'room')
+
+_EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+class ReadingFrame(object):
+    """
+    Columnar batch of readings: int64 ``sensor_id``, ``building_id`` and
+    ``floor`` (-1 when missing), ``room`` as int32 codes into
+    ``room_labels``, ``timestamp`` as datetime64[s], float64 ``temperature``
+    (NaN when missing) and boolean ``on``.
+    """
+
+    def __init__(self, columns, room_labels):
+        self.columns = columns
+        self.room_labels = room_labels
+
+    def __len__(self):
+        return len(self.columns['temperature'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def labels(self, name, values):
+        if name == 'room':
+            return [self.room_labels[v] for v in values]
+        return [int(v) if v != -1 else None for v in values]
+
+
+def _ints(values):
+    return np.array([-1 if v is None else v for v in values], dtype=np.int64)
+
+
+def frame_from_rows(rows, chunk=100000):
+    """
+    Build a ReadingFrame from an iterable of ROW_COLUMNS tuples, converting
+    ``chunk`` rows at a time.
+    """
+    parts = dict((name, []) for name in ('sensor_id', 'building_id', 'floor', 'room',
+                                          'timestamp', 'temperature', 'on'))
+    room_codes = {}
+    batch = []
+
+    def flush():
+        sensor_id, building_id, floor, room, date, time, temperature, status = zip(*batch)
+        parts['sensor_id'].append(_ints(sensor_id))
+        parts['building_id'].append(_ints(building_id))
+        parts['floor'].append(_ints(floor))
+        parts['room'].append(np.array([room_codes.setdefault(r, len(room_codes)) for r in room],
+                                      dtype=np.int32))
+        days = np.array([d.toordinal() - _EPOCH for d in date], dtype=np.int64)
+        seconds = np.array([t.hour * 3600 + t.minute * 60 + t.second if t is not None else 0 for t in time],
+                           dtype=np.int64)
+        parts['timestamp'].append((days * 86400 + seconds).astype('datetime64[s]'))
+        parts['temperature'].append(np.array(temperature, dtype=np.float64))
+        parts['on'].append(np.array(status, dtype=object) == 'ON')
+        del batch[:]
+
+    for row in rows:
+        batch.append(row)
+        if len(batch) == chunk:
+            flush()
+    if batch:
+        flush()
+
+    empty = {'timestamp': 'datetime64[s]', 'temperature': np.float64, 'on': bool, 'room': np.int32}
+    columns = {}
+    for name, arrays in parts.items():
+        columns[name] = np.concatenate(arrays) if arrays else np.array([], dtype=empty.get(name, np.int64))
+    labels = [None] * len(room_codes)
+    for room, code in room_codes.items():
+        labels[code] = room
+    return ReadingFrame(columns, labels)
+
+
+def with_temperature(frame):
+    """
+    ReadingFrame of the readings of ``frame`` that have a temperature.
+    """
+    valid = ~np.isnan(frame['temperature'])
+    if valid.all():
+        return frame
+    return ReadingFrame(dict((name, values[valid]) for name, values in frame.columns.items()), frame.room_labels)
+
+
+def _group(frame, by):
+    """
+    Unique group keys and the group index of every reading.
+    """
+    # fold the columns into one int64 key so np.unique sorts a flat array
+    combined = np.zeros(len(frame), dtype=np.int64)
+    for name in by:
+        values, codes = np.unique(frame[name], return_inverse=True)
+        combined = combined * len(values) + codes.reshape(-1)
+    _, first, inverse = np.unique(combined, return_index=True, return_inverse=True)
+    unique = np.stack([frame[name][first] for name in by], axis=1)
+    return unique, inverse.reshape(-1)
+
+
+def _segments(inverse, values):
+    """
+    ``values`` sorted by group and the start offset of each group.
+    """
+    order = np.argsort(inverse, kind='stable')
+    grouped = inverse[order]
+    starts = np.flatnonzero(np.r_[True, grouped[1:] != grouped[:-1]])
+    return values[order], starts
+
+
+def group_stats(frame, by=('building_id',)):
+    """
+    List of per-group dicts with the group keys and count, mean, std, min,
+    max and ON ratio of the temperature. Readings without a temperature
+    count towards ``count`` and ``on_ratio`` only.
+    """
+    if not len(frame):
+        return []
+    unique, inverse = _group(frame, by)
+    temperature = frame['temperature']
+    valid = ~np.isnan(temperature)
+    groups = len(unique)
+    count = np.bincount(inverse, minlength=groups)
+    on = np.bincount(inverse, weights=frame['on'], minlength=groups)
+    n = np.bincount(inverse[valid], minlength=groups)
+    total = np.bincount(inverse[valid], weights=temperature[valid], minlength=groups)
+    squares = np.bincount(inverse[valid], weights=temperature[valid] ** 2, minlength=groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / n
+        std = np.sqrt(np.maximum(squares / n - mean ** 2, 0))
+    sorted_temp, starts = _segments(inverse, np.where(valid, temperature, np.nan))
+    minimum = np.fmin.reduceat(sorted_temp, starts)
+    maximum = np.fmax.reduceat(sorted_temp, starts)
+
+    result = []
+    for i in range(groups):
+        entry = dict((name, frame.labels(name, [unique[i][j]])[0]) for j, name in enumerate(by))
+        entry.update(count=int(count[i]), on_ratio=float(on[i] / count[i]),
+                     mean=_float(mean[i]), std=_float(std[i]), min=_float(minimum[i]), max=_float(maximum[i]))
+        result.append(entry)
+    return result
+
+
+def percentiles(frame, qs=(5, 25, 50, 75, 95), by=None):
+    """
+    Temperature percentiles of the whole frame, or a list of per-group
+    dicts when ``by`` names group keys.
+    """
+    temperature = frame['temperature']
+    valid = ~np.isnan(temperature)
+    if by is None:
+        values = temperature[valid]
+        return dict(('p%g' % q, _float(v)) for q, v in zip(qs, np.percentile(values, qs))) if len(values) else {}
+    if not valid.any():
+        return []
+    unique, inverse = _group(frame, by)
+    sorted_temp, starts = _segments(inverse[valid], temperature[valid])
+    present = np.unique(inverse[valid])
+    ends = np.r_[starts[1:], len(sorted_temp)]
+    result = []
+    for group, start, end in zip(present, starts, ends):
+        entry = dict((name, frame.labels(name, [unique[group][j]])[0]) for j, name in enumerate(by))
+        values = np.percentile(sorted_temp[start:end], qs)
+        entry.update(('p%g' % q, _float(v)) for q, v in zip(qs, values))
+        result.append(entry)
+    return result
+
+
+def _sensor_order(frame):
+    return np.lexsort((frame['timestamp'], frame['sensor_id']))
+
+
+def moving_average(frame, window):
+    """
+    Mean temperature of each reading and the ``window - 1`` readings before
+    it from the same sensor, in time order; returned aligned with the frame.
+    Missing temperatures are treated as 0; filter them out first with
+    with_temperature().
+    """
+    size = len(frame)
+    result = np.empty(size)
+    if not size:
+        return result
+    order = _sensor_order(frame)
+    temperature = np.nan_to_num(frame['temperature'][order])
+    sensor = frame['sensor_id'][order]
+    position = np.arange(size)
+    first = np.maximum.accumulate(np.where(np.r_[True, sensor[1:] != sensor[:-1]], position, 0))
+    totals = np.r_[0.0, np.cumsum(temperature)]
+    low = np.maximum(position + 1 - window, first)
+    result[order] = (totals[position + 1] - totals[low]) / (position + 1 - low)
+    return result
+
+
+def latest_by_sensor(frame):
+    """
+    Index of each sensor's latest reading, in sensor order.
+    """
+    if not len(frame):
+        return np.zeros(0, dtype=np.int64)
+    order = _sensor_order(frame)
+    sensor = frame['sensor_id'][order]
+    return order[np.r_[sensor[1:] != sensor[:-1], True]]
+
+
+def anomalies(frame, z=3.0, low=None, high=None):
+    """
+    Boolean arrays aligned with the frame: ``zscore`` marks readings more
+    than ``z`` standard deviations from their sensor's mean, ``out_of_range``
+    readings outside [low, high]. Also returns the z-scores themselves.
+    """
+    temperature = frame['temperature']
+    size = len(frame)
+    if not size:
+        empty = np.zeros(0, dtype=bool)
+        return {'zscore': empty, 'out_of_range': empty, 'z': np.zeros(0)}
+    _, inverse = _group(frame, ('sensor_id',))
+    valid = ~np.isnan(temperature)
+    filled = np.where(valid, temperature, 0.0)
+    n = np.bincount(inverse, weights=valid)
+    mean = np.bincount(inverse, weights=filled) / np.maximum(n, 1)
+    variance = np.bincount(inverse, weights=filled ** 2) / np.maximum(n, 1) - mean ** 2
+    std = np.sqrt(np.maximum(variance, 0))[inverse]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = np.where((std > 0) & valid, (temperature - mean[inverse]) / std, 0.0)
+    out_of_range = np.zeros(size, dtype=bool)
+    if low is not None:
+        out_of_range |= valid & (temperature < low)
+    if high is not None:
+        out_of_range |= valid & (temperature > high)
+    return {'zscore': np.abs(scores) > z, 'out_of_range': out_of_range, 'z': scores}
+
+
+def _float(value):
+    return None if np.isnan(value) else float(value)
@@ -1,27 +1,99 @@
 #!venv/bin/python
+import atexit
+import base64
+import binascii
+import hashlib
+import itertools
 import json
+import logging
+import math
 import os
-from random import randrange
+import sqlite3
+import threading
+import time
 
-from datetime import timedelta
 from datetime import datetime
-from flask import Flask, url_for, redirect, render_template, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
+import click
+import numpy as np
+from flask import Flask, url_for, redirect, render_template, request, abort, jsonify, flash, \
+    Response, stream_with_context
+from sqlalchemy import and_, bindparam, case, event, func, inspect, or_, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 from flask_security import Security, SQLAlchemyUserDatastore, \
-    UserMixin, RoleMixin, login_required, current_user
-from flask_security.utils import hash_password
+    UserMixin, RoleMixin, login_required
+from flask_security.utils import get_hmac, use_double_hash
 import flask_admin
 from flask_admin import BaseView, expose, AdminIndexView
 from flask_admin.contrib import sqla
 from flask_admin import helpers as admin_helpers
+from wtforms.validators import ValidationError
+
+import alerts
+import analytics
+import events
+import export
+import geocoding
+import ingest
+import metering
+import operations
+import passwords
+import periodic
+import retention
+import routing
+import rollups
+import seed
+import spatial
+import storage
+from authz import AccessLevel, AccessMixin, access_level
+from ingest_queue import QueueFull, WriteBehindQueue
+from instrumentation import Instrumentation
+from operations import Batch, OperationError
+from stats import FacetIndex, SummaryStats
 
 
 import datetime
 # Create Flask application
 app = Flask(__name__)
-from geopy.geocoders import Nominatim
 app.config.from_pyfile('config.py')
-db = SQLAlchemy(app)
+if os.environ.get('GREENBUILDING_PROFILE', 'development') == 'production':
+    app.config.from_pyfile('config_production.py')
+app.config.from_envvar('GREENBUILDING_SETTINGS', silent=True)
+for key in ('SECRET_KEY', 'SECURITY_PASSWORD_SALT'):
+    if not app.config.get(key):
+        raise RuntimeError('%s is not configured' % key)
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(app.config['DATABASE_POOL'],
+                                                   **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
+logging.basicConfig(level=app.config['LOG_LEVEL'], format=app.config['LOG_FORMAT'])
+log = logging.getLogger(__name__)
+
+# reads of the views marked with read_router.reads() may go to the
+# READ_REPLICAS; see routing.py
+read_router = routing.ReadRouter(sticky_seconds=app.config['READ_REPLICA_STICKY_SECONDS'])
+db = routing.RoutingSQLAlchemy(app, router=read_router)
+read_router.engines = [routing.replica_engine(url, app.root_path, **app.config['DATABASE_POOL'])
+                       for url in app.config['READ_REPLICAS']]
+
+instrumentation = None
+if app.config['INSTRUMENTATION']:
+    instrumentation = Instrumentation(app.config['SLOW_QUERY_MS'], app.config['SERVER_TIMING'])
+    instrumentation.init_app(app)
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # read-only replicas are never written, so the pragmas don't apply
+    if not isinstance(dbapi_connection, sqlite3.Connection) or isinstance(dbapi_connection,
+                                                                          routing.ReplicaConnection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
 
 # Define models
 roles_users = db.Table(
@@ -52,6 +124,8 @@ class Building(db.Model):
     state = db.Column(db.String(255))
     zip_code = db.Column(db.Integer)
     confirmed_at = db.Column(db.DateTime())
+    clusters = db.relationship('ClusterNode', backref='building',
+                               order_by='(ClusterNode.floor, ClusterNode.id)')
 
     def to_dict(self):
         return {c.name: getattr(self, c.name, None) for c in self.__table__.columns}
@@ -80,10 +154,18 @@ class ClusterNode(db.Model):
     lng = db.Column(db.Float)
     ip = db.Column(db.String(255))
     comment = db.Column(db.String(255))
+    sensors = db.relationship('SensorNode', backref='cluster', order_by='SensorNode.id')
 
     def to_dict(self):
         return {c.name: getattr(self, c.name, None) for c in self.__table__.columns}
 
+
+class TopologyRevision(db.Model):
+    # single row, bumped in the same transaction as every change to
+    # buildings, clusters or sensors; the topology ETag is derived from it
+    id = db.Column(db.Integer, primary_key=True)
+    revision = db.Column(db.Integer, nullable=False, default=0)
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.String(255))
@@ -92,7 +174,9 @@ class User(db.Model, UserMixin):
     password = db.Column(db.String(255))
     active = db.Column(db.Boolean())
     confirmed_at = db.Column(db.DateTime())
-    roles = db.relationship('Role', secondary=roles_users,
+    # loaded with the user, which Flask-Security does on every request, so
+    # resolving the access level needs no query of its own
+    roles = db.relationship('Role', secondary=roles_users, lazy='joined',
                             backref=db.backref('users', lazy='dynamic'))
 
     def __str__(self):
@@ -111,37 +195,621 @@ class SensorData(db.Model):
     time = db.Column(db.Time)
     status = db.Column(db.String(255))
 
+    # composite indexes backing the building/floor/room/date filters of
+    # /data_request and per-sensor time lookups
+    __table_args__ = (
+        db.Index('ix_sensor_data_location', 'building_id', 'floor', 'room', 'date'),
+        db.Index('ix_sensor_data_sensor_time', 'sensor_id', 'date', 'time'),
+        db.Index('ix_sensor_data_timeline', 'date', 'time', 'id'),
+    )
+
     def to_dict(self):
         return {c.name: getattr(self, c.name, None) for c in self.__table__.columns}
 
 
 
+def _reading_store():
+    if app.config['READING_STORE'] == 'sharded':
+        return storage.ShardedStore(app.config['READING_SHARD_DIR'], SensorData.__table__)
+    return storage.TableStore(db.session, SensorData.__table__)
+
+
+# where the readings live; every reading query goes through it
+reading_store = _reading_store()
+
+
+class ReadingRollup(db.Model):
+    """
+    Hourly, daily and monthly temperature aggregates per sensor location;
+    see rollups.py.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    resolution = db.Column(db.String(8))
+    bucket = db.Column(db.DateTime)
+    sensor_id = db.Column(db.Integer)
+    building_id = db.Column(db.Integer)
+    floor = db.Column(db.Integer)
+    room = db.Column(db.String(255))
+    count = db.Column(db.Integer)
+    temp_sum = db.Column(db.Float)
+    temp_min = db.Column(db.Float)
+    temp_max = db.Column(db.Float)
+    on_count = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.Index('ix_reading_rollup_sensor', 'resolution', 'sensor_id', 'bucket'),
+        db.Index('ix_reading_rollup_location', 'resolution', 'building_id', 'floor', 'room', 'bucket'),
+    )
+
+
+class RetentionMark(db.Model):
+    """
+    The raw readings of a building dated before ``purged_before`` were
+    deleted by the retention job; only their rollups remain.
+    """
+    building_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    purged_before = db.Column(db.Date)
+
+
+class SensorUsage(db.Model):
+    """
+    Hours of ``day`` in which a sensor reported ON, as a 24-bit mask; see
+    metering.py.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    sensor_id = db.Column(db.Integer)
+    building_id = db.Column(db.Integer)
+    day = db.Column(db.Date)
+    hours = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_sensor_usage_key', 'sensor_id', 'day', 'building_id', unique=True),
+    )
+
+
+class BillingDay(db.Model):
+    """
+    Billable sensor-hours of a building on one day.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    building_id = db.Column(db.Integer)
+    day = db.Column(db.Date)
+    sensor_hours = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_billing_day_key', 'day', 'building_id', unique=True),
+    )
+
+
+class AlertRule(db.Model):
+    """
+    Condition raising alerts for the readings of a building, floor or room
+    (any of them empty to match all); see alerts.py.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255))
+    kind = db.Column(db.String(16), nullable=False)
+    building_id = db.Column(db.Integer, db.ForeignKey('building.id'))
+    floor = db.Column(db.Integer)
+    room = db.Column(db.String(255))
+    threshold = db.Column(db.Float)
+    window_seconds = db.Column(db.Integer)
+    enabled = db.Column(db.Boolean, nullable=False, default=True)
+
+    def __str__(self):
+        return self.name or '%s #%s' % (self.kind, self.id)
+
+
+class Alert(db.Model):
+    """
+    One occurrence of a rule holding for a sensor, from the reading that
+    raised it until the one that resolved it.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    rule_id = db.Column(db.Integer, db.ForeignKey('alert_rule.id'))
+    sensor_id = db.Column(db.Integer)
+    building_id = db.Column(db.Integer)
+    floor = db.Column(db.Integer)
+    room = db.Column(db.String(255))
+    kind = db.Column(db.String(16))
+    value = db.Column(db.Float)
+    last_value = db.Column(db.Float)
+    count = db.Column(db.Integer, nullable=False, default=1)
+    started_at = db.Column(db.DateTime)
+    last_seen_at = db.Column(db.DateTime)
+    resolved_at = db.Column(db.DateTime)
+    rule = db.relationship('AlertRule', backref='alerts')
+
+    __table_args__ = (
+        db.Index('ix_alert_open', 'sensor_id', 'resolved_at'),
+        db.Index('ix_alert_started', 'started_at'),
+        # one open alert per rule and sensor, whichever process raised it
+        db.Index('ix_alert_open_key', 'rule_id', 'sensor_id', unique=True,
+                 sqlite_where=db.text('resolved_at IS NULL'), postgresql_where=db.text('resolved_at IS NULL')),
+    )
+
+
+class DeviceToken(db.Model):
+    """
+    API token of a machine client, optionally bound to one cluster. Only
+    the SHA-256 of its secret is stored; see passwords.py.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255))
+    cluster_id = db.Column(db.Integer, db.ForeignKey('cluster_node.id'))
+    digest = db.Column(db.String(64), nullable=False)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.now)
+    cluster = db.relationship('ClusterNode')
+
+    def __str__(self):
+        return self.name or 'token %s' % self.id
+
+
+class MeterWatermark(db.Model):
+    # single row: the highest reading id metered into BillingDay, and when
+    id = db.Column(db.Integer, primary_key=True)
+    reading_id = db.Column(db.Integer, nullable=False, default=0)
+    metered_at = db.Column(db.DateTime)
+
+
+# Columns the incrementally maintained summaries need from each reading
+READING_SUMMARY_COLUMNS = ('sensor_id', 'cluster_id', 'building_id', 'floor', 'room',
+                           'date', 'time', 'status', 'temperature')
+
+
+def _dashboard_groups():
+    """
+    Reading counts per (sensor, cluster, building) with the sensor's latest
+    reading, in a single aggregate query.
+    """
+    table = SensorData.__table__
+    latest = table.alias('latest')
+
+    def latest_of(column):
+        return select([column]).where(latest.c.sensor_id == table.c.sensor_id) \
+            .order_by(latest.c.date.desc(), latest.c.time.desc(), latest.c.id.desc()).limit(1).as_scalar()
+
+    query = select([table.c.sensor_id, table.c.cluster_id, table.c.building_id, func.count(),
+                    latest_of(latest.c.date), latest_of(latest.c.time), latest_of(latest.c.status)]) \
+        .group_by(table.c.sensor_id, table.c.cluster_id, table.c.building_id)
+    return reading_store.execute_all(query)
+
+
+def _latest_readings(sensor_ids):
+    table = SensorData.__table__
+    found = {}
+    for sensor_id in sensor_ids:
+        query = select([table.c.date, table.c.time, table.c.id, table.c.status]) \
+            .where(table.c.sensor_id == sensor_id) \
+            .order_by(table.c.date.desc(), table.c.time.desc(), table.c.id.desc()).limit(1)
+        # one candidate per store part; the newest of them wins
+        readings = reading_store.execute_all(query)
+        if readings:
+            date, time, _, status = max(readings, key=lambda row: tuple(row[:3]))
+            found[sensor_id] = (date, time, status)
+    return found
+
+
+def _facet_groups():
+    # groups of different store parts may repeat; FacetIndex adds them up
+    table = SensorData.__table__
+    query = select([table.c.building_id, table.c.floor, table.c.room, func.count()]) \
+        .group_by(table.c.building_id, table.c.floor, table.c.room)
+    return reading_store.execute_all(query)
+
+
+# loaded from the primary: a lagging replica would miss writes this process
+# has already applied to them
+dashboard_stats = SummaryStats(read_router.on_primary(_dashboard_groups), read_router.on_primary(_latest_readings))
+facet_index = FacetIndex(read_router.on_primary(_facet_groups))
+
+
+# live updates pushed to /api/events
+event_broker = events.Broker(max_subscribers=app.config['EVENTS_MAX_SUBSCRIBERS'])
+
+
+def apply_reading_writes(inserted=(), deleted=()):
+    """
+    Bring the maintained summaries up to date with committed reading writes.
+    """
+    dashboard_stats.apply(inserted, deleted)
+    facet_index.apply(inserted, deleted)
+    # the counts are read when the event is sent, once per coalesced burst
+    event_broker.publish('dashboard', 'dashboard', None, None)
+
+
+ingest.on_ingest(lambda rows: apply_reading_writes(inserted=rows))
+
+
+@ingest.on_ingest
+def _publish_readings(rows):
+    if not event_broker.has_subscribers():
+        return
+    for row in rows:
+        if row.get('sensor_id') is None:
+            continue
+        event_broker.publish('building:%s' % row.get('building_id'), 'reading', row['sensor_id'], {
+            'sensor_id': row['sensor_id'], 'building_id': row.get('building_id'),
+            'cluster_id': row.get('cluster_id'), 'temperature': row.get('temperature'),
+            'status': row.get('status'), 'date': row['date'].isoformat(), 'time': row['time'].strftime('%H:%M:%S')})
+
+
+# rules run on every ingested batch; see alerts.py
+alert_engine = alerts.AlertEngine(history=app.config['ALERT_HISTORY'])
+_alert_lock = threading.Lock()
+_alert_rules_loaded_at = None
+
+
+def load_alert_rules():
+    """
+    Load the enabled rules into the alert engine, along with the alerts
+    still open so they are not raised again. Open alerts of rules since
+    disabled or deleted are closed.
+    """
+    global _alert_rules_loaded_at
+    rules = [alerts.Rule(rule.id, rule.kind, rule.building_id, rule.floor, rule.room, rule.threshold,
+                         rule.window_seconds)
+             for rule in AlertRule.query.filter(AlertRule.enabled.is_(True))]
+    alert_engine.load(rules)
+    table = Alert.__table__
+    orphaned = [table.c.resolved_at.is_(None)]
+    if rules:
+        orphaned.append(or_(table.c.rule_id.is_(None), table.c.rule_id.notin_([rule.id for rule in rules])))
+    if db.session.execute(table.update().where(and_(*orphaned)).values(
+            resolved_at=datetime.datetime.now())).rowcount:
+        db.session.commit()
+    alert_engine.restore(tuple(row) for row in db.session.query(Alert.rule_id, Alert.sensor_id).filter(
+        Alert.resolved_at.is_(None)))
+    _alert_rules_loaded_at = time.monotonic()
+
+
+def _reading_datetime(row):
+    return datetime.datetime.combine(row['date'], row['time'])
+
+
+def record_alerts(changes, repeated, attempts=3):
+    """
+    Persist what AlertEngine.evaluate() returned: insert the alerts opened,
+    close the ones resolved and count the readings that kept others open.
+    An alert another process opened meanwhile is counted instead of opened
+    again.
+    """
+    for attempt in range(attempts):
+        try:
+            opened = _record_alerts(changes, repeated)
+            break
+        except IntegrityError:
+            # ix_alert_open_key: another process opened one of the alerts
+            # since they were read
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+
+    for alert_id, rule, row, value in opened:
+        log.warning('alert %d: %s rule %d on sensor %s (value %s)', alert_id, rule.kind, rule.id, row['sensor_id'], value)
+        event_broker.publish('building:%s' % row['building_id'], 'alert', alert_id, {
+            'id': alert_id, 'rule_id': rule.id, 'kind': rule.kind, 'sensor_id': row['sensor_id'],
+            'building_id': row['building_id'], 'floor': row['floor'], 'room': row['room'], 'value': value,
+            'started_at': _reading_datetime(row).isoformat()})
+
+
+def _record_alerts(changes, repeated, chunk=500):
+    table = Alert.__table__
+    touched = set(repeated) | set(change[1] if change[0] == 'resolve' else (change[1].id, change[2]['sensor_id'])
+                                  for change in changes)
+    open_ids = {}
+    sensor_ids = sorted(set(key[1] for key in touched))
+    for i in range(0, len(sensor_ids), chunk):
+        query = select([table.c.id, table.c.rule_id, table.c.sensor_id]).where(and_(
+            table.c.resolved_at.is_(None), table.c.sensor_id.in_(sensor_ids[i:i + chunk]))).order_by(table.c.id)
+        for alert_id, rule_id, sensor_id in db.session.execute(query):
+            open_ids[(rule_id, sensor_id)] = alert_id
+
+    opened = []
+    for change in changes:
+        if change[0] == 'open':
+            _, rule, row, value = change
+            at = _reading_datetime(row)
+            alert_id = open_ids.get((rule.id, row['sensor_id']))
+            if alert_id is not None:
+                db.session.execute(table.update().where(table.c.id == alert_id).values(
+                    count=table.c.count + 1, last_seen_at=at, last_value=value))
+                continue
+            alert_id = db.session.execute(table.insert().values(
+                rule_id=rule.id, sensor_id=row['sensor_id'], building_id=row['building_id'], floor=row['floor'],
+                room=row['room'], kind=rule.kind, value=value, last_value=value, count=1, started_at=at,
+                last_seen_at=at)).inserted_primary_key[0]
+            open_ids[(rule.id, row['sensor_id'])] = alert_id
+            opened.append((alert_id, rule, row, value))
+            continue
+        _, key, row, repeats = change
+        alert_id = open_ids.pop(key, None)
+        if alert_id is None:
+            continue
+        values = {'resolved_at': _reading_datetime(row)}
+        if repeats is not None:
+            values.update(count=table.c.count + repeats[0], last_seen_at=_reading_datetime(repeats[1]),
+                          last_value=repeats[2])
+        db.session.execute(table.update().where(table.c.id == alert_id).values(**values))
+
+    updates = [{'_id': open_ids[key], '_count': count, '_seen': _reading_datetime(row), '_value': value}
+               for key, (count, row, value) in repeated.items() if key in open_ids]
+    if updates:
+        db.session.execute(table.update().where(table.c.id == bindparam('_id')).values(
+            count=table.c.count + bindparam('_count'), last_seen_at=bindparam('_seen'),
+            last_value=bindparam('_value')), updates)
+    db.session.commit()
+    return opened
+
+
+@ingest.on_ingest
+def _evaluate_alerts(rows):
+    global _alert_rules_loaded_at
+    with _alert_lock:
+        try:
+            max_age = app.config['ALERT_RULES_MAX_AGE']
+            if _alert_rules_loaded_at is None or (max_age is not None
+                                                  and time.monotonic() - _alert_rules_loaded_at > max_age):
+                load_alert_rules()
+            if not alert_engine.rules:
+                return
+            changes, repeated = alert_engine.evaluate(rows)
+            if changes or repeated:
+                record_alerts(changes, repeated)
+        except Exception:
+            db.session.rollback()
+            # the engine may be ahead of the alert table: forget its open
+            # alerts, the next batch reloads them from there
+            alert_engine.load(())
+            _alert_rules_loaded_at = None
+            raise
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_alert_rules(session, flush_context):
+    if any(isinstance(obj, AlertRule) for obj in itertools.chain(session.new, session.dirty, session.deleted)):
+        session.info['alert_rules_changed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _alert_rules_committed(session):
+    global _alert_rules_loaded_at
+    if session.info.pop('alert_rules_changed', None):
+        # reloaded with the next ingested batch
+        _alert_rules_loaded_at = None
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _alert_rules_rolled_back(session):
+    session.info.pop('alert_rules_changed', None)
+
+
+def _reading_values(reading, committed=False):
+    values = {}
+    for key in READING_SUMMARY_COLUMNS:
+        history = inspect(reading).attrs[key].history
+        if committed and history.deleted:
+            values[key] = history.deleted[0]
+        else:
+            values[key] = getattr(reading, key)
+    return values
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_reading_writes(session, flush_context):
+    # ORM writes (the admin views) are applied once the transaction commits
+    inserted, deleted = session.info.setdefault('reading_writes', ([], []))
+    for obj in session.new:
+        if isinstance(obj, SensorData):
+            inserted.append(_reading_values(obj))
+    for obj in session.dirty:
+        if isinstance(obj, SensorData) and session.is_modified(obj):
+            deleted.append(_reading_values(obj, committed=True))
+            inserted.append(_reading_values(obj))
+    for obj in session.deleted:
+        if isinstance(obj, SensorData):
+            deleted.append(_reading_values(obj, committed=True))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_reading_writes(session):
+    writes = session.info.pop('reading_writes', None)
+    if writes:
+        apply_reading_writes(*writes)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_reading_writes(session):
+    session.info.pop('reading_writes', None)
+
+
+def recount_dashboard_stats():
+    """
+    The dashboard counts computed from a full scan, for checking the
+    maintained ones.
+    """
+    table = SensorData.__table__
+    distinct = {}
+    for name in ('sensor_id', 'cluster_id', 'building_id'):
+        query = select([table.c[name]]).where(table.c[name].isnot(None)).distinct()
+        distinct[name] = set(row[0] for row in reading_store.execute_all(query))
+    latest = {}
+    for sensor_id, date, time, id, status in reading_store.iter_rows(
+            {}, ('sensor_id', 'date', 'time', 'id', 'status')):
+        if sensor_id is None:
+            continue
+        if sensor_id not in latest or (date, time, id) > latest[sensor_id][0]:
+            latest[sensor_id] = ((date, time, id), status)
+    active = sum(1 for _, status in latest.values() if status == 'ON')
+    return {'sensors': len(distinct['sensor_id']), 'active_sensors': active,
+            'clusters': len(distinct['cluster_id']), 'buildings': len(distinct['building_id'])}
+
+
+@app.cli.command('check-stats')
+def check_stats_command():
+    """Compare the maintained dashboard counts with a full recount."""
+    differences = dashboard_stats.check(recount_dashboard_stats())
+    for key, (maintained, recounted) in sorted(differences.items()):
+        print('%s: maintained %d, recounted %d' % (key, maintained, recounted))
+    if differences:
+        raise SystemExit(1)
+    print('dashboard counts are consistent')
+
+
+TOPOLOGY_MODELS = (Building, ClusterNode, SensorNode)
+
+
+def bump_topology_revision(session):
+    # once per transaction is enough
+    if session.info.get('topology_bumped'):
+        return
+    session.info['topology_bumped'] = True
+    table = TopologyRevision.__table__
+    result = session.execute(table.update().where(table.c.id == 1).values(revision=table.c.revision + 1))
+    if not result.rowcount:
+        session.execute(table.insert().values(id=1, revision=1))
+
+
+def topology_revision():
+    revision = db.session.execute(select([TopologyRevision.revision]).where(TopologyRevision.id == 1)).scalar()
+    return revision or 0
+
+
+@event.listens_for(db.session, 'after_flush')
+def _topology_flushed(session, flush_context):
+    if any(isinstance(obj, TOPOLOGY_MODELS) for obj in session.new | session.dirty | session.deleted):
+        bump_topology_revision(session)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_sensor_status(session, flush_context):
+    changed = session.info.setdefault('sensor_status', {})
+    for obj in session.new | session.dirty:
+        if isinstance(obj, SensorNode) and inspect(obj).attrs.status.history.has_changes():
+            building_id = obj.cluster.building_id if obj.cluster is not None else None
+            changed[obj.id] = (building_id, {'sensor_id': obj.id, 'cluster_id': obj.cluster_id,
+                                             'building_id': building_id, 'status': obj.status})
+
+
+@event.listens_for(db.session, 'after_commit')
+def _topology_committed(session):
+    if session.info.pop('topology_bumped', None):
+        event_broker.publish('topology', 'topology', None, {})
+    for sensor_id, (building_id, data) in session.info.pop('sensor_status', {}).items():
+        event_broker.publish('building:%s' % building_id, 'sensor_status', sensor_id, data)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _topology_rolled_back(session):
+    session.info.pop('topology_bumped', None)
+    session.info.pop('sensor_status', None)
+
+
+@event.listens_for(db.session, 'after_bulk_update')
+@event.listens_for(db.session, 'after_bulk_delete')
+def _topology_bulk_changed(context):
+    # Query.update()/delete() skip the flush
+    if context.mapper.class_ in TOPOLOGY_MODELS:
+        bump_topology_revision(context.session)
+
+
 # Setup Flask-Security
 user_datastore = SQLAlchemyUserDatastore(db, User, Role)
 security = Security(app, user_datastore)
 
+# passwords are hashed and verified on a process pool; see passwords.py
+password_hasher = passwords.PasswordHasher(
+    app.extensions['security'].pwd_context.to_dict(),
+    app.config.get('SECURITY_PASSWORD_HASH_OPTIONS'),
+    workers=app.config['PASSWORD_HASH_WORKERS'],
+    max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+    timeout=app.config['PASSWORD_HASH_TIMEOUT'],
+)
+app.extensions['security'].pwd_context = password_hasher
+atexit.register(password_hasher.shutdown)
+
+
+@app.errorhandler(passwords.HasherBusy)
+def _hasher_busy(e):
+    return Response(str(e), 503, {'Retry-After': '1'})
+
+
+def hash_passwords(values):
+    """
+    hash_password() of several passwords at once, spread over the hashing
+    workers.
+    """
+    if use_double_hash():
+        values = [get_hmac(value).decode('ascii') for value in values]
+    return password_hasher.hash_many(values)
+
+
+def _load_device_token(token_id):
+    table = DeviceToken.__table__
+    return db.session.execute(select([table.c.id, table.c.digest, table.c.cluster_id]).where(
+        and_(table.c.id == token_id, table.c.active.is_(True)))).first()
+
+
+device_tokens = passwords.DeviceTokenCache(_load_device_token, max_age=app.config['DEVICE_TOKEN_MAX_AGE'])
+
+
+def create_device_token(name, cluster_id=None):
+    """
+    Add a DeviceToken; returns it and the token to hand to the client,
+    which is not stored anywhere.
+    """
+    secret = passwords.new_token_secret()
+    device_token = DeviceToken(name=name, cluster_id=cluster_id, digest=passwords.token_digest(secret))
+    db.session.add(device_token)
+    db.session.flush()
+    return device_token, '%d.%s' % (device_token.id, secret)
+
+
+def request_device_token():
+    """
+    The valid device token record (id, digest, cluster_id) of the request's
+    ``Authorization: Bearer`` header; None if there is no such header,
+    False if its token is not valid.
+    """
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer':
+        return None
+    return device_tokens.check(token.strip()) or False
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_device_tokens(session, flush_context):
+    if any(isinstance(obj, DeviceToken) for obj in itertools.chain(session.new, session.dirty, session.deleted)):
+        session.info['device_tokens_changed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _device_tokens_committed(session):
+    if session.info.pop('device_tokens_changed', None):
+        device_tokens.clear()
 
-# Create customized model view class
-class MyModelView(sqla.ModelView):
-    def is_accessible(self):
-        if not current_user.is_active or not current_user.is_authenticated:
-            return False
-        if current_user.has_role('superuser'):
-            return True
-        return False
-
-    def _handle_view(self, name, **kwargs):
-        """
-        Override builtin _handle_view in order to redirect users when a view is not accessible.
-        """
-        if not self.is_accessible():
-            if current_user.is_authenticated:
-                # permmission denied
-                abort(403)
-            else:
-                # login
-                return redirect(url_for('security.login', next=request.url))
 
+@event.listens_for(db.session, 'after_rollback')
+def _device_tokens_rolled_back(session):
+    session.info.pop('device_tokens_changed', None)
+
+
+_token_request_loader = app.login_manager._request_callback
+
+
+@app.login_manager.request_loader
+def request_loader(req):
+    # Flask-Security looks for an auth token in JSON bodies and assumes they
+    # are objects, which ingest batches sent as bare arrays are not
+    if req.is_json and not isinstance(req.get_json(silent=True), dict):
+        return None
+    return _token_request_loader(req)
+
+
+# Create customized model view class
+class MyModelView(AccessMixin, sqla.ModelView):
+    required_level = AccessLevel.SUPERUSER
 
     # can_edit = True
     edit_modal = True
@@ -151,345 +819,1481 @@ class MyModelView(sqla.ModelView):
     details_modal = True
 
 
-class UserView(sqla.ModelView):
-
-    def is_accessible(self):
-        if not current_user.is_active or not current_user.is_authenticated:
-            return False
-        if current_user.has_role('superuser'):
-            return True
-        return False
-
-    def _handle_view(self, name, **kwargs):
-        """
-        Override builtin _handle_view in order to redirect users when a view is not accessible.
-        """
-        if not self.is_accessible():
-            if current_user.is_authenticated:
-                # permmission denied
-                abort(403)
-            else:
-                column_list = ['email', 'first_name', 'last_name']
-                can_create = False
-                can_edit = False
-                can_delete = False
-                column_searchable_list = column_list
-                column_exclude_list = ['password']
-                form_excluded_columns = column_exclude_list
-                column_details_exclude_list = column_exclude_list
-                # column_filters = column_editable_list
-
-
-class SensorView(sqla.ModelView):
-
-    def is_accessible(self):
-        if not current_user.is_active or not current_user.is_authenticated:
-            return False
-        if current_user.has_role('superuser') or current_user.has_role('manager'):
-            return True
-        return False
-
-    # TODO: change number to enums
-    def get_access_level(self):
-        if not current_user.is_active or not current_user.is_authenticated:
-            return 0
-        if current_user.has_role('superuser'):
-            return 3
-        if current_user.has_role('manager'):
-            return 2
-        if current_user.has_role('user'):
-            return 1
-        return 1
-
-    def _handle_view(self, name, **kwargs):
-        """
-        Override builtin _handle_view in order to redirect users when a view is not accessible.
-        """
-        print("access level",self.get_access_level())
-        access_level = self.get_access_level()
-
-        if access_level == 3:
-            column_list = ["id", "floor", "ip", "cluster_id", "type", "status"]
-            column_searchable_list = column_list
-            can_create = True
-            can_edit = True
-            can_delete = True
-        elif access_level == 2:
-            column_list = ["id", "floor", "ip", "cluster_id", "type", "status"]
-            column_searchable_list = column_list
-            can_create = False
-            can_edit = False
-            can_delete = False
-        elif access_level == 1:
-            print("user access")
-            column_list = ["id", "floor", "ip", "cluster_id", "type", "status"]
-            column_searchable_list = column_list
-            can_create = False
-            can_edit = False
-            can_delete = False
+class UserView(AccessMixin, sqla.ModelView):
+    required_level = AccessLevel.SUPERUSER
 
 
-        else:
-            # login
-            return redirect(url_for('security.login', next=request.url))
+class SensorView(AccessMixin, sqla.ModelView):
+    # every signed-in user may look, only superusers may change anything
+    required_level = AccessLevel.USER
+
+    column_list = ["id", "floor", "ip", "cluster_id", "type", "status"]
+    column_searchable_list = column_list
+
+    @property
+    def can_create(self):
+        return access_level() >= AccessLevel.SUPERUSER
+
+    can_edit = can_create
+    can_delete = can_create
+
+
+class AlertRuleView(AccessMixin, sqla.ModelView):
+    # managers look after their buildings' rules
+    required_level = AccessLevel.MANAGER
+
+    column_list = ['id', 'name', 'kind', 'building_id', 'floor', 'room', 'threshold', 'window_seconds', 'enabled']
+    form_columns = ['name', 'kind', 'building_id', 'floor', 'room', 'threshold', 'window_seconds', 'enabled']
+    form_choices = {'kind': [(kind, kind) for kind in alerts.KINDS]}
+    column_descriptions = {
+        'threshold': 'degrees: the limit of above/below rules, the largest change of rate rules',
+        'window_seconds': 'how far back rate rules look',
+    }
+
+    def on_model_change(self, form, model, is_created):
+        if model.kind in ('above', 'below', 'rate') and model.threshold is None:
+            raise ValidationError('%s rules need a threshold' % model.kind)
+        if model.kind == 'rate' and not model.window_seconds:
+            raise ValidationError('rate rules need a window')
+
+
+class AlertView(AccessMixin, sqla.ModelView):
+    required_level = AccessLevel.MANAGER
+
+    can_create = False
+    can_edit = False
+    column_list = ['id', 'rule', 'kind', 'sensor_id', 'building_id', 'floor', 'room', 'value', 'last_value',
+                   'count', 'started_at', 'last_seen_at', 'resolved_at']
+    column_filters = ['kind', 'sensor_id', 'building_id', 'floor', 'room', 'started_at', 'resolved_at']
+    column_default_sort = ('started_at', True)
+
+    @property
+    def can_delete(self):
+        return access_level() >= AccessLevel.SUPERUSER
 
 
+class DeviceTokenView(AccessMixin, sqla.ModelView):
+    required_level = AccessLevel.SUPERUSER
 
+    column_list = ['id', 'name', 'cluster', 'active', 'created_at']
+    form_columns = ['name', 'cluster', 'active']
+    column_descriptions = {'cluster': 'if set, the token only accepts readings for this cluster'}
 
-class BillingView(BaseView):
-    def is_accessible(self):
-        if not current_user.is_active or not current_user.is_authenticated:
-            return False
-        if current_user.has_role('superuser'):
-            return True
-        return False
+    def on_model_change(self, form, model, is_created):
+        if is_created:
+            model.secret = passwords.new_token_secret()
+            model.digest = passwords.token_digest(model.secret)
+
+    def after_model_change(self, form, model, is_created):
+        if is_created:
+            # the only time the token is shown
+            flash('Token for %s: %d.%s' % (model, model.id, model.secret), 'success')
+
+
+class BillingView(AccessMixin, BaseView):
+    required_level = AccessLevel.SUPERUSER
 
     @expose('/')
     def index(self):
-        count = SensorNode.query.count()
-        return self.render('admin/billing.html',count=count)
+        # metered by the meter-usage command or the metering worker, never
+        # here: catching up could read every reading in the request
+        start, end = billing_period(request.args)
+        metered_id, metered_at, newest_id = metering_status()
+        return self.render('admin/billing.html', start=start, end=end,
+                           last_day=end - datetime.timedelta(days=1), rate=app.config['BILLING_HOURLY_RATE'],
+                           invoices=invoices(start, end), metered_id=metered_id, metered_at=metered_at,
+                           newest_id=newest_id)
+
+class MapView(AccessMixin, BaseView):
+    required_level = AccessLevel.MANAGER
+
+    @expose('/')
+    @read_router.reads
+    def index(self):
+        # pass in the list of buildings; clusters and sensors come from
+        # /api/topology
+        buildings = [b.to_dict() for b in Building.query.order_by(Building.id)]
+        return self.render('admin/map.html', buildings=buildings)
 
-class MapView(BaseView):
 
-    def is_accessible(self):
-        if not current_user.is_active or not current_user.is_authenticated:
-            return False
-        if current_user.has_role('superuser') or current_user.has_role('manager'):
-            return True
-        return False
+class AnalyticsView(AccessMixin, BaseView):
+    required_level = AccessLevel.MANAGER
 
     @expose('/')
     def index(self):
-        # TODO: finish the user roles to clean this part
-        # pass in the list of buildings
-        buildings = Building.query.all()
-        return self.render('admin/map.html', buildings=buildings)
+        facets = facet_index.values()
+        return self.render('admin/analytics.html', buildings=facets['buildings'],
+                           floors=facets['floors'], rooms=facets['rooms'])
 
 
 class DataView(BaseView):
     @expose('/')
+    @read_router.reads
     def index(self):
-        buildings = []
-        floors = []
-        rooms = []
-        sensor_logs = SensorData.query.all()
-        for sensor_data in sensor_logs:
-            if str(sensor_data.building_id) not in buildings:
-                buildings.append(str(sensor_data.building_id))
-            if str(sensor_data.floor) not in floors:
-                floors.append(str(sensor_data.floor))
-            if str(sensor_data.room) not in rooms:
-                rooms.append(str(sensor_data.room))
-            buildings.sort(key=int)
-            floors.sort(key=int)
-            rooms.sort(key=int)
-        return self.render('admin/data_view.html',entries=sensor_logs, buildings=buildings, floors=floors, rooms=rooms)
+        facets = facet_index.values()
+        return self.render('admin/data_view.html', buildings=facets['buildings'],
+                           floors=facets['floors'], rooms=facets['rooms'])
+
+
+def reading_criteria(filters):
+    """
+    Store criteria of the building/floor/room/date filters posted by the data
+    view. Empty filters are ignored and the date bounds are exclusive.
+    """
+    criteria = {}
+    try:
+        if filters.get('building'):
+            criteria['building_id'] = int(filters['building'])
+        if filters.get('floor'):
+            criteria['floor'] = int(filters['floor'])
+        if filters.get('room'):
+            criteria['room'] = str(filters['room'])
+        if filters.get('start_date'):
+            criteria['date_after'] = datetime.datetime.strptime(filters['start_date'], "%Y-%m-%d").date()
+        if filters.get('end_date'):
+            criteria['date_before'] = datetime.datetime.strptime(filters['end_date'], "%Y-%m-%d").date()
+    except ValueError:
+        abort(400)
+    return criteria
+
+
+def reading_to_json(row):
+    """
+    JSON-ready dict of a reading row, with the date and time formatted for
+    the data view table.
+    """
+    temp = dict(row)
+    temp['date'] = temp['date'].strftime('%Y-%m-%d')
+    temp['time'] = temp['time'].strftime('%H:%M')
+    return temp
+
+
+def encode_cursor(row):
+    key = '|'.join((row['date'].isoformat(), row['time'].isoformat(), str(row['id'])))
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        date, time, id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return (datetime.datetime.strptime(date, "%Y-%m-%d").date(),
+                datetime.time.fromisoformat(time), int(id))
+    except (ValueError, TypeError, binascii.Error):
+        abort(400)
+
+
+def iter_readings(criteria, page_size):
+    """
+    Walk every matching reading in (date, time, id) order one keyset page at
+    a time, so only a single page is ever held in memory.
+    """
+    cursor = None
+    while True:
+        page = reading_store.page(criteria, cursor, page_size)
+        for row in page:
+            yield row
+        if len(page) < page_size:
+            return
+        cursor = storage.sort_key(page[-1])
+
+
+@app.route('/api/readings')
+@login_required
+@read_router.reads
+def readings_api():
+    """
+    Readings matching the data view filters.
+
+    By default returns one page and the cursor of the next one. With
+    ``format=ndjson`` the whole result is streamed as JSON Lines, and with
+    ``stream=1`` as a chunked JSON array.
+    """
+    filters = request.args
+    try:
+        page_size = int(filters.get('page_size', app.config['READINGS_PAGE_SIZE']))
+    except ValueError:
+        abort(400)
+    page_size = max(1, min(page_size, app.config['READINGS_MAX_PAGE_SIZE']))
+    criteria = reading_criteria(filters)
+
+    if filters.get('format') == 'ndjson':
+        def generate():
+            for sensor_data in iter_readings(criteria, page_size):
+                yield json.dumps(reading_to_json(sensor_data)) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    if filters.get('stream'):
+        def generate():
+            separator = '['
+            for sensor_data in iter_readings(criteria, page_size):
+                yield separator + json.dumps(reading_to_json(sensor_data))
+                separator = ','
+            yield '[]' if separator == '[' else ']'
+        return Response(stream_with_context(generate()), mimetype='application/json')
+
+    cursor = decode_cursor(filters['cursor']) if filters.get('cursor') else None
+    page = reading_store.page(criteria, cursor, page_size)
+    next_cursor = encode_cursor(page[-1]) if len(page) == page_size else None
+    return jsonify(readings=[reading_to_json(r) for r in page], next_cursor=next_cursor)
 
 
 @app.route('/data_request', methods=['POST','GET'])
+@read_router.reads
 def data_request():
     if request.method == "POST":
         filters = request.form
-        print('data_request',filters)
-
-        s_query = SensorData.query.all()
-        result = []
-
-        # filter query result
-        for sensor_data in s_query:
-                if filters['building']:
-                    if not str(filters['building']) == str(sensor_data.building_id):
-                        continue
-                if filters['floor']:
-                    if not str(filters['floor']) == str(sensor_data.floor):
-                        continue
-                if filters['room']:
-                    if not str(filters['room']) == str(sensor_data.room):
-                        continue
-                if filters['start_date']:
-                    start_date = datetime.datetime.strptime(filters['start_date'], "%Y-%m-%d").date()
-                    if not start_date < sensor_data.date:
-                        continue
-                if filters['end_date']:
-                    end_date = datetime.datetime.strptime(filters['end_date'], "%Y-%m-%d").date()
-                    if not end_date > sensor_data.date:
-                        continue
-                temp = sensor_data.to_dict()
-                temp['date'] = temp['date'].strftime('%Y-%m-%d')
-                temp['time'] = temp['time'].strftime('%H:%S')
-                result.append(temp)
-        print("result is", result)
+        log.debug('data_request %s', filters.to_dict())
 
+        result = [reading_to_json(r) for r in reading_store.iter_rows(reading_criteria(filters))]
         return json.dumps(result)
 
-# handles all requests going around map view
-@app.route('/map_request',methods=['POST','GET'])
-def map_request():
 
-    if request.method == 'POST':
-        packet = request.form.to_dict()
-        if 'type' not in packet.keys() :
-            print("weird packet!")
-            return ""
-        print("map_request", request.form['type'])
-        operation = packet['type']  # determines operations to do
-        # init vars for easier access
-        try:
-            building_id = packet['building_id']
-        except KeyError:
-            pass
-        try:
-            floor = packet['floor']
-        except KeyError:
-            pass
-        try:
-            ip = packet['ip']
-        except KeyError:
-            pass
-        try:
-            address = packet['address']
-        except KeyError:
-            pass
-        try:
-            city = packet['city']
-        except KeyError:
-            pass
-        try:
-            state = packet['state']
-        except KeyError:
-            pass
-        try:
-            zip_code = packet['zip']
-        except KeyError:
-            pass
-        try:
-            cluster_ip = packet['cluster_ip']
-        except KeyError:
-            pass
-        try:
-            sensor_ip = packet['sensor_ip']
-        except KeyError:
-            pass
-        try:
-            cluster_id = packet['cluster_id']
-        except KeyError:
-            pass
-        try:
-            new_name = packet['new_name']
-        except KeyError:
-            pass
-        try:
-            new_building_id = packet['new_building_id']
-        except KeyError:
-            pass
-        try:
-            new_floor = packet['new_floor']
-        except KeyError:
-            pass
-        try:
-            new_ip = packet['new_ip']
-        except KeyError:
-            pass
-        try:
-            new_sensor_ip = packet['new_sensor_ip']
-        except KeyError:
-            pass
-        try:
-            new_cluster_ip = packet['new_cluster_ip']
-        except KeyError:
-            pass
+# format -> (chunk encoder, mimetype, file extension)
+EXPORT_FORMATS = {
+    'csv': (export.csv_chunks, 'text/csv', 'csv'),
+    'columns': (export.column_chunks, 'application/octet-stream', 'cols'),
+}
+
+
+@app.route('/api/export')
+@login_required
+@read_router.reads
+def export_readings():
+    """
+    Download the readings matching the data view filters as CSV, or with
+    ``format=columns`` in the columnar format of export.py. Rows are
+    streamed from the store cursor and gzip compressed on the fly when the
+    client accepts it.
+    """
+    if request.args.get('format', 'csv') not in EXPORT_FORMATS:
+        abort(400)
+    encode, mimetype, extension = EXPORT_FORMATS[request.args.get('format', 'csv')]
+    criteria = reading_criteria(request.args)
+    chunks = encode(reading_store.iter_rows(criteria), batch_size=app.config['EXPORT_BATCH_SIZE'])
+    compressed = 'gzip' in request.accept_encodings
+    if compressed:
+        chunks = export.gzip_chunks(chunks, app.config['EXPORT_GZIP_LEVEL'])
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=readings.' + extension
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compressed:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def insert_readings(rows):
+    """
+    Insert validated readings with a single executemany per store part, then
+    hand them to the ingest listeners.
+    """
+    if not rows:
+        return
+    reading_store.insert(rows)
+    update_rollups(rows)
+    db.session.commit()
+    ingest.notify(rows)
+
+
+def update_rollups(rows, chunk=500):
+    """
+    Add raw readings to their rollup buckets within the current transaction.
+    Existing buckets are incremented in place, so concurrent writers never
+    lose updates; a bucket created twice by a race just has two rows, which
+    every query sums anyway.
+    """
+    table = ReadingRollup.__table__
+    deltas = rollups.aggregate(rows)
+    by_resolution = {}
+    for key in deltas:
+        by_resolution.setdefault(key[0], []).append(key)
+
+    existing = {}
+    for resolution, keys in by_resolution.items():
+        buckets = [key[1] for key in keys]
+        sensor_ids = sorted(set(key[2] for key in keys))
+        for i in range(0, len(sensor_ids), chunk):
+            query = select([table.c.id] + [table.c[name] for name in rollups.KEY_COLUMNS]).where(and_(
+                table.c.resolution == resolution,
+                table.c.bucket >= min(buckets), table.c.bucket <= max(buckets),
+                table.c.sensor_id.in_(sensor_ids[i:i + chunk])))
+            for row in db.session.execute(query):
+                existing[tuple(row[1:])] = row[0]
+
+    updates, inserts = [], []
+    for key, (count, temp_sum, temp_min, temp_max, on_count) in deltas.items():
+        values = {'_count': count, '_sum': temp_sum, '_min': temp_min, '_max': temp_max, '_on': on_count}
+        if key in existing:
+            values['_id'] = existing[key]
+            updates.append(values)
+        else:
+            inserts.append(dict(zip(rollups.KEY_COLUMNS, key), count=count, temp_sum=temp_sum,
+                                temp_min=temp_min, temp_max=temp_max, on_count=on_count))
+    if updates:
+        db.session.execute(table.update().where(table.c.id == bindparam('_id')).values(
+            count=table.c.count + bindparam('_count'),
+            temp_sum=table.c.temp_sum + bindparam('_sum'),
+            temp_min=case([(table.c.temp_min > bindparam('_min'), bindparam('_min'))], else_=table.c.temp_min),
+            temp_max=case([(table.c.temp_max < bindparam('_max'), bindparam('_max'))], else_=table.c.temp_max),
+            on_count=table.c.on_count + bindparam('_on')), updates)
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+
+
+def rebuild_rollups(start=None, end=None, chunk=50000, building_id=None):
+    """
+    Recompute the rollups of [start, end) (dates, widened to whole months)
+    from the raw readings, committing every ``chunk`` readings. Without
+    bounds the whole table is rebuilt; with ``building_id`` only that
+    building's rollups are. Rollups of readings removed by the retention job
+    are kept as they are.
+    """
+    readings = SensorData.__table__
+    table = ReadingRollup.__table__
+    if start is None or end is None:
+        bounds = [row for row in reading_store.execute_all(
+            select([func.min(readings.c.date), func.max(readings.c.date)])) if row[0] is not None]
+        if not bounds:
+            return 0
+        first, last = min(row[0] for row in bounds), max(row[1] for row in bounds)
+        start = start or first
+        end = end or last + datetime.timedelta(days=1)
+    start = rollups.floor_to('month', datetime.datetime.combine(start, datetime.time()))
+    end = rollups.ceil_to('month', datetime.datetime.combine(end, datetime.time()))
+
+    criteria = {'date_after': start.date() - datetime.timedelta(days=1), 'date_before': end.date()}
+    conditions = [table.c.bucket >= start, table.c.bucket < end]
+    if building_id is not None:
+        criteria['building_id'] = building_id
+        conditions.append(table.c.building_id == building_id)
+    purged = dict(db.session.query(RetentionMark.building_id, RetentionMark.purged_before))
+    for purged_building, purged_before in purged.items():
+        conditions.append(or_(table.c.building_id != purged_building, table.c.building_id.is_(None),
+                              table.c.bucket >= datetime.datetime.combine(purged_before, datetime.time())))
+
+    db.session.execute(table.delete().where(and_(*conditions)))
+    total = 0
+    cursor = None
+    while True:
+        page = reading_store.page(criteria, cursor, chunk)
+        # late readings of purged months are already in the kept rollups
+        rows = [dict(row) for row in page
+                if row['building_id'] not in purged or row['date'] >= purged[row['building_id']]]
+        update_rollups(rows)
+        db.session.commit()
+        total += len(rows)
+        if len(page) < chunk:
+            return total
+        cursor = storage.sort_key(page[-1])
+
+
+ROLLUP_GROUPS = {
+    'building': ('building_id',),
+    'floor': ('building_id', 'floor'),
+    'room': ('building_id', 'floor', 'room'),
+    'sensor': ('sensor_id',),
+}
+
+
+def query_rollups(start, end, group_by='building', interval='day', filters=None):
+    """
+    Temperature aggregates of [start, end) per group, as points at
+    ``interval``, read from the coarsest rollups that fit the range.
+    """
+    table = ReadingRollup.__table__
+    group_columns = [table.c[name] for name in ROLLUP_GROUPS[group_by]]
+    conditions = [table.c[name] == value for name, value in (filters or {}).items()]
+    measures = [func.sum(table.c.count), func.sum(table.c.temp_sum), func.min(table.c.temp_min),
+                func.max(table.c.temp_max), func.sum(table.c.on_count)]
+    groups = []
+    for resolution, segment_start, segment_end in rollups.plan(start, end, rollups.coarsest_for(interval)):
+        where = and_(table.c.resolution == resolution, table.c.bucket >= segment_start,
+                     table.c.bucket < segment_end, *conditions)
+        if interval == 'total':
+            query = select(group_columns + measures).where(where).group_by(*group_columns)
+            groups.extend((tuple(row[:len(group_columns)]), None) + tuple(row[len(group_columns):])
+                          for row in db.session.execute(query))
+        else:
+            query = select(group_columns + [table.c.bucket] + measures).where(where) \
+                .group_by(*(group_columns + [table.c.bucket]))
+            groups.extend((tuple(row[:len(group_columns)]),) + tuple(row[len(group_columns):])
+                          for row in db.session.execute(query))
+    return rollups.combine(groups, interval)
+
+
+def _parse_range_bound(value):
+    for fmt in ('%Y-%m-%dT%H:%M', '%Y-%m-%dT%H', '%Y-%m-%d'):
         try:
-            status = packet['status']
-        except KeyError:
-            pass
-        # TODO finish adding sensors, then get_sensor
-        if operation == "add_sensor":
-            cluster = ClusterNode.query.filter_by(ip=cluster_ip,building_id=building_id).first()
-            print("add_sensor:",cluster)
-            new_sensor = SensorNode(ip=sensor_ip,cluster_id=cluster.id,status=status)
-            print("new_sensor:",new_sensor.id)
-            db.session.add(new_sensor)
-            # more here
-            db.session.commit()
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
             pass
-        elif operation == "add_cluster":
-            db.session.add(ClusterNode(building_id=building_id,floor=floor,ip=ip))
-            db.session.commit()
-        elif operation == "add_building":
-            building_address = ' '.join((address, city, state, zip_code))
-            geolocator = Nominatim(user_agent="my-application")
-            location = geolocator.geocode(building_address)
-            if not location:  # fake address
-                lat, lng = 0, 0
-            else:
-                lat, lng = location.latitude, location.longitude
-                print(location.latitude, location.longitude)
-            b = Building(name=packet['building_name'], address=address,city=city,
-                         state=state, zip_code=zip_code, lat=lat, lng=lng)
-            db.session.add(b)
-            db.session.commit()
-        elif operation == "edit_building":
-            building = Building.query.get(building_id)
-            if new_name:
-                building.name = new_name
-            if address:
-                building.address = address
-            if city:
-                building.city = city
-            if state:
-                building.state = state
-            if zip_code:
-                building.zip_code = zip_code
-            db.session.commit()
-        elif operation == "remove_building":
-            Building.query.filter_by(id=building_id).delete()
-            db.session.commit()
-            return json.dumps({"time": str(datetime.datetime.now())})
-        elif operation == "remove_cluster":
-            ClusterNode.query.filter_by(building_id=building_id,floor=floor, ip=ip).delete()
+    abort(400)
+
+
+@app.route('/api/rollups')
+@login_required
+def rollups_api():
+    """
+    Temperature trends from the rollup tables: ``start`` and ``end``
+    (YYYY-MM-DD, optionally with THH:MM) bound the range, ``group_by`` is one
+    of building/floor/room/sensor and ``interval`` one of
+    hour/day/month/year/total. building/floor/room/sensor narrow it down.
+    """
+    args = request.args
+    group_by = args.get('group_by', 'building')
+    interval = args.get('interval', 'day')
+    if group_by not in ROLLUP_GROUPS or interval not in rollups.INTERVALS \
+            or not args.get('start') or not args.get('end'):
+        abort(400)
+    filters = {}
+    try:
+        for name, column, convert in (('building', 'building_id', int), ('floor', 'floor', int),
+                                      ('room', 'room', str), ('sensor', 'sensor_id', int)):
+            if args.get(name):
+                filters[column] = convert(args[name])
+    except ValueError:
+        abort(400)
+    result = query_rollups(_parse_range_bound(args['start']), _parse_range_bound(args['end']),
+                           group_by, interval, filters)
+    series = [dict(zip(ROLLUP_GROUPS[group_by], group), points=points) for group, points in result.items()]
+    return jsonify(group_by=group_by, interval=interval, series=series)
+
+
+@app.cli.command('rebuild-rollups')
+@click.option('--start', help='first date to rebuild, YYYY-MM-DD')
+@click.option('--end', help='date to stop before, YYYY-MM-DD')
+def rebuild_rollups_command(start, end):
+    """Recompute the temperature rollups from the raw readings."""
+    def parse(value):
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    count = rebuild_rollups(parse(start), parse(end))
+    print('rolled up %d readings' % count)
+
+
+def split_readings(target, chunk=50000, delete=False):
+    """
+    Copy the SensorData table into the sharded store ``target`` in id order,
+    ``chunk`` readings at a time, keeping their ids. Progress is
+    checkpointed in the target, so an interrupted copy resumes where it
+    stopped; repeated rows are overwritten, not duplicated. With ``delete``
+    the copied readings are then removed from the table.
+    """
+    readings = SensorData.__table__
+    last_id = target.ids.checkpoint('split') or 0
+    copied = 0
+    while True:
+        rows = [dict(row) for row in db.session.execute(
+            select([readings]).where(readings.c.id > last_id).order_by(readings.c.id).limit(chunk))]
+        if not rows:
+            break
+        target.insert(rows, replace=True)
+        last_id = rows[-1]['id']
+        target.ids.checkpoint('split', last_id)
+        copied += len(rows)
+        log.info('split %d readings, up to id %d', copied, last_id)
+    # new readings must not reuse the ids of copied ones
+    target.ids.allocate(0, at_least=last_id + 1)
+    if delete:
+        db.session.execute(readings.delete().where(readings.c.id <= last_id))
+        db.session.commit()
+    return copied
+
+
+@app.cli.command('split-readings')
+@click.option('--shard-dir', help='directory of the shards, READING_SHARD_DIR by default')
+@click.option('--chunk', default=50000, help='readings copied per batch')
+@click.option('--delete', is_flag=True, help='remove the copied readings from the SensorData table')
+def split_readings_command(shard_dir, chunk, delete):
+    """Copy the SensorData table into building/month SQLite shards."""
+    target = storage.ShardedStore(shard_dir or app.config['READING_SHARD_DIR'], SensorData.__table__)
+    count = split_readings(target, chunk, delete)
+    print('copied %d readings into %d shards' % (count, len(target.shards())))
+
+
+def retention_cutoffs(today=None):
+    """
+    ``{building_id: date}`` of the buildings with a retention period, raw
+    readings dated before the date having expired.
+    """
+    today = today or datetime.date.today()
+    per_building = app.config['RETENTION_BUILDING_DAYS']
+    cutoffs = {}
+    for (building_id,) in db.session.query(Building.id):
+        days = per_building.get(building_id, app.config['RETENTION_DAYS'])
+        if days is not None:
+            cutoffs[building_id] = retention.cutoff(today, days)
+    return cutoffs
+
+
+def apply_retention(today=None):
+    """
+    Fold expired readings into the rollups, then delete them in chunks and
+    vacuum the freed space. Returns ``{'buildings': {id: rows}, 'rows',
+    'bytes'}``; bytes is None when the store cannot tell its size.
+    """
+    chunk = app.config['RETENTION_CHUNK']
+    readings = SensorData.__table__
+    cutoffs = retention_cutoffs(today)
+    if cutoffs:
+        # readings are only billed once metered, so meter before deleting
+        meter_usage()
+    for building_id, before in sorted(cutoffs.items()):
+        mark = RetentionMark.query.get(building_id)
+        if mark is None:
+            oldest = [row[0] for row in reading_store.execute_all(
+                select([func.min(readings.c.date)]).where(readings.c.building_id == building_id),
+                {'building_id': building_id}) if row[0] is not None]
+            if not oldest or min(oldest) >= before:
+                continue
+            mark = RetentionMark(building_id=building_id, purged_before=min(oldest).replace(day=1))
+            db.session.add(mark)
+        if mark.purged_before < before:
+            # rollups first: once the mark moves, rebuilds keep these buckets
+            rebuild_rollups(mark.purged_before, before, building_id=building_id)
+            mark.purged_before = before
             db.session.commit()
-            return json.dumps({"time": str(datetime.datetime.now())})
-        elif operation == "remove_sensor":
-            cluster = ClusterNode.query.filter_by(building_id=building_id, floor=floor, ip=cluster_ip).first()
-            SensorNode.query.filter_by(cluster_id=cluster.id, ip=sensor_ip).delete()
+
+    # measured after the rollups grew, so only what the deletes free counts
+    size = reading_store.size()
+    report = {'buildings': {}, 'rows': 0}
+    for building_id, before in sorted(cutoffs.items()):
+        deleted = reading_store.delete_before(building_id, before, chunk)
+        if deleted:
+            report['buildings'][building_id] = deleted
+            report['rows'] += deleted
+            log.info('retention deleted %d readings of building %d before %s', deleted, building_id, before)
+    if report['rows']:
+        if not reading_store.compact(app.config['RETENTION_VACUUM_PAGES']):
+            log.warning('the reading database does not use incremental vacuum; '
+                        'run apply-retention --full-vacuum once to enable it')
+        dashboard_stats.rebuild()
+        facet_index.rebuild()
+    report['bytes'] = size - reading_store.size() if size is not None else None
+    return report
+
+
+def _run_retention():
+    with app.app_context():
+        apply_retention()
+
+
+# periodic jobs, started with each process's first request rather than at
+# import, so they also start when the app is imported before the server
+# forks; the ones given the lock only run in the process holding it
+background_lock = periodic.ProcessLock(os.path.join(app.root_path, app.config['BACKGROUND_LOCK_FILE']))
+background_workers = []
+
+
+@app.before_request
+def _start_background_workers():
+    for worker in background_workers:
+        worker.start()
+
+
+def _rebuild_summaries():
+    with app.app_context():
+        dashboard_stats.rebuild()
+        facet_index.rebuild()
+
+
+# every process keeps its own summaries
+summaries_worker = None
+if app.config['DASHBOARD_STATS_MAX_AGE']:
+    summaries_worker = periodic.PeriodicWorker(_rebuild_summaries, app.config['DASHBOARD_STATS_MAX_AGE'],
+                                               'summaries')
+    background_workers.append(summaries_worker)
+    atexit.register(summaries_worker.stop)
+
+
+retention_worker = None
+if app.config['RETENTION_INTERVAL']:
+    retention_worker = periodic.PeriodicWorker(_run_retention, app.config['RETENTION_INTERVAL'], 'retention',
+                                               background_lock)
+    background_workers.append(retention_worker)
+    atexit.register(retention_worker.stop)
+
+
+@app.cli.command('apply-retention')
+@click.option('--full-vacuum', is_flag=True,
+              help='switch the database to incremental vacuum with a full VACUUM first (locks it meanwhile)')
+def apply_retention_command(full_vacuum):
+    """Roll up and delete readings past their retention period."""
+    if full_vacuum and not reading_store.vacuum():
+        print('the reading database cannot be vacuumed incrementally')
+    report = apply_retention()
+    for building_id, count in sorted(report['buildings'].items()):
+        print('building %d: %d readings' % (building_id, count))
+    reclaimed = 'unknown' if report['bytes'] is None else '%d bytes' % report['bytes']
+    print('deleted %d readings, reclaimed %s' % (report['rows'], reclaimed))
+
+
+METERING_COLUMNS = ('id', 'sensor_id', 'building_id', 'date', 'time', 'status')
+_metering_lock = threading.Lock()
+
+
+def _meter(rows, chunk=500):
+    """
+    Add the sensor-hours of ``rows`` not billed yet to SensorUsage and
+    BillingDay within the current transaction.
+    """
+    masks = metering.hour_masks(rows)
+    if not masks:
+        return
+    usage = SensorUsage.__table__
+    days = [key[2] for key in masks]
+    sensor_ids = sorted(set(key[0] for key in masks))
+    existing = {}
+    for i in range(0, len(sensor_ids), chunk):
+        query = select([usage.c.id, usage.c.sensor_id, usage.c.building_id, usage.c.day, usage.c.hours]).where(
+            and_(usage.c.day >= min(days), usage.c.day <= max(days), usage.c.sensor_id.in_(sensor_ids[i:i + chunk])))
+        for row in db.session.execute(query):
+            existing[(row['sensor_id'], row['building_id'], row['day'])] = (row['id'], row['hours'])
+    changed, added = metering.merge(masks, dict((key, value[1]) for key, value in existing.items()))
+    updates = [{'_id': existing[key][0], '_hours': mask} for key, mask in changed.items() if key in existing]
+    inserts = [{'sensor_id': key[0], 'building_id': key[1], 'day': key[2], 'hours': mask}
+               for key, mask in changed.items() if key not in existing]
+    if updates:
+        db.session.execute(usage.update().where(usage.c.id == bindparam('_id')).values(hours=bindparam('_hours')),
+                           updates)
+    if inserts:
+        db.session.execute(usage.insert(), inserts)
+    if not added:
+        return
+
+    billing = BillingDay.__table__
+    days = [key[1] for key in added]
+    totals = {}
+    query = select([billing.c.id, billing.c.building_id, billing.c.day]).where(and_(
+        billing.c.day >= min(days), billing.c.day <= max(days)))
+    for row in db.session.execute(query):
+        totals[(row['building_id'], row['day'])] = row['id']
+    updates = [{'_id': totals[key], '_hours': count} for key, count in added.items() if key in totals]
+    inserts = [{'building_id': key[0], 'day': key[1], 'sensor_hours': count}
+               for key, count in added.items() if key not in totals]
+    if updates:
+        db.session.execute(billing.update().where(billing.c.id == bindparam('_id')).values(
+            sensor_hours=billing.c.sensor_hours + bindparam('_hours')), updates)
+    if inserts:
+        db.session.execute(billing.insert(), inserts)
+
+
+def meter_usage(chunk=None):
+    """
+    Meter the readings added since the last run, ``chunk`` readings at a
+    time, committing after each chunk; the watermark moves as far as the
+    store says every reading has been read. Each chunk's transaction starts
+    by writing the watermark row, so runs in other processes wait for it to
+    commit and then see the hours it billed. Returns the number of readings
+    read.
+    """
+    chunk = chunk or app.config['METERING_CHUNK']
+    table = MeterWatermark.__table__
+    with _metering_lock:
+        watermark = MeterWatermark.query.get(1)
+        if watermark is None:
+            try:
+                db.session.add(MeterWatermark(id=1, reading_id=0))
+                db.session.commit()
+            except IntegrityError:
+                # created by another process meanwhile
+                db.session.rollback()
+            watermark = MeterWatermark.query.get(1)
+        # ids may be committed out of order by concurrent writers; reading
+        # the overlap again bills nothing twice
+        start = max(watermark.reading_id - app.config['METERING_OVERLAP'], 0)
+        total = 0
+        for rows, through in reading_store.id_chunks(start, reading_store.max_id(), METERING_COLUMNS, chunk):
+            db.session.execute(table.update().where(table.c.id == 1).values(reading_id=table.c.reading_id))
+            _meter(rows)
+            if through is not None:
+                watermark.reading_id = max(watermark.reading_id, through)
             db.session.commit()
-        elif operation == "edit_cluster":
-            cluster = ClusterNode.query.filter_by(building_id=building_id,floor=floor, ip=ip).first()
-            print("cluster_id is",cluster.id)
-            if new_building_id:
-                cluster.building_id = building_id
-            if new_floor:
-                cluster.floor = new_floor
-            if new_ip:
-                cluster.ip = new_ip
+            total += len(rows)
+        watermark.metered_at = datetime.datetime.now()
+        db.session.commit()
+    return total
+
+
+def metering_status():
+    """
+    ``(reading_id, metered_at, newest_id)``: the watermark, when it was last
+    metered (None if never) and the newest reading id, for showing how far
+    behind the invoices are.
+    """
+    watermark = MeterWatermark.query.get(1)
+    if watermark is None:
+        return 0, None, reading_store.max_id()
+    return watermark.reading_id, watermark.metered_at, reading_store.max_id()
+
+
+def _run_metering():
+    with app.app_context():
+        meter_usage()
+
+
+metering_worker = None
+if app.config['METERING_INTERVAL']:
+    metering_worker = periodic.PeriodicWorker(_run_metering, app.config['METERING_INTERVAL'], 'metering',
+                                              background_lock)
+    background_workers.append(metering_worker)
+    atexit.register(metering_worker.stop)
+
+
+def invoices(start, end, building_id=None):
+    """
+    Invoices of the sensor-hours metered on the days of [start, end), per
+    owner; see metering.invoice_lines().
+    """
+    table = BillingDay.__table__
+    conditions = [table.c.day >= start, table.c.day < end]
+    if building_id is not None:
+        conditions.append(table.c.building_id == building_id)
+    usage = db.session.execute(select([table.c.building_id, func.sum(table.c.sensor_hours)]).where(
+        and_(*conditions)).group_by(table.c.building_id)).fetchall()
+    buildings = dict((row[0], (row[1], row[2])) for row in db.session.query(Building.id, Building.name, Building.owner))
+    return metering.invoice_lines(usage, buildings, app.config['BILLING_HOURLY_RATE'])
+
+
+def billing_period(args):
+    """
+    ``(start, end)`` dates of the ``start``/``end`` arguments, end
+    exclusive; the current month by default.
+    """
+    today = datetime.date.today()
+    try:
+        start = (datetime.datetime.strptime(args['start'], '%Y-%m-%d').date() if args.get('start')
+                 else today.replace(day=1))
+        end = (datetime.datetime.strptime(args['end'], '%Y-%m-%d').date() if args.get('end')
+               else rollups.ceil_to('month', datetime.datetime.combine(start, datetime.time()) +
+                                    datetime.timedelta(days=1)).date())
+    except ValueError:
+        abort(400)
+    if end <= start:
+        abort(400)
+    return start, end
+
+
+@app.route('/api/invoices')
+@login_required
+def invoices_api():
+    """
+    Invoices of the billing period ``start``..``end`` (``YYYY-MM-DD``, end
+    exclusive, the current month by default), optionally for one
+    ``building``, as metered so far: ``metered_through`` is the last
+    reading id counted and ``newest_reading_id`` the newest one stored.
+    """
+    if access_level() < AccessLevel.SUPERUSER:
+        abort(403)
+    start, end = billing_period(request.args)
+    try:
+        building_id = int(request.args['building']) if request.args.get('building') else None
+    except ValueError:
+        abort(400)
+    metered_id, metered_at, newest_id = metering_status()
+    result = []
+    for owner, lines, sensor_hours, amount in invoices(start, end, building_id):
+        result.append({'owner': owner, 'sensor_hours': sensor_hours, 'amount': amount, 'buildings': [
+            {'building_id': line[0], 'name': line[1], 'sensor_hours': line[2], 'amount': line[3]}
+            for line in lines]})
+    return jsonify(start=start.isoformat(), end=end.isoformat(), rate=app.config['BILLING_HOURLY_RATE'],
+                   invoices=result, metered_through=metered_id, newest_reading_id=newest_id,
+                   metered_at=metered_at and metered_at.isoformat())
+
+
+@app.cli.command('meter-usage')
+@click.option('--since', type=int, help='move the watermark back to this reading id; hours are never billed twice')
+def meter_usage_command(since):
+    """Meter the sensor-hours of new readings for billing."""
+    if since is not None:
+        watermark = MeterWatermark.query.get(1) or MeterWatermark(id=1)
+        watermark.reading_id = since
+        db.session.add(watermark)
+        db.session.commit()
+    print('metered %d readings' % meter_usage())
+
+
+def load_analytics_frame(filters):
+    """
+    Readings matching the data view filters as a columnar ReadingFrame,
+    fetched as Core rows without building ORM objects.
+    """
+    max_rows = app.config['ANALYTICS_MAX_ROWS']
+    chunk = app.config['ANALYTICS_CHUNK_SIZE']
+    rows = itertools.islice(reading_store.iter_rows(reading_criteria(filters), analytics.ROW_COLUMNS), max_rows + 1)
+    frame = analytics.frame_from_rows(rows, chunk)
+    if len(frame) > max_rows:
+        abort(413)
+    return frame
+
+
+def _float_arg(args, name, default=None):
+    if not args.get(name):
+        return default
+    try:
+        value = float(args[name])
+    except ValueError:
+        abort(400)
+    if not math.isfinite(value):
+        abort(400)
+    return value
+
+
+@app.route('/api/analytics')
+@login_required
+def analytics_api():
+    """
+    Vectorized statistics of the readings matching the data view filters:
+    per-group count/mean/std/min/max/ON ratio and percentiles (``group_by``
+    one of building/floor/room/sensor), each sensor's latest ``window``
+    reading moving average, and up to ``limit`` anomalies whose z-score
+    exceeds ``z`` or whose temperature is outside ``low``/``high``.
+    """
+    if access_level() < AccessLevel.MANAGER:
+        abort(403)
+    args = request.args
+    group_by = args.get('group_by', 'building')
+    if group_by not in ROLLUP_GROUPS:
+        abort(400)
+    by = ROLLUP_GROUPS[group_by]
+    window = int(_float_arg(args, 'window', 12))
+    limit = int(_float_arg(args, 'limit', 100))
+    if window < 1 or limit < 0:
+        abort(400)
+    frame = load_analytics_frame(args)
+
+    groups = analytics.group_stats(frame, by)
+    # groups without temperatures have no percentiles
+    quantiles = dict((tuple(entry[name] for name in by), entry) for entry in analytics.percentiles(frame, by=by))
+    for group in groups:
+        entry = quantiles.get(tuple(group[name] for name in by), {})
+        group.update((key, value) for key, value in entry.items() if key.startswith('p'))
+
+    measured = analytics.with_temperature(frame)
+    latest = analytics.latest_by_sensor(measured)
+    smoothed = analytics.moving_average(measured, window)[latest]
+    moving = [{'sensor_id': int(sensor_id), 'timestamp': str(timestamp), 'moving_average': float(value)}
+              for sensor_id, timestamp, value
+              in zip(measured['sensor_id'][latest], measured['timestamp'][latest], smoothed)]
+
+    flags = analytics.anomalies(frame, z=_float_arg(args, 'z', 3.0),
+                                low=_float_arg(args, 'low'), high=_float_arg(args, 'high'))
+    flagged = np.flatnonzero(flags['zscore'] | flags['out_of_range'])
+    flagged = flagged[np.argsort(-np.abs(flags['z'][flagged]), kind='stable')][:limit]
+    found = []
+    for i in flagged:
+        found.append({
+            'sensor_id': int(frame['sensor_id'][i]),
+            'building_id': frame.labels('building_id', [frame['building_id'][i]])[0],
+            'floor': frame.labels('floor', [frame['floor'][i]])[0],
+            'room': frame.room_labels[frame['room'][i]],
+            'timestamp': str(frame['timestamp'][i]),
+            'temperature': float(frame['temperature'][i]),
+            'z': round(float(flags['z'][i]), 3),
+            'zscore': bool(flags['zscore'][i]),
+            'out_of_range': bool(flags['out_of_range'][i]),
+        })
+
+    return jsonify(count=len(frame), group_by=group_by, percentiles=analytics.percentiles(frame),
+                   groups=groups, moving_averages=moving,
+                   anomaly_count=int((flags['zscore'] | flags['out_of_range']).sum()), anomalies=found)
+
+
+def _lookup(model, ids, chunk=500):
+    # keep IN lists under the bound parameter limit of older SQLite builds
+    ids = sorted(ids)
+    found = {}
+    for i in range(0, len(ids), chunk):
+        for row in model.query.filter(model.id.in_(ids[i:i + chunk])):
+            found[row.id] = row
+    return found
+
+
+def _write_queued_readings(rows):
+    with app.app_context():
+        insert_readings(rows)
+
+
+ingest_writer = None
+if app.config['INGEST_ASYNC']:
+    ingest_writer = WriteBehindQueue(
+        _write_queued_readings,
+        maxsize=app.config['INGEST_QUEUE_SIZE'],
+        batch_size=app.config['INGEST_QUEUE_BATCH_SIZE'],
+        flush_interval=app.config['INGEST_QUEUE_FLUSH_INTERVAL'],
+        block=app.config['INGEST_QUEUE_BACKPRESSURE'] == 'block',
+        put_timeout=app.config['INGEST_QUEUE_PUT_TIMEOUT'],
+        retry_delay=app.config['INGEST_QUEUE_RETRY_DELAY'],
+        max_retry_delay=app.config['INGEST_QUEUE_MAX_RETRY_DELAY'],
+    )
+    atexit.register(ingest_writer.stop)
+
+
+@app.route('/api/ingest', methods=['POST'])
+def ingest_request():
+    """
+    Bulk insert of readings pushed by a cluster node; see ingest.py for the
+    payload format. The batch is all or nothing: any invalid reading rejects
+    it with a 400 listing the errors. Clients authenticate with a device
+    token, or are signed in as a manager, unless INGEST_ALLOW_ANONYMOUS is
+    set; a token bound to a cluster only accepts readings for that cluster.
+    """
+    device_token = request_device_token()
+    signed_in = device_token is None and access_level() >= AccessLevel.MANAGER
+    if device_token is False or not (device_token or signed_in or app.config['INGEST_ALLOW_ANONYMOUS']):
+        response = jsonify(error='invalid or missing device token')
+        response.headers['WWW-Authenticate'] = 'Bearer'
+        return response, 401
+    try:
+        if request.is_json:
+            readings = ingest.unwrap(request.get_json(silent=True))
+        elif request.mimetype in ingest.NDJSON_MIMETYPES:
+            readings = ingest.parse_ndjson(request.get_data(as_text=True))
+        else:
+            return jsonify(error='send application/json or application/x-ndjson'), 415
+    except ingest.IngestError as e:
+        return jsonify(error=str(e)), 400
+    if len(readings) > app.config['INGEST_MAX_BATCH']:
+        return jsonify(error='batch larger than %d readings' % app.config['INGEST_MAX_BATCH']), 413
+
+    token_cluster_id = device_token.cluster_id if device_token else None
+    default_cluster_id = request.args.get('cluster_id', token_cluster_id)
+    sensor_ids, cluster_ids = ingest.referenced_ids(readings, default_cluster_id)
+    remote_addr = request.remote_addr if app.config['INGEST_CHECK_CLUSTER_IP'] else None
+    rows, errors = ingest.validate(readings, _lookup(ClusterNode, cluster_ids),
+                                   _lookup(SensorNode, sensor_ids), default_cluster_id, remote_addr,
+                                   token_cluster_id)
+    if errors:
+        return jsonify(errors=errors[:100], error_count=len(errors)), 400
+
+    if ingest_writer is None:
+        insert_readings(rows)
+        return jsonify(inserted=len(rows)), 201
+    try:
+        ingest_writer.put(rows)
+    except QueueFull as e:
+        response = jsonify(error=str(e))
+        response.headers['Retry-After'] = '1'
+        return response, 429
+    return jsonify(queued=len(rows)), 202
+
+
+@app.route('/api/ingest/metrics')
+@login_required
+def ingest_metrics():
+    if ingest_writer is None:
+        return jsonify(enabled=False)
+    return jsonify(enabled=True, **ingest_writer.metrics())
+
+
+def _event_topics(args):
+    topics = args.getlist('topic')
+    for topic in topics:
+        name, _, building_id = topic.partition(':')
+        if not (topic in ('dashboard', 'topology') or name == 'building' and building_id.isdigit()):
+            abort(400)
+    return topics or None
+
+
+@app.route('/api/events')
+@login_required
+def events_api():
+    """
+    Server-Sent Events stream of the ``topic`` parameters (dashboard,
+    topology, building:<id>; all of them when none is given). A dashboard
+    subscription starts with the current counts.
+    """
+    topics = _event_topics(request.args)
+    try:
+        subscription = event_broker.subscribe(topics)
+    except events.TooManySubscribers:
+        abort(503)
+    if subscription.wants('dashboard'):
+        subscription.offer('dashboard', None, None)
+
+    def generate():
+        # a stream can stay open for hours; don't hold a pooled connection
+        db.session.close()
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                batch = subscription.get(app.config['EVENTS_HEARTBEAT_SECONDS'], app.config['EVENTS_COALESCE_SECONDS'])
+                if batch is None:
+                    return
+                if not batch:
+                    yield ': keepalive\n\n'
+                    continue
+                chunks = []
+                for type, data in batch:
+                    if type == 'dashboard':
+                        data = dashboard_stats.snapshot()
+                    chunks.append('event: %s\ndata: %s\n\n' % (type, json.dumps(data)))
+                db.session.close()
+                yield ''.join(chunks)
+        finally:
+            event_broker.unsubscribe(subscription)
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Prometheus text-format metrics of this process, for the scraper
+    addresses in METRICS_ALLOWED_ADDRESSES.
+    """
+    if instrumentation is None:
+        abort(404)
+    if request.remote_addr not in app.config['METRICS_ALLOWED_ADDRESSES']:
+        abort(403)
+    extra = []
+    if ingest_writer is not None:
+        extra = [('ingest_queue_' + name, name.replace('_', ' ') + ' of the ingest write-behind queue.', value)
+                 for name, value in sorted(ingest_writer.metrics().items())]
+    return Response(instrumentation.render_metrics(extra), mimetype='text/plain; version=0.0.4')
+
+
+# handles all requests going around map view
+def _geocoding_provider():
+    if app.config['GEOCODER'] == 'offline':
+        return geocoding.OfflineProvider()
+    return geocoding.NominatimProvider(app.config['GEOCODER_USER_AGENT'], app.config['GEOCODER_TIMEOUT'])
+
+
+geocoder = geocoding.Geocoder(
+    _geocoding_provider(),
+    geocoding.GeocodeCache(os.path.join(app.root_path, app.config['GEOCODE_CACHE_FILE']),
+                           app.config['GEOCODE_CACHE_SIZE'], app.config['GEOCODE_NOT_FOUND_TTL']),
+    workers=app.config['GEOCODER_WORKERS'],
+)
+atexit.register(geocoder.shutdown)
+
+
+def locate_building(building_id, address):
+    """
+    Geocode the address in the background and store the location on the
+    building once it is known. Returns the lookup future.
+    """
+    def store(location):
+        if location is None:
+            log.warning('no location found for building %d at %r', building_id, address)
+            return
+        with app.app_context():
+            Building.query.filter_by(id=building_id).update({'lat': location[0], 'lng': location[1]})
             db.session.commit()
-        elif operation == "edit_sensor":
-            cluster = ClusterNode.query.filter_by(building_id=building_id, floor=floor, ip=ip).first()
-            sensor = SensorNode.query.filter_by(cluster_id=cluster.id).first()
-            if new_building_id and new_floor:
-                if new_cluster_ip:
-                    new_cluster = ClusterNode.query.filter_by(building_id=new_building_id, floor=new_floor, cluster_ip=new_cluster_ip).first()
-                else:
-                    new_cluster = ClusterNode.query.filter_by(building_id=new_building_id, floor=new_floor).first()
-                sensor.cluster_id = new_cluster.id
-                db.session.commit()
+    return geocoder.submit(address, store)
 
-        elif operation == "get_cluster":
-            clusters = ClusterNode.query.filter_by(building_id=building_id).order_by(ClusterNode.floor).all()
-            print("clusters", clusters)
-            result = [r.to_dict() for r in clusters]
-            print("result is",result)
-            return json.dumps(result)
-        elif operation == "get_sensor":
-            sensors = SensorNode.query.filter_by(cluster_id=cluster_id).all()
-            result = [r.to_dict() for r in sensors]
-            return json.dumps(result)
+
+TOPOLOGY_BUILDING_FIELDS = ('id', 'name', 'lat', 'lng', 'floors', 'address', 'city', 'state', 'zip_code')
+_topology_cache = {}
+
+
+def load_topology(building_ids=None):
+    """
+    Building -> cluster -> sensor tree of the given buildings (all when
+    None), loaded with one query per level.
+    """
+    query = Building.query.options(selectinload(Building.clusters).selectinload(ClusterNode.sensors))
+    if building_ids:
+        query = query.filter(Building.id.in_(building_ids))
+    return [dict([(name, getattr(building, name)) for name in TOPOLOGY_BUILDING_FIELDS],
+                 clusters=[dict(cluster.to_dict(), sensors=[sensor.to_dict() for sensor in cluster.sensors])
+                           for cluster in building.clusters])
+            for building in query.order_by(Building.id)]
+
+
+@app.route('/api/topology')
+@login_required
+@read_router.reads
+def topology_api():
+    """
+    Buildings with their clusters and sensors, for the ``building`` ids
+    given (repeatable) or all of them. The ETag follows the topology
+    revision, so clients can revalidate with If-None-Match; rendered
+    payloads are cached per revision.
+    """
+    if access_level() < AccessLevel.MANAGER:
+        abort(403)
+    try:
+        building_ids = tuple(sorted(set(int(b) for b in request.args.getlist('building'))))
+    except ValueError:
+        abort(400)
+    revision = topology_revision()
+    etag = 'topology-%d-%s' % (revision, hashlib.sha1(repr(building_ids).encode()).hexdigest()[:16])
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        key = (revision, building_ids)
+        body = _topology_cache.get(key)
+        if body is None:
+            body = json.dumps(load_topology(building_ids))
+            if any(cached_revision != revision for cached_revision, _ in list(_topology_cache)) \
+                    or len(_topology_cache) >= app.config['TOPOLOGY_CACHE_SIZE']:
+                _topology_cache.clear()
+            _topology_cache[key] = body
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+SITE_KINDS = ('building', 'cluster', 'sensor')
+site_index = spatial.GridIndex(app.config['SPATIAL_CELL_DEGREES'])
+_site_index_lock = threading.Lock()
+
+
+def _located(model):
+    return and_(model.lat.isnot(None), model.lng.isnot(None))
+
+
+def _load_sites():
+    for row in db.session.query(Building.id, Building.lat, Building.lng, Building.name, Building.address,
+                                Building.city, Building.state, Building.zip_code).filter(_located(Building)):
+        yield spatial.Site('building', row[0], row[1], row[2], {
+            'name': row[3], 'address': row[4], 'city': row[5], 'state': row[6], 'zip_code': row[7]})
+    for row in db.session.query(ClusterNode.id, ClusterNode.lat, ClusterNode.lng, ClusterNode.building_id,
+                                ClusterNode.floor, ClusterNode.ip).filter(_located(ClusterNode)):
+        yield spatial.Site('cluster', row[0], row[1], row[2], {'building_id': row[3], 'floor': row[4], 'ip': row[5]})
+    for row in db.session.query(SensorNode.id, SensorNode.lat, SensorNode.lng, SensorNode.cluster_id,
+                                ClusterNode.building_id, SensorNode.floor, SensorNode.room, SensorNode.ip,
+                                SensorNode.status).outerjoin(ClusterNode).filter(_located(SensorNode)):
+        yield spatial.Site('sensor', row[0], row[1], row[2], {
+            'cluster_id': row[3], 'building_id': row[4], 'floor': row[5], 'room': row[6], 'ip': row[7],
+            'status': row[8]})
+
+
+def current_site_index():
+    """
+    The spatial index of the map sites, rebuilt first if the topology
+    changed since it was built.
+    """
+    revision = topology_revision()
+    if site_index.revision != revision:
+        with _site_index_lock:
+            if site_index.revision != revision:
+                site_index.rebuild(list(_load_sites()), revision)
+    return site_index
+
+
+def site_to_json(site, **extra):
+    return dict(site.data, kind=site.kind, id=site.id, lat=site.lat, lng=site.lng, **extra)
+
+
+def _site_kinds(args, default):
+    kinds = args.getlist('kind')
+    if any(kind not in SITE_KINDS for kind in kinds):
+        abort(400)
+    return kinds or default
+
+
+@app.route('/api/map')
+@login_required
+@read_router.reads
+def map_api():
+    """
+    Sites inside ``bbox`` (``south,west,north,east`` in degrees; west east
+    of east crosses the antimeridian) for a map at ``zoom``: buildings, or
+    the ``kind`` values given (building, cluster, sensor). Below
+    MAP_CLUSTER_MAX_ZOOM sites close together on screen come back as one
+    cluster with their count, centroid and bounds.
+    """
+    if access_level() < AccessLevel.MANAGER:
+        abort(403)
+    try:
+        south, west, north, east = [float(value) for value in request.args['bbox'].split(',')]
+        zoom = int(request.args['zoom']) if request.args.get('zoom') else None
+    except (KeyError, ValueError):
+        abort(400)
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        abort(400)
+    kinds = _site_kinds(request.args, ['building'])
+    index = current_site_index()
+    if zoom is not None and zoom < app.config['MAP_CLUSTER_MAX_ZOOM']:
+        # degrees per MAP_CLUSTER_PIXELS at this zoom on 256 pixel tiles
+        cell = app.config['MAP_CLUSTER_PIXELS'] * 360.0 / (256 * 2 ** max(zoom, 0))
+        sites, clusters = index.clusters(south, west, north, east, cell, kinds)
+    else:
+        sites, clusters = index.within(south, west, north, east, kinds), []
+    return jsonify(revision=index.revision, sites=[site_to_json(site) for site in sites], clusters=clusters)
+
+
+@app.route('/api/map/nearest')
+@login_required
+@read_router.reads
+def nearest_sites_api():
+    """
+    The ``limit`` sites nearest to ``lat``/``lng``, optionally of the given
+    ``kind`` values and within ``max_km``, with their distance in km.
+    """
+    if access_level() < AccessLevel.MANAGER:
+        abort(403)
+    try:
+        lat, lng = float(request.args['lat']), float(request.args['lng'])
+        limit = int(request.args.get('limit', 1))
+        max_km = float(request.args['max_km']) if request.args.get('max_km') else None
+    except (KeyError, ValueError):
+        abort(400)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        abort(400)
+    limit = max(1, min(limit, app.config['MAP_NEAREST_MAX']))
+    found = current_site_index().nearest(lat, lng, limit, _site_kinds(request.args, None), max_km)
+    return jsonify(sites=[site_to_json(site, distance_km=round(distance, 3)) for distance, site in found])
+
+
+# model column each operation field is validated against
+OPERATION_COLUMNS = {
+    'building_id': Building.id, 'new_building_id': Building.id, 'building_name': Building.name,
+    'new_name': Building.name, 'address': Building.address, 'city': Building.city,
+    'state': Building.state, 'zip': Building.zip_code,
+    'cluster_id': ClusterNode.id, 'floor': ClusterNode.floor, 'new_floor': ClusterNode.floor,
+    'ip': ClusterNode.ip, 'new_ip': ClusterNode.ip, 'cluster_ip': ClusterNode.ip,
+    'new_cluster_ip': ClusterNode.ip, 'sensor_ip': SensorNode.ip, 'new_sensor_ip': SensorNode.ip,
+    'room': SensorNode.room, 'status': SensorNode.status, 'type': SensorNode.type,
+}
+
+
+def _get_building(batch, building_id):
+    key = ('building', building_id)
+    if key not in batch.cache:
+        batch.cache[key] = Building.query.get(building_id)
+    if batch.cache[key] is None:
+        raise OperationError('unknown building %d' % building_id)
+    return batch.cache[key]
+
+
+def _get_cluster(batch, building_id, ip, floor=None):
+    key = ('cluster', building_id, floor, ip)
+    cluster = batch.cache.get(key)
+    if cluster is None:
+        query = ClusterNode.query.filter_by(building_id=building_id, ip=ip)
+        if floor is not None:
+            query = query.filter_by(floor=floor)
+        cluster = batch.cache[key] = query.first()
+    if cluster is None:
+        raise OperationError('no cluster %s on building %d%s' % (
+            ip, building_id, ' floor %d' % floor if floor is not None else ''))
+    return cluster
+
+
+def _get_sensor(cluster, ip):
+    sensor = SensorNode.query.filter_by(cluster_id=cluster.id, ip=ip).first()
+    if sensor is None:
+        raise OperationError('no sensor %s on cluster %d' % (ip, cluster.id))
+    return sensor
+
+
+def _add_building(batch, fields):
+    address = ' '.join((fields['address'], fields['city'], fields['state'], str(fields['zip'])))
+    # answer from the cache, or add the building without a location and let
+    # the geocoder fill it in
+    location = geocoder.cached(address)
+    lat, lng = location or geocoding.NOT_FOUND
+    building = Building(name=fields['building_name'], address=fields['address'], city=fields['city'],
+                        state=fields['state'], zip_code=fields['zip'], lat=lat, lng=lng)
+    db.session.add(building)
+    db.session.flush()
+    if location is None:
+        batch.after_commit.append(lambda: locate_building(building.id, address))
+    return {'id': building.id}
+
+
+def _edit_building(batch, fields):
+    building = _get_building(batch, fields['building_id'])
+    for field, column in (('new_name', 'name'), ('address', 'address'), ('city', 'city'),
+                          ('state', 'state'), ('zip', 'zip_code')):
+        if field in fields:
+            setattr(building, column, fields[field])
+    return {'id': building.id}
+
+
+def _remove_building(batch, fields):
+    _get_building(batch, fields['building_id'])
+    Building.query.filter_by(id=fields['building_id']).delete()
+    batch.cache.clear()
+    return {'id': fields['building_id']}
+
+
+def _add_cluster(batch, fields):
+    _get_building(batch, fields['building_id'])
+    cluster = ClusterNode(building_id=fields['building_id'], floor=fields['floor'], ip=fields['ip'])
+    db.session.add(cluster)
+    db.session.flush()
+    return {'id': cluster.id}
+
+
+def _edit_cluster(batch, fields):
+    cluster = _get_cluster(batch, fields['building_id'], fields['ip'], fields['floor'])
+    if 'new_building_id' in fields:
+        cluster.building_id = _get_building(batch, fields['new_building_id']).id
+    if 'new_floor' in fields:
+        cluster.floor = fields['new_floor']
+    if 'new_ip' in fields:
+        cluster.ip = fields['new_ip']
+    batch.cache.clear()
+    return {'id': cluster.id}
+
+
+def _remove_cluster(batch, fields):
+    cluster = _get_cluster(batch, fields['building_id'], fields['ip'], fields['floor'])
+    ClusterNode.query.filter_by(id=cluster.id).delete()
+    batch.cache.clear()
+    return {'id': cluster.id}
+
+
+def _add_sensor(batch, fields):
+    cluster = _get_cluster(batch, fields['building_id'], fields['cluster_ip'], fields.get('floor'))
+    sensor = SensorNode(ip=fields['sensor_ip'], cluster_id=cluster.id, status=fields.get('status'),
+                        floor=fields.get('floor', cluster.floor), room=fields.get('room'),
+                        type=fields.get('type'))
+    db.session.add(sensor)
+    db.session.flush()
+    return {'id': sensor.id}
+
+
+def _edit_sensor(batch, fields):
+    cluster = _get_cluster(batch, fields['building_id'], fields['cluster_ip'], fields['floor'])
+    sensor = _get_sensor(cluster, fields['sensor_ip'])
+    if 'new_building_id' in fields or 'new_floor' in fields or 'new_cluster_ip' in fields:
+        building_id = fields.get('new_building_id', fields['building_id'])
+        floor = fields.get('new_floor', fields['floor'])
+        if 'new_cluster_ip' in fields:
+            new_cluster = _get_cluster(batch, building_id, fields['new_cluster_ip'], floor)
         else:
+            new_cluster = ClusterNode.query.filter_by(building_id=building_id, floor=floor).first()
+            if new_cluster is None:
+                raise OperationError('no cluster on building %d floor %d' % (building_id, floor))
+        sensor.cluster_id = new_cluster.id
+        sensor.floor = floor
+    if 'new_sensor_ip' in fields:
+        sensor.ip = fields['new_sensor_ip']
+    if 'status' in fields:
+        sensor.status = fields['status']
+    return {'id': sensor.id}
+
+
+def _remove_sensor(batch, fields):
+    cluster = _get_cluster(batch, fields['building_id'], fields['cluster_ip'], fields['floor'])
+    sensor = _get_sensor(cluster, fields['sensor_ip'])
+    SensorNode.query.filter_by(id=sensor.id).delete()
+    return {'id': sensor.id}
+
+
+def _list_clusters(batch, fields):
+    clusters = ClusterNode.query.filter_by(building_id=fields['building_id']).order_by(ClusterNode.floor).all()
+    return [r.to_dict() for r in clusters]
+
+
+def _list_sensors(batch, fields):
+    return [r.to_dict() for r in SensorNode.query.filter_by(cluster_id=fields['cluster_id']).all()]
+
+
+OPERATION_HANDLERS = {
+    'add_building': _add_building,
+    'edit_building': _edit_building,
+    'remove_building': _remove_building,
+    'add_cluster': _add_cluster,
+    'edit_cluster': _edit_cluster,
+    'remove_cluster': _remove_cluster,
+    'add_sensor': _add_sensor,
+    'edit_sensor': _edit_sensor,
+    'remove_sensor': _remove_sensor,
+    'get_cluster': _list_clusters,
+    'get_sensor': _list_sensors,
+}
+
+
+def run_operations(parsed):
+    """
+    Apply validated ``(op, fields)`` pairs in one transaction and return
+    their results in order. Any OperationError rolls the whole batch back
+    and is re-raised with the index of the failing operation.
+    """
+    batch = Batch()
+    results = []
+    try:
+        for index, (op, fields) in enumerate(parsed):
+            try:
+                results.append(OPERATION_HANDLERS[op](batch, fields))
+            except OperationError as e:
+                raise OperationError({'index': index, 'error': str(e)})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    for callback in batch.after_commit:
+        callback()
+    return results
+
+
+@app.route('/api/operations', methods=['POST'])
+@login_required
+def operations_request():
+    """
+    Apply a batch of map view operations; see operations.py for the payload.
+    Returns the result of every operation in order, or a 400 listing the
+    errors if the batch is invalid or any operation fails, in which case
+    nothing is changed. Managers only, like the map view.
+    """
+    if access_level() < AccessLevel.MANAGER:
+        abort(403)
+    try:
+        raw = operations.unwrap(request.get_json(silent=True))
+    except OperationError as e:
+        return jsonify(errors=[{'index': None, 'error': str(e)}]), 400
+    if len(raw) > app.config['OPERATIONS_MAX_BATCH']:
+        abort(413)
+    parsed, errors = operations.validate(raw, OPERATION_COLUMNS)
+    if errors:
+        return jsonify(errors=errors[:100]), 400
+    try:
+        results = run_operations(parsed)
+    except OperationError as e:
+        return jsonify(errors=[e.args[0]]), 400
+    if any(op not in operations.READ_ONLY for op, _ in parsed):
+        read_router.stick()
+    return jsonify(results=[{'op': op, 'result': result} for (op, _), result in zip(parsed, results)])
+
+
+@app.route('/map_request',methods=['POST','GET'])
+@login_required
+def map_request():
+    """
+    Single form-encoded operation posted by the map view, with the op in
+    ``type``; runs through the same handlers as /api/operations.
+    """
+    if access_level() < AccessLevel.MANAGER:
+        abort(403)
+    if request.method == 'POST':
+        packet = request.form.to_dict()
+        if 'type' not in packet.keys() :
+            log.warning('map_request without a type')
+            return ""
+        log.debug('map_request %s', request.form['type'])
+        operation = packet.pop('type')
+        if operation not in operations.OPERATIONS:
             return json.dumps({"time":str(datetime.datetime.now()),"you":"got_pranked"})
+        # the forms carry fields other operations use; keep the ones this op takes
+        required, optional = operations.OPERATIONS[operation]
+        fields = dict((name, packet[name]) for name in required + optional if name in packet)
+        fields['op'] = operation
+        parsed, errors = operations.validate([fields], OPERATION_COLUMNS)
+        if errors:
+            return jsonify(error=errors[0]['error']), 400
+        try:
+            result, = run_operations(parsed)
+        except OperationError as e:
+            return jsonify(error=e.args[0]['error']), 400
+        if operation in operations.READ_ONLY:
+            return json.dumps(result)
+        # the map reloads from the replicas next, which may not have the change yet
+        read_router.stick()
+        if operation.startswith('remove_'):
+            return json.dumps({"time": str(datetime.datetime.now())})
+        return json.dumps(result)
 
     elif request.method == 'GET':
         return json.dumps({"time":str(datetime.datetime.now())})
 
+
 # Flask views
 # @app.route('/')
 # def index():
@@ -498,25 +2302,12 @@ def map_request():
 
 class MyIndexView(AdminIndexView):
     @expose('/')
+    @read_router.reads
     def index(self):
-        print("wtf")
-        id_list = []
-        c_id_list = []
-        b_id_list = []
-        active = 0
-        for sensor in SensorData.query.all():
-            if sensor.sensor_id not in id_list:
-                id_list.append(sensor.sensor_id)
-                if sensor.status == 'ON':
-                  active += 1
-            if sensor.cluster_id not in c_id_list:
-                c_id_list.append(sensor.cluster_id)
-            if sensor.building_id not in b_id_list:
-                b_id_list.append(sensor.building_id)
-
+        counts = dashboard_stats.snapshot()
         buildings = Building.query.all()
-        print("b1:",buildings)
-        return self.render('admin/index.html',arg1=len(id_list), arg2=active, arg3=len(c_id_list), arg4=len(b_id_list), buildings=buildings)
+        return self.render('admin/index.html', arg1=counts['sensors'], arg2=counts['active_sensors'],
+                           arg3=counts['clusters'], arg4=counts['buildings'], buildings=buildings)
 
 
 # Create admin
@@ -543,10 +2334,18 @@ admin.add_view(MapView(name="Map View", endpoint='map', menu_icon_type='fa', men
 
 admin.add_view(SensorView(SensorNode, db.session, name="Sensor View",endpoint='sensor', menu_icon_type='fa', menu_icon_value='fa-connectdevelop'))
 
+admin.add_view(AlertView(Alert, db.session, name="Alerts", endpoint='alert', menu_icon_type='fa', menu_icon_value='fa-bell'))
+
+admin.add_view(AlertRuleView(AlertRule, db.session, name="Alert Rules", endpoint='alert_rule', menu_icon_type='fa', menu_icon_value='fa-sliders'))
+
+admin.add_view(DeviceTokenView(DeviceToken, db.session, name="Device Tokens", endpoint='device_token', menu_icon_type='fa', menu_icon_value='fa-key'))
+
 admin.add_view(BillingView(name="Billing View", endpoint='billing', menu_icon_type='glyph', menu_icon_value='glyphicon-home'))
 
 admin.add_view(DataView(name="Data View", endpoint='data_view', menu_icon_type='glyph', menu_icon_value='glyphicon-home'))
 
+admin.add_view(AnalyticsView(name="Analytics", endpoint='analytics', menu_icon_type='glyph', menu_icon_value='glyphicon-stats'))
+
 # define a context processor for merging flask-admin's template context into the
 # flask-security views.
 @security.context_processor
@@ -558,15 +2357,165 @@ def security_context_processor():
         get_url=url_for
     )
 
-def random_date(start, end):
+def create_missing_indexes(*tables):
     """
-    This function will return a random datetime between two datetime
-    objects.
+    create_all() skips tables that already exist, so databases built before an
+    index was declared need the missing ones created explicitly.
     """
-    delta = end - start
-    int_delta = (delta.days * 24 * 60 * 60) + delta.seconds
-    random_second = randrange(int_delta)
-    return start + timedelta(seconds=random_second)
+    inspector = inspect(db.engine)
+    for table in tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+
+
+def init_db():
+    """
+    Create missing tables, and indexes added to existing tables since the
+    database was built.
+    """
+    db.create_all()
+    # keep the oldest of the open alerts raised more than once before
+    # ix_alert_open_key
+    table = Alert.__table__
+    first = select([func.min(table.c.id)]).where(table.c.resolved_at.is_(None)).group_by(
+        table.c.rule_id, table.c.sensor_id)
+    db.session.execute(table.update().where(and_(table.c.resolved_at.is_(None), table.c.id.notin_(first))).values(
+        resolved_at=table.c.last_seen_at))
+    db.session.commit()
+    create_missing_indexes(SensorData.__table__, table)
+    sync_replicas()
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create missing tables and indexes."""
+    init_db()
+    print('database is up to date')
+
+
+def sync_replicas():
+    """
+    Refresh the SQLite files among the READ_REPLICAS with a copy of the
+    primary. Returns how many were copied.
+    """
+    primary = routing.sqlite_path(app.config['SQLALCHEMY_DATABASE_URI'], app.root_path)
+    copied = 0
+    for url in app.config['READ_REPLICAS']:
+        path = routing.sqlite_path(url, app.root_path)
+        if primary is not None and path is not None:
+            routing.copy_sqlite(primary, path)
+            copied += 1
+    return copied
+
+
+@app.cli.command('sync-replicas')
+def sync_replicas_command():
+    """Copy the primary SQLite database over its SQLite read replicas."""
+    print('synced %d replicas' % sync_replicas())
+
+
+replica_sync_worker = None
+if app.config['READ_REPLICA_SYNC_INTERVAL']:
+    replica_sync_worker = periodic.PeriodicWorker(sync_replicas, app.config['READ_REPLICA_SYNC_INTERVAL'],
+                                                  'replica-sync', background_lock)
+    background_workers.append(replica_sync_worker)
+    atexit.register(replica_sync_worker.stop)
+
+
+@app.cli.command('create-device-token')
+@click.argument('name')
+@click.option('--cluster-id', type=int, help='only accept readings for this cluster')
+def create_device_token_command(name, cluster_id):
+    """Create an API token for a machine client and print it."""
+    if cluster_id is not None and ClusterNode.query.get(cluster_id) is None:
+        raise click.BadParameter('no cluster %d' % cluster_id, param_hint='--cluster-id')
+    _, token = create_device_token(name, cluster_id)
+    db.session.commit()
+    # only the digest is stored; the token cannot be shown again
+    print(token)
+
+
+def seed_database(buildings, floors, rooms, sensors_per_room, per_sensor, start, end,
+                  chunk=50000, workers=1, random_seed=0, details=(), defer_indexes=False):
+    """
+    Create a generated topology and its readings (see seed.py) with bulk
+    Core inserts, committing about every ``chunk`` readings. Readings are
+    generated by ``workers`` processes while this one writes. With
+    ``defer_indexes`` the SensorData indexes are dropped during the load and
+    built once at the end, which is much faster for large loads into the
+    table store. Returns the number of readings.
+    """
+    building_rows, cluster_rows, sensor_rows = seed.topology(buildings, floors, rooms, sensors_per_room,
+                                                             details, random_seed)
+    for model, rows in ((Building, building_rows), (ClusterNode, cluster_rows), (SensorNode, sensor_rows)):
+        for i in range(0, len(rows), chunk):
+            db.session.execute(model.__table__.insert(), rows[i:i + chunk])
+    bump_topology_revision(db.session)
+    db.session.commit()
+
+    readings = SensorData.__table__
+    defer_indexes = defer_indexes and isinstance(reading_store, storage.TableStore)
+    if defer_indexes:
+        existing = set(index['name'] for index in inspect(db.engine).get_indexes(readings.name))
+        for index in readings.indexes:
+            if index.name in existing:
+                index.drop(db.engine)
+    blocks = seed.sensor_blocks(sensor_rows, cluster_rows, max(1, chunk // per_sensor))
+    total = 0
+    for rows in seed.generate(blocks, per_sensor, start, end, random_seed, workers):
+        reading_store.insert(rows)
+        db.session.commit()
+        total += len(rows)
+        log.debug('seeded %d readings', total)
+    if defer_indexes:
+        create_missing_indexes(readings)
+    dashboard_stats.rebuild()
+    facet_index.rebuild()
+    return total
+
+
+@app.cli.command('seed')
+@click.option('--buildings', default=5, show_default=True)
+@click.option('--floors', default=10, show_default=True, help='floors per building, one cluster node each')
+@click.option('--rooms', default=20, show_default=True, help='rooms per floor')
+@click.option('--sensors-per-room', default=1, show_default=True)
+@click.option('--readings', 'per_sensor', default=100, show_default=True, help='readings per sensor')
+@click.option('--start', default='2017-01-01', show_default=True, help='first reading date, YYYY-MM-DD')
+@click.option('--end', default='2018-01-01', show_default=True, help='date readings stop before, YYYY-MM-DD')
+@click.option('--chunk', default=50000, show_default=True, help='readings per transaction')
+@click.option('--workers', default=1, show_default=True, help='processes generating readings')
+@click.option('--seed', 'random_seed', default=0, show_default=True)
+@click.option('--reset', is_flag=True, help='drop and recreate every table and clear the reading store first')
+@click.option('--defer-indexes', is_flag=True, help='build the reading indexes after the load')
+@click.option('--rollups/--no-rollups', 'with_rollups', default=True, help='rebuild the rollups afterwards')
+def seed_command(buildings, floors, rooms, sensors_per_room, per_sensor, start, end, chunk, workers,
+                 random_seed, reset, defer_indexes, with_rollups):
+    """Generate buildings, clusters, sensors and readings in bulk."""
+    start, end = [datetime.datetime.strptime(value, '%Y-%m-%d') for value in (start, end)]
+    if reset:
+        db.drop_all()
+        db.create_all()
+        reading_store.clear()
+    elif Building.query.first() is not None:
+        raise click.UsageError('the database already has buildings; use --reset to replace them')
+    started = time.monotonic()
+    count = seed_database(buildings, floors, rooms, sensors_per_room, per_sensor, start, end,
+                          chunk, workers, random_seed, defer_indexes=defer_indexes)
+    elapsed = time.monotonic() - started
+    print('seeded %d readings in %.1fs (%d/s)' % (count, elapsed, count / max(elapsed, 1e-9)))
+    if with_rollups:
+        started = time.monotonic()
+        rebuild_rollups()
+        print('rebuilt rollups in %.1fs' % (time.monotonic() - started))
+
+
+SAMPLE_BUILDINGS = (
+    {'name': 'Waycrest Manor', 'lat': 37.335480, 'lng': -121.893028, 'address': '1500 Joseph Street'},
+    {'name': 'Sethraliss Temple', 'lat': 40, 'lng': -70, 'address': '402 Wilson Road'},
+    {'name': 'Black Rook Hold', 'lat': 47, 'lng': -122, 'address': '32 Custer Drive'},
+)
 
 
 def build_sample_db():
@@ -587,87 +2536,11 @@ def build_sample_db():
         db.session.add(user_role)
         db.session.add(manager_role)
         db.session.add(super_user_role)
-
-        b1 = Building(id=1,name="Waycrest Manor",lat=37.335480, lng=-121.893028, address="1500 Joseph Street")
-        b2 = Building(id=2,name="Sethraliss Temple",lat=40,lng=-70, address="402 Wilson Road")
-        b3 = Building(id=3, name="Black Rook Hold", lat=47, lng=-122,address="32 Custer Drive")
-
-        c1 = ClusterNode(id=1, building_id=1, floor=2, ip='192.168.1.122')
-        c2 = ClusterNode(id=2, building_id=2, floor=3, ip='192.168.1.12')
-        c3 = ClusterNode(id=3, building_id=3, floor=1, ip='192.168.3.52')
-        c4 = ClusterNode(id=4, building_id=3, floor=4, ip='192.168.5.23')
-
-
-        s1 = SensorNode(id=1, cluster_id=1, ip="10.0.1.4")
-        s2 = SensorNode(id=2, cluster_id=1, ip="10.0.1.45")
-        s3 = SensorNode(id=3, cluster_id=1, ip="10.0.1.4")
-        s4 = SensorNode(id=4, cluster_id=3, ip="10.0.5.3")
-        s5 = SensorNode(id=5, cluster_id=2, ip="10.0.2.125")
-
-        s6 = SensorNode(id=6, cluster_id=2, ip="10.0.1.4")
-
-        s_id = 1
-        c_id = 1
-        d1 = datetime.datetime.strptime('1/1/1995 1:30 PM', '%m/%d/%Y %I:%M %p')
-        d2 = datetime.datetime.strptime('1/1/2018 12:50 PM', '%m/%d/%Y %I:%M %p')
-        for building in range(1,6):
-            for level in range(1,11):
-                for room in range(1,21):
-                    for i in range(5):
-                        dt = random_date(d1, d2)
-                        status = "ON"
-                        if random.uniform(0,1)>0.8:
-                            status = "OFF"
-                        s_data = SensorData(sensor_id=s_id,building_id=building,cluster_id=c_id,floor=level,room=room,
-                                        temperature=round(random.uniform(16.0, 30.0),2),
-                                        date=dt.date(),time=dt.time(),status=status)
-                        db.session.add(s_data)
-                    s_id += 1
-                c_id +=1
-
-        db.session.add(c1)
-        db.session.add(c2)
-        db.session.add(c3)
-        db.session.add(c4)
-
-        db.session.add(s1)
-        db.session.add(s2)
-        db.session.add(s3)
-        db.session.add(s4)
-        db.session.add(s5)
-        db.session.add(s6)
-
-        db.session.add(b1)
-        db.session.add(b2)
-        db.session.add(b3)
-
-
-        db.session.commit()
-        db.session.add(c1)
-        db.session.add(c2)
-        db.session.add(c3)
-        db.session.add(c4)
-
-        db.session.add(s1)
-        db.session.add(s2)
-        db.session.add(s3)
-        db.session.add(s4)
-        db.session.add(s5)
-        db.session.add(s6)
-
-        db.session.add(b1)
-        db.session.add(b2)
-        db.session.add(b3)
-
-
         db.session.commit()
 
-        test_user = user_datastore.create_user(
-            first_name='Admin',
-            email='admin',
-            password=hash_password('admin'),
-            roles=[user_role, super_user_role]
-        )
+        seed_database(buildings=5, floors=10, rooms=20, sensors_per_room=1, per_sensor=5,
+                      start=datetime.datetime(1995, 1, 1, 13, 30), end=datetime.datetime(2018, 1, 1, 12, 50),
+                      random_seed=random.randrange(2 ** 31), details=SAMPLE_BUILDINGS)
 
         first_names = [
             'Harry', 'Amelia', 'Oliver', 'Jack', 'Isabella', 'Charlie', 'Sophie', 'Mia',
@@ -680,17 +2553,30 @@ def build_sample_db():
             'Ali', 'Mason', 'Mitchell', 'Rose', 'Davis', 'Davies', 'Rodriguez', 'Cox', 'Alexander'
         ]
 
+        tmp_passes = [''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(10))
+                      for _ in range(len(first_names))]
+        hashes = hash_passwords(['admin'] + tmp_passes)
+
+        test_user = user_datastore.create_user(
+            first_name='Admin',
+            email='admin',
+            password=hashes[0],
+            roles=[user_role, super_user_role]
+        )
+
         for i in range(len(first_names)):
             tmp_email = first_names[i].lower() + "." + last_names[i].lower() + "@example.com"
-            tmp_pass = ''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(10))
             user_datastore.create_user(
                 first_name=first_names[i],
                 last_name=last_names[i],
                 email=tmp_email,
-                password=hash_password(tmp_pass),
+                password=hashes[i + 1],
                 roles=[user_role, ]
             )
         db.session.commit()
+        rebuild_rollups()
+        meter_usage()
+        sync_replicas()
     return
 
 if __name__ == '__main__':
@@ -700,6 +2586,8 @@ if __name__ == '__main__':
     database_path = os.path.join(app_dir, app.config['DATABASE_FILE'])
     if not os.path.exists(database_path):
         build_sample_db()
+    else:
+        init_db()
 
     # Start app
-    app.run(debug=True, port=80)
\ No newline at end of file
+    app.run(debug=app.config['DEBUG'], port=app.config['PORT'])
\ No newline at end of file
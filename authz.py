@@ -0,0 +1,68 @@
+"""
+Access levels of the admin views.
+
+A user's level is the highest one granted by their roles. It is resolved
+once per request, from a single load of the user's roles, and kept on
+flask.g; every view's is_accessible() and permission check reads it from
+there instead of calling has_role() again. Role changes therefore take
+effect on the user's next request.
+"""
+import enum
+
+from flask import abort, g, redirect, request, url_for
+from flask_security import current_user
+
+
+class AccessLevel(enum.IntEnum):
+    NONE = 0
+    USER = 1
+    MANAGER = 2
+    SUPERUSER = 3
+
+
+ROLE_LEVELS = {
+    'user': AccessLevel.USER,
+    'manager': AccessLevel.MANAGER,
+    'superuser': AccessLevel.SUPERUSER,
+}
+
+
+def resolve_access_level(user):
+    """
+    Level of ``user`` computed from its roles; signed-in users without a
+    known role get USER.
+    """
+    if not user.is_authenticated or not user.is_active:
+        return AccessLevel.NONE
+    levels = [ROLE_LEVELS.get(role.name, AccessLevel.USER) for role in user.roles]
+    return max(levels or [AccessLevel.USER])
+
+
+def access_level():
+    """
+    Access level of the current user, resolved once per request.
+    """
+    user_id = current_user.get_id() if current_user.is_authenticated else None
+    cached = getattr(g, 'access_level', None)
+    if cached is None or cached[0] != user_id:
+        cached = g.access_level = (user_id, resolve_access_level(current_user))
+    return cached[1]
+
+
+class AccessMixin(object):
+    """
+    Admin view mixin granting access from ``required_level`` up; anonymous
+    users are sent to the login page, signed-in users below the level get
+    a 403.
+    """
+
+    required_level = AccessLevel.SUPERUSER
+
+    def is_accessible(self):
+        return access_level() >= self.required_level
+
+    def _handle_view(self, name, **kwargs):
+        if not self.is_accessible():
+            if current_user.is_authenticated:
+                abort(403)
+            return redirect(url_for('security.login', next=request.url))
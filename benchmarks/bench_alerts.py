@@ -0,0 +1,93 @@
+"""
+Measure the alert engine's throughput on a stream of readings.
+
+Every room of every building gets one rule (above, below, rate or off in
+turn), every building an above rule and one off rule covers everything, so
+a reading is checked against a handful of the rules. The readings come from
+sensors spread over those rooms, one per minute, with rare spikes and OFFs.
+
+    python benchmarks/bench_alerts.py --rules 10000 --readings 500000
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import alerts  # noqa: E402
+
+BUILDINGS = 50
+FLOORS = 10
+TARGET = 100000
+
+THRESHOLDS = {'above': 30.0, 'below': 15.0, 'rate': 4.0, 'off': None}
+
+
+def make_rules(count):
+    rooms = max(1, -(-(count - BUILDINGS - 1) // (BUILDINGS * FLOORS)))
+    rules = []
+    for building in range(1, BUILDINGS + 1):
+        for floor in range(1, FLOORS + 1):
+            for room in range(1, rooms + 1):
+                kind = alerts.KINDS[len(rules) % len(alerts.KINDS)]
+                rules.append(alerts.Rule(len(rules) + 1, kind, building, floor, str(room), THRESHOLDS[kind], 600))
+    for building in range(1, BUILDINGS + 1):
+        rules.append(alerts.Rule(len(rules) + 1, 'above', building, None, None, 35.0, None))
+    rules.append(alerts.Rule(len(rules) + 1, 'off', None, None, None, None, None))
+    return rules, rooms
+
+
+def make_rows(count, sensors, rooms, rng):
+    start = datetime.datetime(2018, 1, 1)
+    base = [rng.uniform(18.0, 26.0) for _ in range(sensors)]
+    for i in range(count):
+        sensor = i % sensors
+        dt = start + datetime.timedelta(minutes=i // sensors)
+        yield {
+            'sensor_id': sensor + 1,
+            'building_id': sensor % BUILDINGS + 1,
+            'floor': sensor // BUILDINGS % FLOORS + 1,
+            'room': str(sensor // (BUILDINGS * FLOORS) % rooms + 1),
+            'date': dt.date(),
+            'time': dt.time(),
+            'temperature': base[sensor] + rng.gauss(0.0, 0.5) + (12.0 if rng.random() < 0.001 else 0.0),
+            'status': 'ON' if rng.random() > 0.001 else 'OFF',
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rules', type=int, default=10000)
+    parser.add_argument('--sensors', type=int, default=10000)
+    parser.add_argument('--readings', type=int, default=500000)
+    parser.add_argument('--batch', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rules, rooms = make_rules(args.rules)
+    engine = alerts.AlertEngine(rules)
+    rows = list(make_rows(args.readings, args.sensors, rooms, random.Random(args.seed)))
+
+    opened = resolved = 0
+    started = time.perf_counter()
+    for i in range(0, len(rows), args.batch):
+        changes, _ = engine.evaluate(rows[i:i + args.batch])
+        for change in changes:
+            if change[0] == 'open':
+                opened += 1
+            else:
+                resolved += 1
+    seconds = time.perf_counter() - started
+
+    per_reading = sum(len(matched) for matched in engine._matched.values()) / float(len(engine._matched))
+    rate = len(rows) / seconds
+    print('%d rules, %d sensors, %.1f rules per reading' % (len(rules), args.sensors, per_reading))
+    print('%d readings in %.2f s, %d alerts opened, %d resolved' % (len(rows), seconds, opened, resolved))
+    print('%.0f readings/s (target %d: %s)' % (rate, TARGET, 'met' if rate >= TARGET else 'missed'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Compare the NumPy analytics path with row-at-a-time ORM processing.
+
+Both paths compute per-building temperature count/mean/std/min/max/median,
+the latest 12-reading moving average of every sensor and the readings more
+than 3 standard deviations from their sensor's mean, over the whole table.
+
+    python benchmarks/bench_analytics.py --rows 2000000
+"""
+import argparse
+import datetime
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import analytics  # noqa: E402
+from app import app, db, SensorData  # noqa: E402
+
+CHUNK = 50000
+WINDOW = 12
+
+
+def make_rows(count, rng):
+    start = datetime.datetime(2015, 1, 1)
+    for i in range(count):
+        building = i % 20 + 1
+        dt = start + datetime.timedelta(minutes=i // 2000 * 15)
+        yield {
+            'sensor_id': i % 2000 + 1,
+            'building_id': building,
+            'cluster_id': building * 10 + i % 10,
+            'floor': i // 20 % 10 + 1,
+            'room': str(i % 20 + 1),
+            'temperature': round(rng.gauss(22.0, 3.0), 2),
+            'date': dt.date(),
+            'time': dt.time(),
+            'status': 'ON' if rng.random() > 0.2 else 'OFF',
+        }
+
+
+def populate(count, rng):
+    insert = SensorData.__table__.insert()
+    batch = []
+    for row in make_rows(count, rng):
+        batch.append(row)
+        if len(batch) == CHUNK:
+            db.session.execute(insert, batch)
+            batch = []
+    if batch:
+        db.session.execute(insert, batch)
+    db.session.commit()
+
+
+def orm_path():
+    buildings, sensors = {}, {}
+    for sensor_data in SensorData.query.yield_per(CHUNK):
+        row = sensor_data.to_dict()
+        buildings.setdefault(row['building_id'], []).append(row['temperature'])
+        sensors.setdefault(row['sensor_id'], []).append(
+            (datetime.datetime.combine(row['date'], row['time']), row['temperature']))
+    stats = {}
+    for building, temps in buildings.items():
+        mean = sum(temps) / len(temps)
+        std = math.sqrt(sum((t - mean) ** 2 for t in temps) / len(temps))
+        ordered = sorted(temps)
+        middle = len(ordered) // 2
+        median = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+        stats[building] = (len(temps), mean, std, ordered[0], ordered[-1], median)
+    moving, anomalies = {}, 0
+    for sensor, readings in sensors.items():
+        readings.sort()
+        last = [t for _, t in readings[-WINDOW:]]
+        moving[sensor] = sum(last) / len(last)
+        temps = [t for _, t in readings]
+        mean = sum(temps) / len(temps)
+        std = math.sqrt(sum((t - mean) ** 2 for t in temps) / len(temps))
+        anomalies += sum(1 for t in temps if std and abs(t - mean) / std > 3)
+    return stats, moving, anomalies
+
+
+def numpy_path():
+    columns = [getattr(SensorData, name) for name in analytics.ROW_COLUMNS]
+    frame = analytics.frame_from_rows(db.session.execute(db.session.query(*columns).statement), CHUNK)
+    loaded = time.perf_counter()
+    stats = analytics.group_stats(frame)
+    analytics.percentiles(frame, qs=(50,), by=('building_id',))
+    latest = analytics.latest_by_sensor(frame)
+    analytics.moving_average(frame, WINDOW)[latest]
+    anomalies = int(analytics.anomalies(frame)['zscore'].sum())
+    return stats, anomalies, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10 ** 6)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    with app.app_context():
+        db.create_all()
+        populate(args.rows, random.Random(args.seed))
+
+        started = time.perf_counter()
+        _, _, orm_anomalies = orm_path()
+        orm_seconds = time.perf_counter() - started
+        db.session.expunge_all()
+
+        started = time.perf_counter()
+        _, numpy_anomalies, loaded = numpy_path()
+        numpy_seconds = time.perf_counter() - started
+
+        print('%d readings, %d anomalies (orm) / %d (numpy)' % (args.rows, orm_anomalies, numpy_anomalies))
+        print('%-8s %10s %10s %10s' % ('path', 'load s', 'compute s', 'total s'))
+        print('%-8s %10s %10s %10.2f' % ('orm', '-', '-', orm_seconds))
+        print('%-8s %10.2f %10.2f %10.2f' % ('numpy', loaded - started, numpy_seconds - (loaded - started),
+                                             numpy_seconds))
+        print('speedup  %.1fx' % (orm_seconds / numpy_seconds))
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
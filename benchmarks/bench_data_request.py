@@ -0,0 +1,102 @@
+"""
+Measure /data_request latency while the sensor_data table grows.
+
+Every step appends readings for new buildings only, so the filtered result
+(building 1, one floor, one room, a date window) stays the same size and any
+growth in latency comes from the table size alone.
+
+    python benchmarks/bench_data_request.py --max-rows 10000000
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import app, db, SensorData  # noqa: E402
+
+ROWS_PER_BUILDING = 10000
+CHUNK = 50000
+
+
+def make_rows(first_building, count, rng):
+    start = datetime.datetime(1995, 1, 1)
+    span = int((datetime.datetime(2018, 1, 1) - start).total_seconds())
+    for i in range(count):
+        building = first_building + i // ROWS_PER_BUILDING
+        dt = start + datetime.timedelta(seconds=rng.randrange(span))
+        yield {
+            'sensor_id': building * 1000 + i % 200,
+            'building_id': building,
+            'cluster_id': building * 10 + i % 10,
+            'floor': i // 20 % 10 + 1,
+            'room': str(i % 20 + 1),
+            'temperature': round(rng.uniform(16.0, 30.0), 2),
+            'date': dt.date(),
+            'time': dt.time(),
+            'status': 'ON' if rng.random() > 0.2 else 'OFF',
+        }
+
+
+def grow(table_rows, target, rng):
+    insert = SensorData.__table__.insert()
+    first_building = table_rows // ROWS_PER_BUILDING + 1
+    batch = []
+    for row in make_rows(first_building, target - table_rows, rng):
+        batch.append(row)
+        if len(batch) == CHUNK:
+            db.session.execute(insert, batch)
+            db.session.commit()
+            batch = []
+    if batch:
+        db.session.execute(insert, batch)
+        db.session.commit()
+
+
+def time_requests(client, repeat):
+    form = {'building': '1', 'floor': '3', 'room': '7',
+            'start_date': '2000-01-01', 'end_date': '2010-01-01'}
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.post('/data_request', data=form)
+        samples.append(time.perf_counter() - started)
+        assert response.status_code == 200
+    samples.sort()
+    return samples[len(samples) // 2], len(json.loads(response.data))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--max-rows', type=int, default=10 ** 6)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['SQLALCHEMY_ECHO'] = False
+    rng = random.Random(args.seed)
+
+    with app.app_context():
+        db.create_all()
+        client = app.test_client()
+        rows = 0
+        target = 10 ** 4
+        print('%12s %12s %10s' % ('rows', 'median ms', 'matches'))
+        while target <= args.max_rows:
+            grow(rows, target, rng)
+            rows = target
+            median, matches = time_requests(client, args.repeat)
+            print('%12d %12.2f %10d' % (rows, median * 1000, matches))
+            target *= 10
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
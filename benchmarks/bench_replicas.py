@@ -0,0 +1,149 @@
+"""
+Measure data view reads against ingestion writes, with and without a read
+replica.
+
+A scratch primary and replica SQLite file are seeded with the same readings.
+Reader processes post /data_request queries while a writer process posts
+batches to /api/ingest, as workers of a multi-worker server would. Reads go
+to the primary first and then to the replica. A run without the writer
+gives the reads' baseline. Read latency percentiles show the time spent
+waiting for the writer's locks, even when the processes share few cores.
+
+    python benchmarks/bench_replicas.py --readers 4 --seconds 10
+    python benchmarks/bench_replicas.py --wal
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+SETTINGS = """
+SQLALCHEMY_DATABASE_URI = 'sqlite:///%(primary)s'
+READ_REPLICAS = ['sqlite:///%(replica)s']
+SQLALCHEMY_ECHO = False
+LOG_LEVEL = 'WARNING'
+GEOCODER = 'offline'
+GEOCODE_CACHE_FILE = '%(geocode)s'
+INSTRUMENTATION = False
+INGEST_ALLOW_ANONYMOUS = True
+"""
+
+WAL = """
+SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 5000}
+"""
+
+
+def reader(app, seed, deadline, results):
+    rng = random.Random(seed)
+    client = app.test_client()
+    latencies = []
+    while time.monotonic() < deadline:
+        filters = {'building': rng.randint(1, 5), 'floor': rng.randint(1, 10), 'room': rng.randint(1, 20)}
+        started = time.monotonic()
+        response = client.post('/data_request', data=filters)
+        if response.status_code == 200:
+            latencies.append(time.monotonic() - started)
+    results.put(('reads', latencies))
+
+
+def writer(app, sensors, batch, deadline, results, seed):
+    rng = random.Random(seed)
+    client = app.test_client()
+    at = datetime.datetime(2030, 1, 1) + datetime.timedelta(days=seed)
+    written = 0
+    while time.monotonic() < deadline:
+        cluster_id, sensor_ids = rng.choice(sensors)
+        readings = []
+        for _ in range(batch):
+            at += datetime.timedelta(seconds=1)
+            readings.append({'sensor_id': rng.choice(sensor_ids), 'temperature': round(rng.uniform(16, 30), 2),
+                             'status': 'ON', 'timestamp': at.isoformat()})
+        response = client.post('/api/ingest', data=json.dumps(readings), content_type='application/json',
+                               query_string={'cluster_id': cluster_id})
+        if response.status_code in (201, 202):
+            written += batch
+    results.put(('written', [written]))
+
+
+def run(app, args, sensors, with_writer, seed):
+    # forked workers each open their own SQLite connections
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    deadline = time.monotonic() + args.seconds
+    processes = [context.Process(target=reader, args=(app, seed * 100 + i, deadline, results))
+                 for i in range(args.readers)]
+    if with_writer:
+        processes.append(context.Process(target=writer, args=(app, sensors, args.batch, deadline, results, seed)))
+    started = time.monotonic()
+    for process in processes:
+        process.start()
+    totals = {'reads': [], 'written': []}
+    for _ in processes:
+        name, values = results.get()
+        totals[name].extend(values)
+    for process in processes:
+        process.join()
+    seconds = time.monotonic() - started
+    return sorted(totals['reads']), seconds, sum(totals['written'])
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100.0))] if ordered else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--per-sensor', type=int, default=200, help='seeded readings per sensor')
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--batch', type=int, default=500, help='readings per ingest request')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--wal', action='store_true', help='put the primary in WAL mode')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    settings = os.path.join(directory, 'settings.py')
+    with open(settings, 'w') as f:
+        f.write(SETTINGS % {'primary': os.path.join(directory, 'primary.sqlite'),
+                            'replica': os.path.join(directory, 'replica.sqlite'),
+                            'geocode': os.path.join(directory, 'geocode.sqlite')})
+        if args.wal:
+            f.write(WAL)
+    os.environ['GREENBUILDING_SETTINGS'] = settings
+
+    from app import app, db, read_router, seed_database, sync_replicas, SensorNode
+
+    with app.app_context():
+        db.create_all()
+        count = seed_database(buildings=5, floors=10, rooms=20, sensors_per_room=1, per_sensor=args.per_sensor,
+                              start=datetime.datetime(2015, 1, 1), end=datetime.datetime(2018, 1, 1))
+        sync_replicas()
+        clusters = {}
+        for sensor_id, cluster_id in db.session.query(SensorNode.id, SensorNode.cluster_id):
+            clusters.setdefault(cluster_id, []).append(sensor_id)
+        sensors = sorted(clusters.items())
+
+    replicas = read_router.engines
+    print('%d readings, %d readers, %s primary' % (count, args.readers, 'WAL' if args.wal else 'rollback journal'))
+    print('%-26s %10s %10s %10s %14s' % ('run', 'reads/s', 'p50 ms', 'p99 ms', 'written rows/s'))
+    runs = (('reads only', replicas, False),
+            ('reads + writes, primary', [], True),
+            ('reads + writes, replica', replicas, True))
+    for seed, (label, engines, with_writer) in enumerate(runs):
+        # an empty router sends everything to the primary
+        read_router.engines = engines
+        latencies, seconds, written = run(app, args, sensors, with_writer, seed)
+        print('%-26s %10.1f %10.1f %10.1f %14s' % (
+            label, len(latencies) / seconds, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+            '%.0f' % (written / seconds) if with_writer else '-'))
+    read_router.engines = replicas
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Benchmark every admin view and JSON endpoint, and catch regressions.
+
+Seeds a database of the requested size (or reuses --db if it exists), signs
+in as a superuser through the Flask test client and requests each endpoint
+--requests times. Per endpoint it records latency percentiles, the number of
+SQL statements of one request and the peak memory Python allocated while
+serving it (measured in a separate pass, as tracemalloc slows everything
+down).
+
+    python benchmarks/bench_views.py --readings 200 --save baseline.json
+    python benchmarks/bench_views.py --readings 200 --baseline baseline.json
+
+With --baseline the run fails (exit status 1) when any metric of any
+endpoint is worse than the baseline by more than --threshold (a fraction)
+and its small absolute allowance.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import event  # noqa: E402
+
+import app as application  # noqa: E402
+from app import app, db  # noqa: E402
+
+START = datetime.datetime(2017, 1, 1)
+END = datetime.datetime(2018, 1, 1)
+
+# name -> (method, path, form data); sensor 1 sits in cluster 1 on floor 1 of
+# building 1 in every seeded database
+ENDPOINTS = (
+    ('index', 'GET', '/admin/', None),
+    ('data_view', 'GET', '/data_view/', None),
+    ('billing', 'GET', '/billing/', None),
+    ('map', 'GET', '/map/', None),
+    ('data_request', 'POST', '/data_request',
+     {'building': '1', 'floor': '2', 'room': '', 'start_date': '2017-03-01', 'end_date': '2017-04-01'}),
+    ('map_request.get_cluster', 'POST', '/map_request', {'type': 'get_cluster', 'building_id': '1'}),
+    ('map_request.edit_sensor', 'POST', '/map_request',
+     {'type': 'edit_sensor', 'building_id': '1', 'floor': '1', 'cluster_ip': '172.0.0.1',
+      'sensor_ip': '10.0.0.1', 'status': 'ON'}),
+    ('api.readings', 'GET', '/api/readings?building=1&page_size=500', None),
+    ('api.topology', 'GET', '/api/topology', None),
+    ('api.rollups', 'GET', '/api/rollups?start=2017-01-01&end=2018-01-01&group_by=floor&interval=day', None),
+    ('api.analytics', 'GET', '/api/analytics?building=1', None),
+)
+
+# metric -> absolute allowance on top of the relative threshold
+METRICS = (
+    ('p50_ms', 1.0),
+    ('p95_ms', 2.0),
+    ('p99_ms', 5.0),
+    ('queries', 0),
+    ('peak_kb', 64.0),
+)
+
+
+def seed(path, args):
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    if os.path.exists(path):
+        return
+    datastore = application.user_datastore
+    with app.app_context():
+        db.create_all()
+        roles = [datastore.find_or_create_role(name) for name in ('user', 'manager', 'superuser')]
+        db.session.commit()
+        application.seed_database(args.buildings, args.floors, args.rooms, 1, args.readings, START, END,
+                                  defer_indexes=True)
+        datastore.create_user(email='bench', password=application.hash_passwords(['bench'])[0],
+                              roles=[roles[0], roles[2]], active=True)
+        db.session.commit()
+        application.rebuild_rollups()
+
+
+def measure(client, method, path, data, requests, statements):
+    latencies = []
+    for _ in range(requests):
+        del statements[:]
+        started = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if response.status_code != 200:
+            raise SystemExit('%s %s answered %d' % (method, path, response.status_code))
+    queries = len(statements)
+
+    tracemalloc.start()
+    client.open(path, method=method, data=data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {'p50_ms': round(p50, 3), 'p95_ms': round(p95, 3), 'p99_ms': round(p99, 3),
+            'max_ms': round(max(latencies), 3), 'queries': queries, 'peak_kb': round(peak / 1024.0, 1)}
+
+
+def regressions(results, baseline, threshold):
+    found = []
+    for name, metrics in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric, allowance in METRICS:
+            if metric in before and metrics[metric] > before[metric] * (1 + threshold) + allowance:
+                found.append('%s %s: %s -> %s' % (name, metric, before[metric], metrics[metric]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--buildings', type=int, default=5)
+    parser.add_argument('--floors', type=int, default=10)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--readings', type=int, default=100, help='readings per sensor')
+    parser.add_argument('--db', help='seeded SQLite file to reuse, created if missing')
+    parser.add_argument('--requests', type=int, default=30, help='timed requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--only', action='append', help='endpoint names to run (repeatable)')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['WTF_CSRF_ENABLED'] = False
+    started = time.perf_counter()
+    seed(path, args)
+    print('database ready in %.1fs' % (time.perf_counter() - started))
+
+    statements = []
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: statements.append(a[2]))
+    client = app.test_client()
+    response = client.post('/login/', data={'email': 'bench', 'password': 'bench'})
+    assert response.status_code == 302, 'could not sign in'
+
+    results = {}
+    print('%-26s%10s%10s%10s%10s%9s%11s' % ('endpoint', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'queries', 'peak KB'))
+    for name, method, url, data in ENDPOINTS:
+        if args.only and name not in args.only:
+            continue
+        measure(client, method, url, data, args.warmup, statements)
+        metrics = results[name] = measure(client, method, url, data, args.requests, statements)
+        print('%-26s%10.2f%10.2f%10.2f%10.2f%9d%11.1f' % (
+            name, metrics['p50_ms'], metrics['p95_ms'], metrics['p99_ms'], metrics['max_ms'],
+            metrics['queries'], metrics['peak_kb']))
+
+    report = {'meta': {'buildings': args.buildings, 'floors': args.floors, 'rooms': args.rooms,
+                       'readings': args.readings, 'requests': args.requests},
+              'results': results}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('meta') != report['meta']:
+            print('warning: the baseline was recorded with %s' % baseline.get('meta'))
+        found = regressions(results, baseline['results'], args.threshold)
+        for line in found:
+            print('REGRESSION ' + line)
+        if found:
+            raise SystemExit(1)
+        print('no regressions beyond %d%%' % (args.threshold * 100))
+    if not args.db:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
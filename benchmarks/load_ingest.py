@@ -0,0 +1,128 @@
+"""
+Load test for the bulk ingestion endpoint, reporting sustained rows/sec.
+
+By default it runs against a scratch database through the Flask test
+client. With --url it posts to a running server instead, from --clients
+threads, using the clusters and sensors given by --cluster-id/--sensor-ids.
+
+    python benchmarks/load_ingest.py --batch 1000 --seconds 20
+    python benchmarks/load_ingest.py --url http://localhost/api/ingest \\
+        --cluster-id 1 --sensor-ids 1,2,3 --clients 8
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def make_batch(rng, cluster_id, sensor_ids, size, ndjson):
+    now = datetime.datetime(2018, 1, 1) + datetime.timedelta(seconds=rng.randrange(10 ** 7))
+    readings = [{
+        'cluster_id': cluster_id,
+        'sensor_id': rng.choice(sensor_ids),
+        'temperature': round(rng.uniform(16.0, 30.0), 2),
+        'status': 'ON' if rng.random() > 0.2 else 'OFF',
+        'timestamp': (now + datetime.timedelta(seconds=i)).isoformat(),
+    } for i in range(size)]
+    if ndjson:
+        return '\n'.join(json.dumps(r) for r in readings), 'application/x-ndjson'
+    return json.dumps(readings), 'application/json'
+
+
+def run_client(post, args, sensor_ids, seed, deadline, stats, lock):
+    rng = random.Random(seed)
+    while time.perf_counter() < deadline:
+        body, mimetype = make_batch(rng, args.cluster_id, sensor_ids, args.batch, args.ndjson)
+        started = time.perf_counter()
+        status = post(body, mimetype)
+        elapsed = time.perf_counter() - started
+        with lock:
+            stats['latencies'].append(elapsed)
+            if status in (201, 202):
+                stats['rows'] += args.batch
+            else:
+                stats['failed'] += 1
+
+
+def local_target(args):
+    from app import app, db, Building, ClusterNode, SensorNode
+
+    path = os.path.join(tempfile.mkdtemp(), 'ingest.sqlite')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['INGEST_ALLOW_ANONYMOUS'] = True
+    context = app.app_context()
+    context.push()
+    db.create_all()
+    db.session.add(Building(id=1, name='Load test'))
+    db.session.add(ClusterNode(id=args.cluster_id, building_id=1, floor=1, ip='10.0.0.1'))
+    sensor_ids = list(range(1, 201))
+    for sensor_id in sensor_ids:
+        db.session.add(SensorNode(id=sensor_id, cluster_id=args.cluster_id, floor=1, room=str(sensor_id)))
+    db.session.commit()
+    client = app.test_client()
+
+    def post(body, mimetype):
+        return client.post('/api/ingest', data=body, content_type=mimetype).status_code
+    return post, sensor_ids
+
+
+def remote_target(args):
+    def post(body, mimetype):
+        headers = {'Content-Type': mimetype}
+        if args.token:
+            headers['Authorization'] = 'Bearer ' + args.token
+        req = Request(args.url, data=body.encode(), headers=headers)
+        try:
+            with urlopen(req) as response:
+                return response.status
+        except Exception as e:
+            return getattr(e, 'code', 0)
+    return post, [int(i) for i in args.sensor_ids.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url')
+    parser.add_argument('--token', help='device token for servers that require one')
+    parser.add_argument('--cluster-id', type=int, default=1)
+    parser.add_argument('--sensor-ids', default='1')
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--clients', type=int, default=1)
+    parser.add_argument('--ndjson', action='store_true')
+    args = parser.parse_args()
+
+    post, sensor_ids = remote_target(args) if args.url else local_target(args)
+    clients = args.clients if args.url else 1
+    stats = {'rows': 0, 'failed': 0, 'latencies': []}
+    lock = threading.Lock()
+    started = time.perf_counter()
+    deadline = started + args.seconds
+    threads = [threading.Thread(target=run_client, args=(post, args, sensor_ids, i, deadline, stats, lock))
+               for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(stats['latencies'])
+    print('batches      %d (%d failed)' % (len(latencies), stats['failed']))
+    print('rows         %d' % stats['rows'])
+    print('rows/sec     %.0f' % (stats['rows'] / elapsed))
+    if latencies:
+        print('batch p50    %.1f ms' % (latencies[len(latencies) // 2] * 1000))
+        print('batch p99    %.1f ms' % (latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+if __name__ == '__main__':
+    main()
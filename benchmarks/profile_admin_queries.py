@@ -0,0 +1,69 @@
+"""
+Count the SQL queries each admin page runs, per role.
+
+Builds the sample database in a temporary file, signs in as a superuser, a
+manager and a plain user, and prints the number of statements sent to the
+database while rendering every page (menu included).
+
+    python benchmarks/profile_admin_queries.py
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import event  # noqa: E402
+
+import app as application  # noqa: E402
+from app import app, db  # noqa: E402
+
+PAGES = ('/admin/', '/map/', '/billing/', '/data_view/', '/analytics/', '/sensor/', '/user/', '/role/')
+ACCOUNTS = (('superuser', 'admin', 'admin'),
+            ('manager', 'profile-manager', 'profile'),
+            ('user', 'profile-user', 'profile'))
+
+
+def add_profile_users():
+    datastore = application.user_datastore
+    for role, email, password in ACCOUNTS[1:]:
+        datastore.create_user(email=email, password=application.hash_passwords([password])[0],
+                              roles=[datastore.find_role(role)], active=True)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3, help='requests per page, the last one is counted')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'profile.sqlite')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        application.build_sample_db()
+        add_profile_users()
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: statements.append(a[2]))
+
+    print('%-12s' % 'page' + ''.join('%12s' % role for role, _, _ in ACCOUNTS))
+    counts = dict((page, []) for page in PAGES)
+    for role, email, password in ACCOUNTS:
+        client = app.test_client()
+        response = client.post('/login/', data={'email': email, 'password': password})
+        assert response.status_code == 302, 'could not sign in as %s' % email
+        for page in PAGES:
+            for _ in range(args.repeat):
+                del statements[:]
+                status = client.get(page).status_code
+            counts[page].append('%d (%d)' % (len(statements), status))
+    for page in PAGES:
+        print('%-12s' % page + ''.join('%12s' % count for count in counts[page]))
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,10 +6,172 @@ DATABASE_FILE = 'sample_db.sqlite'
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + DATABASE_FILE
 SQLALCHEMY_ECHO = True
 
+# Development defaults. Setting GREENBUILDING_PROFILE=production loads
+# config_production.py on top of this file, and GREENBUILDING_SETTINGS may
+# name one more file of site-specific overrides.
+DEBUG = True
+PORT = 80
+LOG_LEVEL = 'DEBUG'
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# PRAGMAs run on every new SQLite connection, e.g. {'journal_mode': 'WAL'}
+SQLITE_PRAGMAS = {}
+# engine pool settings, only used for server databases (not SQLite)
+DATABASE_POOL = {}
+
+# Where readings are stored: 'table' keeps them in the SensorData table of
+# the app database, 'sharded' in one SQLite file per building and month under
+# READING_SHARD_DIR (see storage.py and the split-readings command)
+READING_STORE = 'table'
+READING_SHARD_DIR = 'shards'
+
+# The retention, metering and replica sync jobs below run in whichever
+# process holds this file lock, once per host; with several hosts, set their
+# intervals on one of them only
+BACKGROUND_LOCK_FILE = 'background_jobs.lock'
+
+# Retention: raw readings older than RETENTION_DAYS (rounded down to the
+# start of a month) are folded into the rollups and deleted, in chunks of
+# RETENTION_CHUNK rows; None keeps them forever. RETENTION_BUILDING_DAYS
+# overrides the period per building id. Freed pages are returned to the file
+# system RETENTION_VACUUM_PAGES at a time.
+RETENTION_DAYS = None
+RETENTION_BUILDING_DAYS = {}
+RETENTION_CHUNK = 5000
+RETENTION_VACUUM_PAGES = 1000
+# run the retention job every this many seconds in a background thread;
+# None leaves it to the apply-retention command
+RETENTION_INTERVAL = None
+
+# Metered billing: sensor-hours (hours with an ON reading) are metered from
+# the readings past the stored watermark, METERING_CHUNK reading ids at a
+# time, re-reading the last METERING_OVERLAP ids in case writers committed
+# out of order. Metering runs in the meter-usage command, or every
+# METERING_INTERVAL seconds in the background; the billing view only shows
+# how far it got
+METERING_CHUNK = 50000
+METERING_OVERLAP = 1000
+METERING_INTERVAL = None
+BILLING_HOURLY_RATE = 5.0
+
+# Request instrumentation: Server-Timing headers, Prometheus metrics at
+# /metrics for METRICS_ALLOWED_ADDRESSES, and a warning in the
+# instrumentation.slow_queries log for statements slower than SLOW_QUERY_MS
+INSTRUMENTATION = True
+SERVER_TIMING = True
+SLOW_QUERY_MS = 250
+METRICS_ALLOWED_ADDRESSES = ('127.0.0.1', '::1')
+
+# Live updates over Server-Sent Events at /api/events. Bursts are coalesced
+# for EVENTS_COALESCE_SECONDS, idle streams get a comment every
+# EVENTS_HEARTBEAT_SECONDS; each open stream holds a worker thread, so at
+# most EVENTS_MAX_SUBSCRIBERS are served per process
+EVENTS_COALESCE_SECONDS = 0.5
+EVENTS_HEARTBEAT_SECONDS = 15
+EVENTS_MAX_SUBSCRIBERS = 100
+
+# Streaming reading exports at /api/export: rows encoded per batch, and
+# gzip compressed at EXPORT_GZIP_LEVEL for clients that accept it
+EXPORT_BATCH_SIZE = 5000
+EXPORT_GZIP_LEVEL = 6
+
+# Read replicas: the dashboard, data view and map read from one of
+# READ_REPLICAS (SQLAlchemy URLs, e.g. 'sqlite:///sample_db_replica.sqlite')
+# and write to the primary. A user who changes the map reads from the
+# primary until a replica has the change: for SQLite replicas, copies of the
+# primary refreshed by init-db, the sync-replicas command and every
+# READ_REPLICA_SYNC_INTERVAL seconds if set, until the next copy; for other
+# replicas, for READ_REPLICA_STICKY_SECONDS
+READ_REPLICAS = []
+READ_REPLICA_STICKY_SECONDS = 10
+READ_REPLICA_SYNC_INTERVAL = None
+
+# Readings API paging
+READINGS_PAGE_SIZE = 500
+READINGS_MAX_PAGE_SIZE = 5000
+
+# Bulk ingestion from cluster nodes
+INGEST_MAX_BATCH = 10000
+# only accept readings for clusters whose ClusterNode.ip is the client address
+INGEST_CHECK_CLUSTER_IP = False
+# batches need an "Authorization: Bearer <device token>" header (see the
+# create-device-token command) or a signed-in manager; tokens revoked in
+# another process stop working after DEVICE_TOKEN_MAX_AGE seconds.
+# INGEST_ALLOW_ANONYMOUS also accepts anonymous batches, for development
+INGEST_ALLOW_ANONYMOUS = False
+DEVICE_TOKEN_MAX_AGE = 60
+# queue validated batches and write them from a background thread
+INGEST_ASYNC = False
+INGEST_QUEUE_SIZE = 100000
+INGEST_QUEUE_BATCH_SIZE = 5000
+INGEST_QUEUE_FLUSH_INTERVAL = 0.5
+# 'reject' answers 429 when the queue is full, 'block' waits for room first
+INGEST_QUEUE_BACKPRESSURE = 'reject'
+INGEST_QUEUE_PUT_TIMEOUT = 5.0
+# a batch that fails to write is retried after a delay doubling from
+# INGEST_QUEUE_RETRY_DELAY up to INGEST_QUEUE_MAX_RETRY_DELAY seconds
+INGEST_QUEUE_RETRY_DELAY = 0.5
+INGEST_QUEUE_MAX_RETRY_DELAY = 30.0
+
+# Rebuild the per-process dashboard counts and filter facets every this many
+# seconds on a background thread, so writes made by other workers show up;
+# None keeps them until restart
+DASHBOARD_STATS_MAX_AGE = 300
+
+# Alert rules are evaluated on every ingested batch; rules edited by another
+# worker are picked up after ALERT_RULES_MAX_AGE seconds. Rate rules look at
+# the last ALERT_HISTORY readings of a sensor
+ALERT_RULES_MAX_AGE = 60
+ALERT_HISTORY = 8
+
+# Analytics: rows converted to arrays per batch, and the most readings one
+# request may load
+ANALYTICS_CHUNK_SIZE = 100000
+ANALYTICS_MAX_ROWS = 5000000
+
+# Most operations accepted in one /api/operations batch
+OPERATIONS_MAX_BATCH = 5000
+
+# Rendered /api/topology payloads kept per process
+TOPOLOGY_CACHE_SIZE = 64
+
+# Map viewport queries: sites are indexed in a grid of SPATIAL_CELL_DEGREES
+# cells. Below MAP_CLUSTER_MAX_ZOOM, /api/map returns the buildings within
+# each MAP_CLUSTER_PIXELS square of the screen as one cluster
+SPATIAL_CELL_DEGREES = 0.05
+MAP_CLUSTER_MAX_ZOOM = 12
+MAP_CLUSTER_PIXELS = 60
+MAP_NEAREST_MAX = 100
+
+# Building address lookups: 'nominatim' (OpenStreetMap) or 'offline', which
+# never resolves anything
+GEOCODER = 'nominatim'
+GEOCODER_USER_AGENT = 'green-building'
+GEOCODER_TIMEOUT = 10
+GEOCODER_WORKERS = 2
+# relative to the app directory
+GEOCODE_CACHE_FILE = 'geocode_cache.sqlite'
+# entries of GEOCODE_CACHE_FILE also kept in memory
+GEOCODE_CACHE_SIZE = 1024
+# addresses the geocoder could not place are asked again after this many
+# seconds; None never asks again
+GEOCODE_NOT_FOUND_TTL = 7 * 86400
+
 # Flask-Security config
 SECURITY_URL_PREFIX = "/"
 SECURITY_PASSWORD_HASH = "pbkdf2_sha512"
 SECURITY_PASSWORD_SALT = "ATGUOHAELKiubahiughaerGOJAEGj"
+# hashing cost; cheap in development, raised by the production profile.
+# Passwords hashed at a lower cost are rehashed at their user's next login
+SECURITY_PASSWORD_HASH_OPTIONS = {'pbkdf2_sha512': {'rounds': 1000}}
+
+# Passwords are hashed on PASSWORD_HASH_WORKERS processes (0 hashes on the
+# request thread). At most PASSWORD_HASH_MAX_PENDING hashes wait per web
+# worker; a login finding no room within PASSWORD_HASH_TIMEOUT seconds gets
+# a 503
+PASSWORD_HASH_WORKERS = 0
+PASSWORD_HASH_MAX_PENDING = 64
+PASSWORD_HASH_TIMEOUT = 10
 
 # Flask-Security URLs, overridden because they don't put a / at the end
 SECURITY_LOGIN_URL = "/login/"
@@ -0,0 +1,46 @@
+# Production overrides, loaded on top of config.py when
+# GREENBUILDING_PROFILE=production (wsgi.py sets it by default).
+import os
+
+SECRET_KEY = os.environ.get('GREENBUILDING_SECRET_KEY')
+SECURITY_PASSWORD_SALT = os.environ.get('GREENBUILDING_PASSWORD_SALT')
+
+# any SQLAlchemy URL; defaults to the SQLite file next to the app
+if os.environ.get('DATABASE_URL'):
+    SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
+
+SQLALCHEMY_ECHO = False
+DEBUG = False
+LOG_LEVEL = 'INFO'
+
+# readers don't block the writer, and commits only fsync at checkpoints;
+# writers wait up to busy_timeout ms for the lock instead of failing; new
+# databases give pages freed by the retention job back incrementally
+SQLITE_PRAGMAS = {
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+}
+
+# per worker process
+DATABASE_POOL = {
+    'pool_size': 10,
+    'max_overflow': 10,
+    'pool_timeout': 30,
+    'pool_recycle': 1800,
+    'pool_pre_ping': True,
+}
+
+# each /api/events stream holds one of the GREENBUILDING_THREADS threads of
+# its worker (see gunicorn.conf.py); leave the rest to ordinary requests
+EVENTS_MAX_SUBSCRIBERS = max(1, int(os.environ.get('GREENBUILDING_THREADS', 64)) - 16)
+
+INGEST_ASYNC = True
+# only device tokens and signed-in managers may push readings
+INGEST_ALLOW_ANONYMOUS = False
+
+# OWASP's recommended PBKDF2-HMAC-SHA512 cost, computed off the request
+# threads
+SECURITY_PASSWORD_HASH_OPTIONS = {'pbkdf2_sha512': {'rounds': 210000}}
+PASSWORD_HASH_WORKERS = 2
@@ -0,0 +1,112 @@
+"""
+In-process publish/subscribe for live updates pushed over Server-Sent Events.
+
+Publishers send events to a topic: ``dashboard`` for the dashboard counts,
+``topology`` when buildings, clusters or sensors change, and
+``building:<id>`` for the readings and sensor status changes of one
+building. Every subscription names the topics it wants, or None for all of
+them.
+
+Events carry a key, and a subscription keeps only the latest pending event
+per ``(type, key)``: a burst of readings from one sensor, or of dashboard
+updates, reaches the client as one event. get() waits for the first event and
+then ``window`` seconds more to let a burst collapse before returning.
+
+The broker only sees events published by its own process; with several
+worker processes each one pushes the changes it made itself.
+"""
+import collections
+import threading
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class Subscription(object):
+
+    def __init__(self, topics=None, max_pending=10000):
+        self.topics = frozenset(topics) if topics is not None else None
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def wants(self, topic):
+        return self.topics is None or topic in self.topics
+
+    def offer(self, type, key, data):
+        with self._cond:
+            if self._closed:
+                return
+            self._pending.pop((type, key), None)
+            if len(self._pending) >= self.max_pending:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+            self._pending[(type, key)] = data
+            self._cond.notify()
+
+    def get(self, timeout, window=0.0):
+        """
+        ``(type, data)`` pairs of the pending events, oldest first, waiting
+        up to ``timeout`` seconds for one. Returns an empty list on timeout
+        and None once the subscription is closed.
+        """
+        with self._cond:
+            if not self._pending and not self._closed:
+                self._cond.wait(timeout)
+            if self._pending and window and not self._closed:
+                self._cond.wait_for(lambda: self._closed, window)
+            if self._closed:
+                return None
+            events = [(type, data) for (type, _), data in self._pending.items()]
+            self._pending.clear()
+        return events
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class Broker(object):
+
+    def __init__(self, max_subscribers=100, max_pending=10000):
+        self.max_subscribers = max_subscribers
+        self.max_pending = max_pending
+        self._subscriptions = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics=None):
+        with self._lock:
+            if len(self._subscriptions) >= self.max_subscribers:
+                raise TooManySubscribers()
+            subscription = Subscription(topics, self.max_pending)
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def has_subscribers(self, topic=None):
+        subscriptions = self._subscriptions
+        return any(s.wants(topic) for s in subscriptions) if topic is not None else bool(subscriptions)
+
+    def publish(self, topic, type, key, data):
+        """
+        Queue an event for the subscriptions of ``topic``, replacing any of
+        theirs still pending with the same type and key.
+        """
+        for subscription in list(self._subscriptions):
+            if subscription.wants(topic):
+                subscription.offer(type, key, data)
+
+    def close(self):
+        with self._lock:
+            subscriptions, self._subscriptions = self._subscriptions, []
+        for subscription in subscriptions:
+            subscription.close()
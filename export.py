@@ -0,0 +1,179 @@
+"""
+Streaming exports of sensor readings.
+
+Rows are encoded in batches as they come off the database cursor, so an
+export of any size runs in the memory of one batch. Two formats:
+
+CSV, with a header row, ISO dates and times and empty fields for NULLs.
+
+A compact columnar binary format for loading into numpy or pandas without
+parsing text. After the ``MAGIC`` line comes one JSON line describing the
+columns, then batches. A batch is its row count (little-endian uint32)
+followed by every column in order: a validity bitmap (numpy.packbits, one
+bit per row, 1 where the value is not NULL) and the values. Numbers are
+little-endian int64, int32 or float64, dates int32 days since 1970-01-01 and
+times int32 seconds since midnight. Strings are dictionary encoded: the
+number of distinct values (uint32), their int32 end offsets into the UTF-8
+bytes that follow, then one code per row, uint8 for up to 256 distinct
+values and int32 above. A batch of zero rows ends the stream. read_columns()
+decodes it.
+
+Either stream can be gzip compressed on the fly with gzip_chunks().
+"""
+import csv
+import datetime
+import io
+import json
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b'GBCOLS1\n'
+
+# column name -> columnar type
+COLUMNS = (
+    ('id', 'int64'),
+    ('sensor_id', 'int32'),
+    ('building_id', 'int32'),
+    ('cluster_id', 'int32'),
+    ('floor', 'int32'),
+    ('room', 'str'),
+    ('date', 'date'),
+    ('time', 'time'),
+    ('temperature', 'float64'),
+    ('status', 'str'),
+)
+
+_EPOCH = datetime.date(1970, 1, 1).toordinal()
+_COUNT = struct.Struct('<I')
+_DTYPES = {'int64': '<i8', 'int32': '<i4', 'float64': '<f8', 'date': '<i4', 'time': '<i4'}
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def csv_chunks(rows, columns=COLUMNS, batch_size=5000):
+    """
+    Yield CSV text of ``rows``, header first, one chunk per ``batch_size``
+    rows.
+    """
+    names = [name for name, _ in columns]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(names)
+    for batch in _batches(rows, batch_size):
+        for row in batch:
+            writer.writerow(['' if row[name] is None else
+                             row[name].isoformat() if kind in ('date', 'time') else row[name]
+                             for name, kind in columns])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _code_dtype(distinct):
+    return np.dtype(np.uint8 if distinct <= 256 else '<i4')
+
+
+def _encode(values, kind):
+    valid = np.array([value is not None for value in values], dtype=bool)
+    parts = [np.packbits(valid).tobytes()]
+    if kind == 'str':
+        codes = {}
+        for value in values:
+            codes.setdefault(value if value is not None else '', len(codes))
+        encoded = [value.encode() for value in codes]
+        parts.append(_COUNT.pack(len(encoded)))
+        parts.append(np.cumsum([len(value) for value in encoded], dtype='<i4').tobytes())
+        parts.append(b''.join(encoded))
+        parts.append(np.array([codes[value if value is not None else ''] for value in values],
+                              dtype=_code_dtype(len(codes))).tobytes())
+    else:
+        if kind == 'date':
+            values = [value.toordinal() - _EPOCH if value is not None else 0 for value in values]
+        elif kind == 'time':
+            values = [value.hour * 3600 + value.minute * 60 + value.second if value is not None else 0
+                      for value in values]
+        else:
+            values = [value if value is not None else 0 for value in values]
+        parts.append(np.array(values, dtype=_DTYPES[kind]).tobytes())
+    return b''.join(parts)
+
+
+def column_chunks(rows, columns=COLUMNS, batch_size=5000):
+    """
+    Yield the columnar encoding of ``rows``, one chunk per ``batch_size``
+    rows.
+    """
+    yield MAGIC + json.dumps({'columns': [list(column) for column in columns]}).encode() + b'\n'
+    for batch in _batches(rows, batch_size):
+        parts = [_COUNT.pack(len(batch))]
+        for name, kind in columns:
+            parts.append(_encode([row[name] for row in batch], kind))
+        yield b''.join(parts)
+    yield _COUNT.pack(0)
+
+
+def _read(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError('truncated column stream')
+    return data
+
+
+def read_columns(f):
+    """
+    Yield the batches of a columnar stream read from the file object ``f``
+    as dicts of column name -> numpy masked array. Dates come back as
+    datetime64[D], times as timedelta64[s] and strings as object arrays.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a column stream')
+    columns = json.loads(f.readline())['columns']
+    while True:
+        count = _COUNT.unpack(_read(f, _COUNT.size))[0]
+        if not count:
+            return
+        batch = {}
+        for name, kind in columns:
+            valid = np.unpackbits(np.frombuffer(_read(f, (count + 7) // 8), dtype=np.uint8))[:count].astype(bool)
+            if kind == 'str':
+                distinct = _COUNT.unpack(_read(f, _COUNT.size))[0]
+                ends = np.frombuffer(_read(f, 4 * distinct), dtype='<i4')
+                data = _read(f, int(ends[-1]))
+                starts = np.concatenate(([0], ends[:-1]))
+                strings = np.array([data[start:end].decode() for start, end in zip(starts, ends)], dtype=object)
+                dtype = _code_dtype(distinct)
+                values = strings[np.frombuffer(_read(f, dtype.itemsize * count), dtype=dtype)]
+            else:
+                dtype = np.dtype(_DTYPES[kind])
+                values = np.frombuffer(_read(f, dtype.itemsize * count), dtype=dtype)
+                if kind == 'date':
+                    values = values.astype('datetime64[D]')
+                elif kind == 'time':
+                    values = values.astype('timedelta64[s]')
+            batch[name] = np.ma.masked_array(values, mask=~valid)
+        yield batch
+
+
+def gzip_chunks(chunks, level=6):
+    """
+    Gzip compress a stream of text or bytes chunks as it goes.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.flush()
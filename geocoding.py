@@ -0,0 +1,197 @@
+"""
+Geocoding of building addresses.
+
+Lookups go through a Geocoder, which checks an in-memory LRU and then a
+persistent SQLite cache keyed by the normalized address before asking the
+provider. Addresses the provider cannot place are cached too, so they are
+not looked up again until the cache's ``not_found_ttl`` passes. submit() runs the lookup on a small worker pool and
+hands the result to a callback, so request handlers never wait on the
+network.
+
+Providers are objects with a ``geocode(address)`` method returning
+``(lat, lng)`` or None: NominatimProvider queries OpenStreetMap through
+geopy, OfflineProvider answers from a dict and never touches the network.
+"""
+import collections
+import logging
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# cached value of addresses the provider could not place
+NOT_FOUND = (None, None)
+
+
+def normalize_address(address):
+    """
+    Cache key of an address: lower case, punctuation dropped, whitespace
+    collapsed.
+    """
+    return ' '.join(re.sub(r'[^\w\s]', ' ', address.lower()).split())
+
+
+class NominatimProvider(object):
+
+    def __init__(self, user_agent, timeout=10):
+        from geopy.geocoders import Nominatim
+        self._geolocator = Nominatim(user_agent=user_agent, timeout=timeout)
+
+    def geocode(self, address):
+        location = self._geolocator.geocode(address)
+        if location is None:
+            return None
+        return location.latitude, location.longitude
+
+
+class OfflineProvider(object):
+    """
+    Answers from ``locations``, a dict of address to ``(lat, lng)``, and
+    ``default`` for anything else.
+    """
+
+    def __init__(self, locations=None, default=None):
+        self.locations = dict((normalize_address(address), value)
+                              for address, value in (locations or {}).items())
+        self.default = default
+        self.lookups = 0
+
+    def geocode(self, address):
+        self.lookups += 1
+        return self.locations.get(normalize_address(address), self.default)
+
+
+class GeocodeCache(object):
+    """
+    Persistent address -> ``(lat, lng)`` store in its own SQLite file, with
+    the ``size`` most recently used entries also kept in memory. NOT_FOUND
+    entries expire after ``not_found_ttl`` seconds, if given.
+    """
+
+    def __init__(self, path, size=1024, not_found_ttl=None):
+        self.path = path
+        self.size = size
+        self.not_found_ttl = not_found_ttl
+        self._lru = collections.OrderedDict()
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS geocode ('
+                               'address TEXT PRIMARY KEY, lat REAL, lng REAL, looked_up_at REAL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _remember(self, key, value, looked_up_at):
+        self._lru[key] = (value, looked_up_at)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    def _fresh(self, value, looked_up_at):
+        if value == NOT_FOUND and self.not_found_ttl is not None:
+            return looked_up_at is not None and time.time() - looked_up_at <= self.not_found_ttl
+        return True
+
+    def get(self, key):
+        """
+        Cached ``(lat, lng)`` of a normalized address, NOT_FOUND if the
+        provider could not place it, or None if it was never looked up or
+        its NOT_FOUND expired.
+        """
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                value, looked_up_at = self._lru[key]
+                return value if self._fresh(value, looked_up_at) else None
+        with self._connect() as connection:
+            row = connection.execute('SELECT lat, lng, looked_up_at FROM geocode WHERE address = ?',
+                                     (key,)).fetchone()
+        if row is None:
+            return None
+        value, looked_up_at = tuple(row[:2]), row[2]
+        with self._lock:
+            self._remember(key, value, looked_up_at)
+        return value if self._fresh(value, looked_up_at) else None
+
+    def put(self, key, value):
+        value = value or NOT_FOUND
+        looked_up_at = time.time()
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)',
+                               (key, value[0], value[1], looked_up_at))
+        with self._lock:
+            self._remember(key, value, looked_up_at)
+
+
+class Geocoder(object):
+
+    def __init__(self, provider, cache, workers=2):
+        self.provider = provider
+        self.cache = cache
+        self.workers = workers
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def cached(self, address):
+        """
+        ``(lat, lng)`` of an address if it is cached, NOT_FOUND if it is
+        cached as unknown, None if it has to be looked up.
+        """
+        return self.cache.get(normalize_address(address))
+
+    def lookup(self, address):
+        """
+        Blocking lookup; ``(lat, lng)``, or None if the provider cannot place
+        the address.
+        """
+        key = normalize_address(address)
+        value = self.cache.get(key)
+        if value is None:
+            value = self.provider.geocode(address) or NOT_FOUND
+            self.cache.put(key, value)
+        return None if value == NOT_FOUND else value
+
+    def submit(self, address, callback):
+        """
+        Look the address up on the worker pool and call ``callback`` with the
+        result of lookup(). Concurrent submissions of the same address share
+        one provider request. Provider errors are logged and leave the
+        address uncached, so it is retried next time.
+        """
+        key = normalize_address(address)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            future = self._pending.get(key)
+            if future is None:
+                future = self._executor.submit(self.lookup, address)
+                self._pending[key] = future
+                future.add_done_callback(lambda _: self._finished(key))
+
+        def done(future):
+            try:
+                result = future.result()
+            except Exception:
+                log.exception('geocoding %r failed', address)
+                return
+            try:
+                callback(result)
+            except Exception:
+                log.exception('geocoding callback for %r failed', address)
+
+        future.add_done_callback(done)
+        return future
+
+    def _finished(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
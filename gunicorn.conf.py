@@ -0,0 +1,11 @@
+# Gunicorn settings, read when gunicorn is started from this directory (see
+# wsgi.py). Each /api/events stream holds a worker thread for as long as it
+# is open, so workers serve requests on a pool of GREENBUILDING_THREADS
+# threads; config_production.py keeps the streams a process accepts well
+# below that.
+import os
+
+bind = os.environ.get('GREENBUILDING_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GREENBUILDING_WORKERS', 4))
+worker_class = 'gthread'
+threads = int(os.environ.get('GREENBUILDING_THREADS', 64))
@@ -0,0 +1,172 @@
+"""
+Parsing and validation of sensor readings pushed by cluster nodes.
+
+A batch is either a JSON array of readings (or an object with a
+``readings`` array) or newline-delimited JSON, one reading per line:
+
+    {"sensor_id": 4, "temperature": 21.5, "status": "ON",
+     "timestamp": "2018-05-01T13:45:00"}
+
+``date`` and ``time`` may be sent instead of ``timestamp``; timestamps with
+a UTC offset are stored in the server's local time, like naive ones.
+``cluster_id`` defaults to the one given for the whole batch. Building,
+floor and room come from the cluster and sensor nodes; a reading that gives
+a different floor or room is rejected.
+"""
+import datetime
+import json
+import logging
+import math
+
+STATUSES = ('ON', 'OFF')
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonlines', 'application/x-jsonlines')
+
+log = logging.getLogger(__name__)
+
+_listeners = []
+
+
+class IngestError(ValueError):
+    pass
+
+
+def on_ingest(listener):
+    """
+    Register a callable run with the list of row dicts of every committed
+    batch. Usable as a decorator. The batch is stored by then, so a listener
+    that fails is logged and does not stop the others.
+    """
+    _listeners.append(listener)
+    return listener
+
+
+def notify(rows):
+    for listener in _listeners:
+        try:
+            listener(rows)
+        except Exception:
+            log.exception('ingest listener %r failed', listener)
+
+
+def parse_ndjson(body):
+    readings = []
+    for number, line in enumerate(body.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            readings.append(json.loads(line))
+        except ValueError:
+            raise IngestError('line %d is not valid JSON' % number)
+    return readings
+
+
+def unwrap(payload):
+    """
+    Readings of an already decoded JSON body, either a bare array or an
+    object with a ``readings`` array.
+    """
+    if isinstance(payload, dict):
+        payload = payload.get('readings')
+    if not isinstance(payload, list):
+        raise IngestError('expected a list of readings')
+    return payload
+
+
+def referenced_ids(readings, default_cluster_id=None):
+    """
+    Sets of the sensor and cluster ids a batch refers to, for looking them up
+    in one query each. Malformed ids are left for validate() to report.
+    """
+    sensor_ids, cluster_ids = set(), set()
+    for reading in readings:
+        if not isinstance(reading, dict):
+            continue
+        for key, ids in (('sensor_id', sensor_ids), ('cluster_id', cluster_ids)):
+            value = reading.get(key, default_cluster_id if key == 'cluster_id' else None)
+            try:
+                ids.add(int(value))
+            except (TypeError, ValueError):
+                pass
+    return sensor_ids, cluster_ids
+
+
+def _parse_timestamp(reading):
+    if 'timestamp' in reading:
+        value = str(reading['timestamp']).strip()
+        if value[-1:] in ('Z', 'z'):
+            value = value[:-1] + '+00:00'
+        try:
+            timestamp = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise IngestError('timestamp %r is not an ISO 8601 date and time' % value)
+        if timestamp.tzinfo is not None:
+            try:
+                timestamp = timestamp.astimezone().replace(tzinfo=None)
+            except (OverflowError, ValueError):
+                raise IngestError('timestamp %r cannot be converted to local time' % value)
+        return timestamp
+    date = datetime.datetime.strptime(str(reading['date']), '%Y-%m-%d').date()
+    time = datetime.time.fromisoformat(str(reading['time']))
+    return datetime.datetime.combine(date, time)
+
+
+def validate(readings, clusters, sensors, default_cluster_id=None, remote_addr=None, only_cluster_id=None):
+    """
+    Turn raw readings into SensorData row dicts.
+
+    ``clusters`` and ``sensors`` map ids to the ClusterNode/SensorNode rows the
+    batch refers to. When ``remote_addr`` is given, every cluster must have
+    that IP, and when ``only_cluster_id`` is, every reading must be for that
+    cluster. Returns ``(rows, errors)``; errors are ``{'index', 'error'}`` dicts
+    and the batch should be rejected if there are any.
+    """
+    rows, errors = [], []
+    for index, reading in enumerate(readings):
+        try:
+            if not isinstance(reading, dict):
+                raise IngestError('reading must be an object')
+            cluster_id = reading.get('cluster_id', default_cluster_id)
+            if cluster_id is None:
+                raise KeyError('cluster_id')
+            cluster_id = int(cluster_id)
+            sensor_id = int(reading['sensor_id'])
+            cluster = clusters.get(cluster_id)
+            if cluster is None:
+                raise IngestError('unknown cluster %d' % cluster_id)
+            if remote_addr is not None and cluster.ip != remote_addr:
+                raise IngestError('cluster %d does not have ip %s' % (cluster_id, remote_addr))
+            if only_cluster_id is not None and cluster_id != only_cluster_id:
+                raise IngestError('token not valid for cluster %d' % cluster_id)
+            sensor = sensors.get(sensor_id)
+            if sensor is None:
+                raise IngestError('unknown sensor %d' % sensor_id)
+            if sensor.cluster_id != cluster_id:
+                raise IngestError('sensor %d is not on cluster %d' % (sensor_id, cluster_id))
+            status = reading.get('status', 'ON')
+            if status not in STATUSES:
+                raise IngestError('status must be ON or OFF')
+            timestamp = _parse_timestamp(reading)
+            temperature = float(reading['temperature'])
+            if not math.isfinite(temperature):
+                raise IngestError('temperature must be a finite number')
+            floor = sensor.floor if sensor.floor is not None else cluster.floor
+            if 'floor' in reading and str(reading['floor']) != str(floor):
+                raise IngestError('sensor %d is on floor %s' % (sensor_id, floor))
+            if 'room' in reading and str(reading['room']) != str(sensor.room):
+                raise IngestError('sensor %d is in room %s' % (sensor_id, sensor.room))
+            rows.append({
+                'sensor_id': sensor_id,
+                'building_id': cluster.building_id,
+                'cluster_id': cluster_id,
+                'temperature': temperature,
+                'floor': floor,
+                'room': sensor.room,
+                'date': timestamp.date(),
+                'time': timestamp.time(),
+                'status': status,
+            })
+        except KeyError as e:
+            errors.append({'index': index, 'error': 'missing %s' % e.args[0]})
+        except (TypeError, ValueError) as e:
+            errors.append({'index': index, 'error': str(e)})
+    return rows, errors
@@ -0,0 +1,163 @@
+"""
+Bounded in-process write-behind queue for ingested readings.
+
+Request handlers put validated rows on the queue and return straight away; a
+single writer thread drains it into the database in batches, flushing when
+``batch_size`` rows are waiting or ``flush_interval`` seconds after the
+oldest waiting row arrived, whichever comes first. When the queue is full
+producers are either rejected at once or blocked for up to ``put_timeout``
+seconds, after which they are rejected too.
+
+Queued rows have already been acknowledged, so a batch that fails to write
+(e.g. on a locked database) goes back to the front of the queue and is
+retried after a delay that doubles from ``retry_delay`` up to
+``max_retry_delay`` seconds.
+"""
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class WriteBehindQueue(object):
+
+    def __init__(self, flush, maxsize=100000, batch_size=5000, flush_interval=0.5,
+                 block=False, put_timeout=5.0, retry_delay=0.5, max_retry_delay=30.0):
+        self.flush = flush
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self.put_timeout = put_timeout
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._rows = collections.deque()
+        # [arrival time, rows left] of every put still in the queue
+        self._arrivals = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._stats = {
+            'enqueued': 0, 'written': 0, 'rejected': 0, 'retried': 0, 'batches': 0,
+            'batch_seconds_total': 0.0, 'batch_seconds_max': 0.0, 'batch_seconds_last': 0.0,
+        }
+
+    def start(self):
+        with self._cond:
+            if self._thread is None and not self._stopping:
+                self._thread = threading.Thread(target=self._run, name='ingest-writer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def put(self, rows):
+        """
+        Queue rows for writing, raising QueueFull if there is no room for the
+        whole batch.
+        """
+        if len(rows) > self.maxsize:
+            raise QueueFull('batch larger than the queue')
+        self.start()
+        with self._cond:
+            if self.block:
+                deadline = time.monotonic() + self.put_timeout
+                while len(self._rows) + len(rows) > self.maxsize and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            if self._stopping or len(self._rows) + len(rows) > self.maxsize:
+                self._stats['rejected'] += len(rows)
+                raise QueueFull('ingest queue is closed' if self._stopping else 'ingest queue is full')
+            if rows:
+                self._arrivals.append([time.monotonic(), len(rows)])
+            self._rows.extend(rows)
+            self._stats['enqueued'] += len(rows)
+            self._cond.notify_all()
+
+    def stop(self, timeout=30):
+        """
+        Flush everything still queued and stop the writer thread. The queue
+        rejects new rows from then on.
+        """
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            if self._rows:
+                log.error('%d queued readings were not written before stopping', len(self._rows))
+
+    def metrics(self):
+        with self._cond:
+            metrics = dict(self._stats)
+            metrics['depth'] = len(self._rows)
+            metrics['maxsize'] = self.maxsize
+        batches = metrics['batches']
+        metrics['batch_seconds_avg'] = metrics['batch_seconds_total'] / batches if batches else 0.0
+        return metrics
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._rows:
+                    waited = time.monotonic() - self._arrivals[0][0]
+                    if self._stopping or len(self._rows) >= self.batch_size or waited >= self.flush_interval:
+                        break
+                    self._cond.wait(self.flush_interval - waited)
+                elif self._stopping:
+                    return None
+                else:
+                    self._cond.wait()
+            count = min(self.batch_size, len(self._rows))
+            batch = [self._rows.popleft() for _ in range(count)]
+            arrived = self._arrivals[0][0]
+            while count:
+                taken = min(count, self._arrivals[0][1])
+                self._arrivals[0][1] -= taken
+                count -= taken
+                if not self._arrivals[0][1]:
+                    self._arrivals.popleft()
+            self._cond.notify_all()
+            return batch, arrived
+
+    def _requeue(self, batch, arrived):
+        # ahead of everything queued since; may go past maxsize, which only
+        # holds new rows back
+        with self._cond:
+            self._rows.extendleft(reversed(batch))
+            self._arrivals.appendleft([arrived, len(batch)])
+
+    def _run(self):
+        delay = 0
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            batch, arrived = batch
+            started = time.perf_counter()
+            try:
+                self.flush(batch)
+                failed = False
+                delay = 0
+            except Exception:
+                delay = min(max(delay * 2, self.retry_delay), self.max_retry_delay)
+                log.exception('failed to write %d queued readings, retrying in %.1fs', len(batch), delay)
+                self._requeue(batch, arrived)
+                failed = True
+            elapsed = time.perf_counter() - started
+            with self._cond:
+                self._stats['retried' if failed else 'written'] += len(batch)
+                self._stats['batches'] += 1
+                self._stats['batch_seconds_total'] += elapsed
+                self._stats['batch_seconds_last'] = elapsed
+                self._stats['batch_seconds_max'] = max(self._stats['batch_seconds_max'], elapsed)
+            if failed:
+                time.sleep(delay)
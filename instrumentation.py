@@ -0,0 +1,221 @@
+"""
+Request instrumentation.
+
+For every request this records the wall time, the number and total time of
+the SQL statements it ran, the rows they fetched and the size of the
+response. The figures are sent back in a Server-Timing header, so browser dev
+tools show them next to each request, and accumulated per endpoint for a
+Prometheus text-format /metrics page. Statements slower than a threshold are
+logged with a fingerprint (the statement with its literals and IN lists
+folded), so repeats of the same query can be grouped.
+
+Statements are timed with engine events on every Engine, shard engines
+included. The per-statement work is a couple of clock reads and dict
+updates; fingerprints are only computed for slow statements.
+"""
+import collections
+import hashlib
+import logging
+import re
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+slow_log = logging.getLogger(__name__ + '.slow_queries')
+
+# request duration histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    """
+    ``(id, normalized statement)``: literals become ``?``, IN lists ``(?+)``
+    and whitespace is collapsed; id is a short hash of the result.
+    """
+    normalized = _SPACES.sub(' ', statement).strip()
+    normalized = _IN_LISTS.sub('(?+)', _LITERALS.sub('?', normalized))
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12], normalized
+
+
+class CountingCursor(object):
+    """
+    DB-API cursor wrapper adding the rows fetched through it to ``stats``.
+    """
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats['rows'] += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._stats['rows'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats['rows'] += len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _Endpoint(object):
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.db_seconds = 0.0
+        self.queries = 0
+        self.rows = 0
+        self.response_bytes = 0
+
+
+class Instrumentation(object):
+
+    def __init__(self, slow_query_ms=250, server_timing=True, max_fingerprints=500):
+        self.slow_query_seconds = slow_query_ms / 1000.0
+        self.server_timing = server_timing
+        self.max_fingerprints = max_fingerprints
+        self._lock = threading.Lock()
+        self._endpoints = collections.defaultdict(_Endpoint)
+        self._statements = 0
+        self._statement_seconds = 0.0
+        self._slow = collections.OrderedDict()
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _before_request(self):
+        g.instrumentation = {'started': time.perf_counter(), 'queries': 0, 'db_seconds': 0.0, 'rows': 0}
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # a connection runs one statement at a time; the start of one that
+        # failed is replaced by the next one's
+        conn.info['statement_started'] = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop('statement_started')
+        stats = g.get('instrumentation') if has_request_context() else None
+        if stats is not None:
+            stats['queries'] += 1
+            stats['db_seconds'] += elapsed
+            # the result object reads from context.cursor, which is created
+            # after this event
+            if context is not None and cursor.description is not None:
+                context.cursor = CountingCursor(cursor, stats)
+        with self._lock:
+            self._statements += 1
+            self._statement_seconds += elapsed
+        if elapsed >= self.slow_query_seconds:
+            self._record_slow(statement, elapsed)
+
+    def _record_slow(self, statement, elapsed):
+        key, normalized = fingerprint(statement)
+        endpoint = request.endpoint if has_request_context() else None
+        slow_log.warning('slow query %s %.1fms (%s): %s', key, elapsed * 1000, endpoint or '-', normalized)
+        with self._lock:
+            count, seconds, _ = self._slow.pop(key, (0, 0.0, None))
+            self._slow[key] = (count + 1, seconds + elapsed, normalized)
+            while len(self._slow) > self.max_fingerprints:
+                self._slow.popitem(last=False)
+
+    def _after_request(self, response):
+        stats = g.pop('instrumentation', None)
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats['started']
+        # calculate_content_length() would drain a streamed body
+        size = None if response.is_streamed else response.calculate_content_length()
+        if self.server_timing:
+            response.headers.add('Server-Timing', 'app;dur=%.1f, db;dur=%.1f;desc="%d queries, %d rows"' % (
+                elapsed * 1000, stats['db_seconds'] * 1000, stats['queries'], stats['rows']))
+        key = (request.endpoint or 'unmatched', request.method, response.status_code)
+        with self._lock:
+            endpoint = self._endpoints[key]
+            for i, bound in enumerate(BUCKETS):
+                if elapsed <= bound:
+                    endpoint.buckets[i] += 1
+            endpoint.count += 1
+            endpoint.seconds += elapsed
+            endpoint.db_seconds += stats['db_seconds']
+            endpoint.queries += stats['queries']
+            endpoint.rows += stats['rows']
+            endpoint.response_bytes += size or 0
+        return response
+
+    def slow_queries(self):
+        """
+        ``(fingerprint, count, seconds, statement)`` of the slow statements
+        seen, slowest in total first.
+        """
+        with self._lock:
+            found = [(key,) + value for key, value in self._slow.items()]
+        return sorted(found, key=lambda item: -item[2])
+
+    def render_metrics(self, extra=()):
+        """
+        Prometheus text exposition of the collected metrics; ``extra`` adds
+        ``(name, help, value)`` gauges.
+        """
+        with self._lock:
+            endpoints = [(key, vars(value).copy()) for key, value in sorted(self._endpoints.items())]
+            statements, statement_seconds = self._statements, self._statement_seconds
+            slow = [(key,) + value for key, value in self._slow.items()]
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, labels, repr(value) if isinstance(value, float) else value))
+
+        def labels(key, **more):
+            pairs = [('endpoint', key[0]), ('method', key[1]), ('status', key[2])] + sorted(more.items())
+            return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('"', '\\"')) for name, value in pairs)
+
+        histogram = []
+        for key, values in endpoints:
+            for bound, count in zip(BUCKETS, values['buckets']):
+                histogram.append((labels(key, le=bound), count))
+            histogram.append((labels(key, le='+Inf'), values['count']))
+        lines.append('# HELP http_request_duration_seconds Request wall time.')
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        for label, value in histogram:
+            lines.append('http_request_duration_seconds_bucket%s %d' % (label, value))
+        for key, values in endpoints:
+            lines.append('http_request_duration_seconds_sum%s %r' % (labels(key), values['seconds']))
+            lines.append('http_request_duration_seconds_count%s %d' % (labels(key), values['count']))
+
+        for name, field, help in (
+                ('http_request_db_seconds_total', 'db_seconds', 'Time spent in SQL statements.'),
+                ('http_request_queries_total', 'queries', 'SQL statements run.'),
+                ('http_request_rows_fetched_total', 'rows', 'Rows fetched by SQL statements.'),
+                ('http_response_bytes_total', 'response_bytes', 'Response bytes, streamed bodies excluded.')):
+            metric(name, 'counter', help, [(labels(key), values[field]) for key, values in endpoints])
+        metric('db_statements_total', 'counter', 'SQL statements run by the process.', [('', statements)])
+        metric('db_statement_seconds_total', 'counter', 'Time spent in SQL statements by the process.',
+               [('', statement_seconds)])
+        metric('db_slow_queries_total', 'counter', 'Statements slower than the slow query threshold.',
+               [('{fingerprint="%s"}' % key, count) for key, count, _, _ in slow])
+        for name, help, value in extra:
+            metric(name, 'gauge', help, [('', value)])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,67 @@
+"""
+Metered sensor usage for billing.
+
+The billable unit is the sensor-hour: an hour in which a sensor sent at
+least one reading with status ON. Every sensor's hours of a day are kept as
+a 24-bit mask. Metering ORs the hours of new readings into those masks, so a
+reading repeated or seen twice never bills an hour twice. The hours a
+reading turns on are added to a per building, per day total. Invoices only
+sum those daily totals, however many readings or sensors there were.
+
+New readings are found by id: the meter remembers the highest reading id it
+has processed (its watermark) and only reads past it.
+"""
+import collections
+
+
+def hour_masks(rows):
+    """
+    ``{(sensor_id, building_id, date): mask}`` of the hours in which each
+    sensor reported ON. Readings without a sensor are not billable.
+    """
+    masks = collections.defaultdict(int)
+    for row in rows:
+        if row['status'] == 'ON' and row['sensor_id'] is not None:
+            masks[(row['sensor_id'], row['building_id'], row['date'])] |= 1 << row['time'].hour
+    return masks
+
+
+def hours(mask):
+    return bin(mask).count('1')
+
+
+def merge(masks, existing):
+    """
+    Fold new hour ``masks`` into the ``existing`` ones (same keys, missing
+    when a sensor has no hours that day yet). Returns the changed masks and
+    ``{(building_id, date): hours}`` of the hours billed for the first time.
+    """
+    changed = {}
+    added = collections.defaultdict(int)
+    for key, mask in masks.items():
+        old = existing.get(key, 0)
+        new = mask & ~old
+        if new:
+            changed[key] = old | new
+            added[(key[1], key[2])] += hours(new)
+    return changed, added
+
+
+def invoice_lines(usage, buildings, rate):
+    """
+    Invoice lines of ``(building_id, sensor_hours)`` usage, priced at
+    ``rate`` per sensor-hour and grouped by owner. ``buildings`` maps ids to
+    ``(name, owner)``. Returns ``(owner, lines, sensor_hours, amount)``
+    tuples sorted by owner, lines being ``(building_id, name, sensor_hours,
+    amount)``.
+    """
+    by_owner = collections.defaultdict(list)
+    for building_id, sensor_hours in usage:
+        name, owner = buildings.get(building_id, (None, None))
+        by_owner[owner or ''].append((building_id, name, sensor_hours, round(sensor_hours * rate, 2)))
+    invoices = []
+    for owner in sorted(by_owner):
+        lines = sorted(by_owner[owner], key=lambda line: (line[0] is None, line[0] or 0))
+        total = sum(line[2] for line in lines)
+        invoices.append((owner, lines, total, round(total * rate, 2)))
+    return invoices
@@ -0,0 +1,113 @@
+"""
+Batches of typed topology operations for the map view.
+
+A batch is a JSON array of operations (or an object with an ``operations``
+array), each naming its ``op`` and its fields:
+
+    [{"op": "add_cluster", "building_id": 3, "floor": 4, "ip": "10.0.4.1"},
+     {"op": "add_sensor", "building_id": 3, "floor": 4,
+      "cluster_ip": "10.0.4.1", "sensor_ip": "10.0.4.17", "room": "401"}]
+
+Clusters and sensors are addressed the way the map view forms address them:
+a cluster by building, floor and IP, a sensor by its cluster and its own IP.
+Every operation is validated before any of them runs, and the batch is
+applied in a single transaction, so it either succeeds as a whole or leaves
+nothing behind.
+"""
+
+# op -> (required fields, optional fields)
+OPERATIONS = {
+    'add_building': (('building_name', 'address', 'city', 'state', 'zip'), ()),
+    'edit_building': (('building_id',), ('new_name', 'address', 'city', 'state', 'zip')),
+    'remove_building': (('building_id',), ()),
+    'add_cluster': (('building_id', 'floor', 'ip'), ()),
+    'edit_cluster': (('building_id', 'floor', 'ip'), ('new_building_id', 'new_floor', 'new_ip')),
+    'remove_cluster': (('building_id', 'floor', 'ip'), ()),
+    'add_sensor': (('building_id', 'cluster_ip', 'sensor_ip'), ('floor', 'room', 'status', 'type')),
+    'edit_sensor': (('building_id', 'floor', 'cluster_ip', 'sensor_ip'),
+                    ('new_building_id', 'new_floor', 'new_cluster_ip', 'new_sensor_ip', 'status')),
+    'remove_sensor': (('building_id', 'floor', 'cluster_ip', 'sensor_ip'), ()),
+    'get_cluster': (('building_id',), ()),
+    'get_sensor': (('cluster_id',), ()),
+}
+READ_ONLY = ('get_cluster', 'get_sensor')
+STATUSES = ('ON', 'OFF')
+
+
+class OperationError(ValueError):
+    pass
+
+
+class Batch(object):
+    """
+    State shared by the operations of one batch: lookups already made and
+    callables to run once the transaction has committed.
+    """
+
+    def __init__(self):
+        self.cache = {}
+        self.after_commit = []
+
+
+def unwrap(payload):
+    """
+    Operations of an already decoded JSON body, either a bare array or an
+    object with an ``operations`` array.
+    """
+    if isinstance(payload, dict):
+        payload = payload.get('operations')
+    if not isinstance(payload, list):
+        raise OperationError('expected a list of operations')
+    return payload
+
+
+def _coerce(name, value, column):
+    python_type = column.type.python_type
+    try:
+        if python_type is int and (isinstance(value, bool) or isinstance(value, float) and not value.is_integer()):
+            raise ValueError
+        value = python_type(value)
+    except (TypeError, ValueError):
+        raise OperationError('%s must be %s' % (name, 'an integer' if python_type is int else 'a string'))
+    length = getattr(column.type, 'length', None)
+    if length is not None and len(value) > length:
+        raise OperationError('%s is longer than %d characters' % (name, length))
+    return value
+
+
+def validate(operations, columns):
+    """
+    Check raw operations against OPERATIONS and coerce every field to the
+    type of the model column ``columns`` maps it to. Empty strings count as
+    missing, as browsers send them for blank inputs. Returns ``(parsed,
+    errors)``: parsed is a list of ``(op, fields)`` pairs and errors are
+    ``{'index', 'error'}`` dicts.
+    """
+    parsed, errors = [], []
+    for index, operation in enumerate(operations):
+        try:
+            if not isinstance(operation, dict):
+                raise OperationError('operation must be an object')
+            op = operation.get('op')
+            if op not in OPERATIONS:
+                raise OperationError('unknown op %r' % (op,))
+            required, optional = OPERATIONS[op]
+            unknown = set(operation) - set(required) - set(optional) - {'op'}
+            if unknown:
+                raise OperationError('unexpected fields %s' % ', '.join(sorted(unknown)))
+            fields = {}
+            for name in required + optional:
+                value = operation.get(name)
+                if value is None or value == '':
+                    if name in required:
+                        raise KeyError(name)
+                    continue
+                fields[name] = _coerce(name, value, columns[name])
+            if fields.get('status', 'ON') not in STATUSES:
+                raise OperationError('status must be ON or OFF')
+            parsed.append((op, fields))
+        except KeyError as e:
+            errors.append({'index': index, 'error': 'missing %s' % e.args[0]})
+        except (TypeError, ValueError) as e:
+            errors.append({'index': index, 'error': str(e)})
+    return parsed, errors
@@ -0,0 +1,221 @@
+"""
+Password hashing off the request threads, and device API tokens.
+
+PasswordHasher stands in for Flask-Security's passlib context. Passwords are
+hashed and verified on a pool of ``workers`` processes, so a burst of logins
+keeps at most that many cores busy with PBKDF2 while the web workers go on
+serving other requests. At most ``max_pending`` hashes wait or run per web
+worker; a login arriving past that waits up to ``timeout`` seconds for room
+and then gets HasherBusy. With ``workers=0`` hashing runs on the calling
+thread.
+
+The cost of each scheme comes from ``options``, e.g. ``{'pbkdf2_sha512':
+{'rounds': 210000}}``. Hashes made at a lower cost are reported by
+needs_update(), which Flask-Security answers by rehashing the password at
+the user's next login.
+
+Device tokens, for machine clients, look like ``<id>.<secret>``. Only the
+SHA-256 of the secret is stored. DeviceTokenCache finds a token by its id,
+compares digests with hmac.compare_digest and keeps the tokens it loaded for
+``max_age`` seconds, so an authenticated request costs one SHA-256 and a
+dict lookup rather than a password verify or a query.
+"""
+import collections
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from passlib.context import CryptContext
+
+log = logging.getLogger(__name__)
+
+
+class HasherBusy(Exception):
+    pass
+
+
+# context of a worker process, set up by _start_worker
+_worker_context = None
+
+
+def _start_worker(settings):
+    global _worker_context
+    _worker_context = CryptContext(**settings)
+
+
+def _hash(secret):
+    return _worker_context.hash(secret)
+
+
+def _verify(secret, hash):
+    return _worker_context.verify(secret, hash)
+
+
+def _pool_context():
+    # workers are forked from a fresh server process that only imported this
+    # module: forking a web worker that runs other threads could copy locks
+    # those threads hold, and spawning would import the app again
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return None
+
+
+class PasswordHasher(object):
+
+    def __init__(self, settings, options=None, workers=2, max_pending=64, timeout=10.0):
+        """
+        ``settings`` are CryptContext settings (schemes, default, deprecated)
+        to which the per scheme cost ``options`` are added.
+        """
+        settings = dict(settings)
+        for scheme, values in (options or {}).items():
+            for name, value in values.items():
+                if name == 'rounds':
+                    settings['%s__default_rounds' % scheme] = value
+                    settings['%s__min_rounds' % scheme] = value
+                else:
+                    settings['%s__%s' % (scheme, name)] = value
+        self.settings = settings
+        self.context = CryptContext(**settings)
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=_pool_context(),
+                                                     initializer=_start_worker, initargs=(self.settings,))
+            return self._executor
+
+    def _submit(self, function, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HasherBusy('too many passwords being hashed, try again shortly')
+        try:
+            pool = self._pool()
+            try:
+                return pool.submit(function, *args).result()
+            except BrokenProcessPool:
+                log.exception('password hashing pool died, restarting it')
+                with self._lock:
+                    if self._executor is pool:
+                        self._executor = None
+                return self._pool().submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, secret, **kwds):
+        # the options hash_password() passes are already in the context
+        if not self.workers:
+            return self.context.hash(secret)
+        return self._submit(_hash, secret)
+
+    def verify(self, secret, hash):
+        if not self.workers:
+            return self.context.verify(secret, hash)
+        return self._submit(_verify, secret, hash)
+
+    def hash_many(self, values):
+        """
+        Hash several secrets at once on all the workers, for batch jobs
+        such as seeding a database; not bounded by ``max_pending``.
+        """
+        if not self.workers:
+            return [self.context.hash(secret) for secret in values]
+        return list(self._pool().map(_hash, values))
+
+    def needs_update(self, hash):
+        return self.context.needs_update(hash)
+
+    def identify(self, hash):
+        return self.context.identify(hash)
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+def new_token_secret():
+    return secrets.token_urlsafe(32)
+
+
+def token_digest(secret):
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+def split_token(token):
+    """
+    ``(id, secret)`` of a device token, or None if it is malformed.
+    """
+    token_id, _, secret = (token or '').partition('.')
+    if not token_id.isdigit() or not secret:
+        return None
+    return int(token_id), secret
+
+
+class DeviceTokenCache(object):
+    """
+    Device tokens by id. ``load(id)`` returns the token's record, anything
+    with a ``digest`` attribute, or None if there is no usable token with
+    that id; unknown ids are cached too. Entries expire after ``max_age``
+    seconds, so tokens revoked by another process stop working by then; at
+    most ``size`` are kept.
+    """
+
+    def __init__(self, load, max_age=60, size=10000):
+        self.load = load
+        self.max_age = max_age
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def check(self, token):
+        """
+        The record of a valid token, None otherwise.
+        """
+        parts = split_token(token)
+        if parts is None:
+            return None
+        token_id, secret = parts
+        now = time.monotonic()
+        with self._lock:
+            generation = self._generation
+            entry = self._entries.get(token_id)
+            if entry is not None and now - entry[1] <= self.max_age:
+                self._entries.move_to_end(token_id)
+                record = entry[0]
+            else:
+                entry = None
+        if entry is None:
+            record = self.load(token_id)
+            with self._lock:
+                # not kept if a clear() came while loading: it may be stale
+                if generation == self._generation:
+                    self._entries[token_id] = (record, now)
+                    self._entries.move_to_end(token_id)
+                    while len(self._entries) > self.size:
+                        self._entries.popitem(last=False)
+        if record is None or not hmac.compare_digest(token_digest(secret), record.digest):
+            return None
+        return record
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
@@ -0,0 +1,90 @@
+"""
+Periodic background jobs.
+
+PeriodicWorker calls a function every ``interval`` seconds on a daemon
+thread. Jobs that must run once per deployment rather than once per server
+worker process, such as retention or metering, share a ProcessLock: each
+process starts the worker, but only the one holding the lock runs the job,
+and another one takes over at its next interval if that process exits.
+"""
+import fcntl
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class ProcessLock(object):
+    """
+    Exclusive lock on the file ``path``, held by one process at a time until
+    it exits. acquire() does not wait; it tells whether this process holds
+    the lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                return True
+            if self._file is not None:
+                # inherited from the process this one was forked from, which
+                # keeps the lock
+                self._file.close()
+                self._file = None
+            lock_file = open(self.path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._file, self._pid = lock_file, os.getpid()
+            return True
+
+
+class PeriodicWorker(object):
+    """
+    Calls ``run()`` every ``interval`` seconds on a daemon thread named
+    ``name``, skipping the runs while another process holds ``lock``.
+    Failures are logged and retried at the next interval. start() may be
+    called again at any time; a process forked from one running the worker
+    starts its own thread.
+    """
+
+    def __init__(self, run, interval, name, lock=None):
+        self.run = run
+        self.interval = interval
+        self.name = name
+        self.lock = lock
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._loop, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            if self.lock is not None and not self.lock.acquire():
+                continue
+            try:
+                self.run()
+            except Exception:
+                log.exception('%s run failed', self.name)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,19 @@
+"""
+Retention of raw sensor readings.
+
+Readings older than a building's retention period are first folded into the
+hourly, daily and monthly rollups and then deleted, so the raw table only
+holds recent readings while the history stays available at rollup
+resolution. Cutoffs fall on the first of a month, matching the widest rollup
+bucket, so a month is either kept in full or only kept as rollups.
+"""
+import datetime
+
+
+def cutoff(today, days):
+    """
+    First day of the month ``days`` days before ``today``: readings dated
+    before it have expired.
+    """
+    expired = today - datetime.timedelta(days=days)
+    return expired.replace(day=1)
@@ -0,0 +1,144 @@
+"""
+Time-bucketed temperature rollups of SensorData.
+
+Every reading is counted into an hourly, a daily and a monthly bucket of its
+sensor (keyed together with the sensor's building, floor and room), holding
+the reading count, the sum/min/max of the temperature and the number of ON
+readings. Range queries are split by plan() into the coarsest buckets that
+exactly cover each part of the range: whole months in the middle, whole days
+around them and hours at the ragged ends.
+"""
+import collections
+import datetime
+
+# coarsest first
+RESOLUTIONS = ('month', 'day', 'hour')
+INTERVALS = ('hour', 'day', 'month', 'year', 'total')
+KEY_COLUMNS = ('resolution', 'bucket', 'sensor_id', 'building_id', 'floor', 'room')
+
+
+def floor_to(resolution, value):
+    if resolution == 'hour':
+        return value.replace(minute=0, second=0, microsecond=0)
+    if resolution == 'day':
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if resolution == 'month':
+        return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if resolution == 'year':
+        return value.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError('unknown resolution %r' % resolution)
+
+
+def _next(resolution, value):
+    if resolution == 'hour':
+        return value + datetime.timedelta(hours=1)
+    if resolution == 'day':
+        return value + datetime.timedelta(days=1)
+    if value.month == 12:
+        return value.replace(year=value.year + 1, month=1)
+    return value.replace(month=value.month + 1)
+
+
+def ceil_to(resolution, value):
+    floored = floor_to(resolution, value)
+    return floored if floored == value else _next(resolution, floored)
+
+
+def plan(start, end, coarsest='month'):
+    """
+    Split the half-open range [start, end) into ``(resolution, start, end)``
+    segments, using the coarsest resolution whose buckets fit whole. Partial
+    hours at the ends are widened to whole hours. ``coarsest`` caps the
+    resolution, for callers that need points finer than a month.
+    """
+    levels = RESOLUTIONS[RESOLUTIONS.index(coarsest):]
+    segments = []
+
+    def split(seg_start, seg_end, level):
+        resolution = levels[level]
+        if level == len(levels) - 1:
+            segments.append((resolution, floor_to(resolution, seg_start), ceil_to(resolution, seg_end)))
+            return
+        first, last = ceil_to(resolution, seg_start), floor_to(resolution, seg_end)
+        if first < last:
+            if seg_start < first:
+                split(seg_start, first, level + 1)
+            segments.append((resolution, first, last))
+            if last < seg_end:
+                split(last, seg_end, level + 1)
+        else:
+            split(seg_start, seg_end, level + 1)
+
+    if start < end:
+        split(start, end, 0)
+    return segments
+
+
+def coarsest_for(interval):
+    """
+    The coarsest stored resolution a query for ``interval`` points may read.
+    """
+    if interval in ('hour', 'day'):
+        return interval
+    return 'month'
+
+
+def aggregate(rows):
+    """
+    Rollup deltas of raw reading dicts, keyed by KEY_COLUMNS values, as
+    ``[count, temp_sum, temp_min, temp_max, on_count]`` lists. Readings
+    without a temperature or timestamp are skipped.
+    """
+    deltas = {}
+    for row in rows:
+        temperature = row['temperature']
+        if temperature is None or row['date'] is None:
+            continue
+        timestamp = datetime.datetime.combine(row['date'], row['time'] or datetime.time())
+        on = 1 if row['status'] == 'ON' else 0
+        for resolution in RESOLUTIONS:
+            key = (resolution, floor_to(resolution, timestamp), row['sensor_id'],
+                   row['building_id'], row['floor'], row['room'])
+            delta = deltas.get(key)
+            if delta is None:
+                deltas[key] = [1, temperature, temperature, temperature, on]
+            else:
+                delta[0] += 1
+                delta[1] += temperature
+                delta[2] = min(delta[2], temperature)
+                delta[3] = max(delta[3], temperature)
+                delta[4] += on
+    return deltas
+
+
+def combine(groups, interval):
+    """
+    Fold ``(group, bucket, count, temp_sum, temp_min, temp_max, on_count)``
+    rows from any mix of resolutions into points per group at ``interval``.
+    Returns ``{group: [point, ...]}`` with points in bucket order.
+    """
+    merged = collections.OrderedDict()
+    for group, bucket, count, temp_sum, temp_min, temp_max, on_count in groups:
+        point_bucket = None if interval == 'total' else floor_to(interval, bucket)
+        points = merged.setdefault(group, {})
+        point = points.get(point_bucket)
+        if point is None:
+            points[point_bucket] = [count, temp_sum, temp_min, temp_max, on_count]
+        else:
+            point[0] += count
+            point[1] += temp_sum
+            point[2] = min(point[2], temp_min)
+            point[3] = max(point[3], temp_max)
+            point[4] += on_count
+    result = {}
+    for group, points in merged.items():
+        result[group] = [{
+            'bucket': bucket.isoformat() if bucket is not None else None,
+            'count': count,
+            'min': temp_min,
+            'max': temp_max,
+            'mean': temp_sum / count,
+            'on_ratio': float(on_count) / count,
+        } for bucket, (count, temp_sum, temp_min, temp_max, on_count)
+            in sorted(points.items(), key=lambda item: item[0] or datetime.datetime.min)]
+    return result
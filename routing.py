@@ -0,0 +1,227 @@
+"""
+Routing of the app session between the primary database and read replicas.
+
+Views decorated with ReadRouter.reads() send their SELECTs to a read
+replica and everything else to the primary. A session picks one replica
+and keeps it, so a request reads one snapshot. Once a session has written
+(a flush, or executing anything but a SELECT), its remaining reads go to the
+primary too, as do SELECT ... FOR UPDATE and everything outside requests,
+such as CLI commands and background workers.
+
+Replicas lag the primary, so after a user changes something, stick()
+records the time in their Flask session, which follows them to any worker.
+Their reads then stay on the primary until a replica has caught up: for a
+SQLite replica, until it is refreshed with a copy made after the change; for
+other replicas, whose lag is unknown, for ``sticky_seconds``. Code that folds
+primary writes into a cache must load that cache with on_primary().
+
+Replicas are SQLAlchemy URLs: server replicas kept in sync by the database,
+or SQLite files. SQLite replicas are opened read-only, and copy_sqlite()
+refreshes one from the primary.
+"""
+import contextlib
+import functools
+import itertools
+import os
+import sqlite3
+import tempfile
+import time
+from urllib.parse import quote
+
+from flask import g, has_request_context, session as flask_session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.expression import SelectBase
+
+WROTE_KEY = '_wrote_at'
+
+
+def sqlite_path(url, root_path='.'):
+    """
+    File of a SQLite URL, relative paths resolved against ``root_path`` the
+    way Flask-SQLAlchemy does; None for other databases or memory.
+    """
+    url = make_url(url)
+    if url.get_backend_name() != 'sqlite' or not url.database or url.database == ':memory:':
+        return None
+    return os.path.join(root_path, url.database)
+
+
+class ReplicaConnection(sqlite3.Connection):
+    """
+    Read-only connection to a SQLite replica.
+    """
+
+
+def replica_engine(url, root_path='.', **options):
+    """
+    Engine of a replica URL. SQLite files are opened read-only, with a new
+    connection per checkout so a refreshed copy is picked up right away.
+    """
+    path = sqlite_path(url, root_path)
+    if path is None:
+        return create_engine(url, **options)
+    uri = 'file:%s?mode=ro' % quote(os.path.abspath(path))
+    engine = create_engine('sqlite://', poolclass=NullPool,
+                           creator=lambda: sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                                           factory=ReplicaConnection))
+    engine.replica_path = path
+    return engine
+
+
+def synced_at(engine):
+    """
+    Time before which every commit to the primary is in the SQLite replica
+    ``engine`` (see copy_sqlite()); 0 if it was never copied, None for other
+    replicas.
+    """
+    path = getattr(engine, 'replica_path', None)
+    if path is None:
+        return None
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def copy_sqlite(source_path, target_path):
+    """
+    Replace the SQLite file ``target_path`` with a consistent copy of
+    ``source_path``. The copy is made with the backup API in a temporary
+    file of its own, which then replaces the target, so readers of the old
+    copy are never blocked and concurrent copies never mix. A WAL primary is
+    not blocked while it is copied. The copy's modification time is set to
+    when it started, which every commit before then is part of.
+    """
+    started = time.time()
+    fd, partial = tempfile.mkstemp(suffix='.partial', dir=os.path.dirname(os.path.abspath(target_path)))
+    os.close(fd)
+    try:
+        source = sqlite3.connect(source_path)
+        try:
+            target = sqlite3.connect(partial)
+            try:
+                source.backup(target)
+                # read-only connections cannot open a WAL file without its -shm
+                target.execute('PRAGMA journal_mode = DELETE')
+            finally:
+                target.close()
+        finally:
+            source.close()
+        os.utime(partial, (started, started))
+        os.replace(partial, target_path)
+    except BaseException:
+        os.remove(partial)
+        raise
+
+
+class ReadRouter(object):
+
+    def __init__(self, engines=(), sticky_seconds=10):
+        self.engines = list(engines)
+        self.sticky_seconds = sticky_seconds
+        self._next = itertools.count()
+
+    def reads(self, view):
+        """
+        Decorator of views whose reads may go to a replica.
+        """
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            g.read_replica = bool(self.engines)
+            g.wrote_at = flask_session.get(WROTE_KEY)
+            return view(*args, **kwargs)
+        return wrapper
+
+    def caught_up(self, engine, wrote_at):
+        """
+        Whether the replica ``engine`` has the current user's changes made
+        at ``wrote_at``.
+        """
+        if wrote_at is None:
+            return True
+        synced = synced_at(engine)
+        if synced is None:
+            return time.time() > wrote_at + self.sticky_seconds
+        return synced > wrote_at
+
+    def stick(self):
+        """
+        Keep the current user's reads on the primary until the replicas
+        have what they just changed.
+        """
+        if self.engines:
+            flask_session[WROTE_KEY] = time.time()
+
+    @contextlib.contextmanager
+    def primary(self):
+        """
+        Read from the primary inside the block.
+        """
+        if not has_request_context():
+            yield
+            return
+        previous = g.get('read_replica', False)
+        g.read_replica = False
+        try:
+            yield
+        finally:
+            g.read_replica = previous
+
+    def on_primary(self, function):
+        """
+        Decorator of functions that must read from the primary.
+        """
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.primary():
+                return function(*args, **kwargs)
+        return wrapper
+
+    def read_engine(self, session, clause):
+        """
+        The replica ``session`` should run ``clause`` on, or None for the
+        primary.
+        """
+        if session._flushing or (clause is not None and not isinstance(clause, SelectBase)):
+            session.info['routing_wrote'] = True
+            return None
+        if clause is None:
+            # a bare connection, e.g. session.connection()
+            return None
+        if (not self.engines or not has_request_context() or not g.get('read_replica')
+                or session.info.get('routing_wrote') or getattr(clause, '_for_update_arg', None) is not None):
+            return None
+        if 'routing_replica' not in session.info:
+            wrote_at = g.get('wrote_at')
+            engines = [engine for engine in self.engines if self.caught_up(engine, wrote_at)]
+            session.info['routing_replica'] = engines[next(self._next) % len(engines)] if engines else None
+        return session.info['routing_replica']
+
+
+class RoutingSession(SignallingSession):
+
+    def __init__(self, db, **options):
+        self.router = db.router
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        engine = self.router.read_engine(self, clause)
+        if engine is not None:
+            return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy whose session routes reads through ``router``.
+    """
+
+    def __init__(self, app=None, router=None, **kwargs):
+        self.router = router or ReadRouter()
+        SQLAlchemy.__init__(self, app, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,123 @@
+"""
+Synthetic topology and readings for development databases and benchmarks.
+
+topology() lays out buildings with one cluster node per floor and a number
+of sensors per room. Readings are generated per block of sensors with numpy:
+each sensor reports ``per_sensor`` times, spread evenly over the time span
+with some jitter, with a temperature that follows the time of day around a
+per-room base. Blocks only depend on their arguments and their own seed, so
+they can be generated by a process pool in any order and the database still
+ends up the same.
+"""
+import datetime
+
+import numpy as np
+
+# share of readings reporting the sensor OFF
+OFF_RATIO = 0.2
+
+
+def _ip(prefix, n):
+    return '%d.%d.%d.%d' % (prefix, (n >> 16) & 255, (n >> 8) & 255, n & 255)
+
+
+def topology(buildings, floors, rooms, sensors_per_room=1, details=(), seed=0):
+    """
+    ``(buildings, clusters, sensors)`` rows with explicit ids. Building ids
+    start at 1; ``details`` are dicts of column values for the first
+    buildings, the others get generated names and coordinates. Every IP is
+    unique, so clusters and sensors are addressable the way the map view
+    addresses them.
+    """
+    random = np.random.RandomState(seed)
+    building_rows, cluster_rows, sensor_rows = [], [], []
+    for building_id in range(1, buildings + 1):
+        row = {'id': building_id, 'name': 'Building %d' % building_id, 'floors': floors,
+               'address': '%d Sample Street' % building_id,
+               'lat': round(37 + random.uniform(-1, 1), 6), 'lng': round(-122 + random.uniform(-1, 1), 6)}
+        if building_id <= len(details):
+            row.update(details[building_id - 1])
+        building_rows.append(row)
+        for floor in range(1, floors + 1):
+            cluster_id = len(cluster_rows) + 1
+            cluster_rows.append({'id': cluster_id, 'building_id': building_id, 'floor': floor,
+                                 'ip': _ip(172, cluster_id)})
+            for room in range(1, rooms + 1):
+                for _ in range(sensors_per_room):
+                    sensor_id = len(sensor_rows) + 1
+                    sensor_rows.append({'id': sensor_id, 'cluster_id': cluster_id, 'floor': floor,
+                                        'room': str(room), 'ip': _ip(10, sensor_id), 'type': 'temperature',
+                                        'status': 'ON'})
+    return building_rows, cluster_rows, sensor_rows
+
+
+def sensor_blocks(sensors, clusters, per_block):
+    """
+    ``(sensor_id, cluster_id, building_id, floor, room)`` tuples of every
+    sensor, split into lists of ``per_block``.
+    """
+    buildings = dict((cluster['id'], cluster['building_id']) for cluster in clusters)
+    located = [(sensor['id'], sensor['cluster_id'], buildings[sensor['cluster_id']], sensor['floor'], sensor['room'])
+               for sensor in sensors]
+    return [located[i:i + per_block] for i in range(0, len(located), per_block)]
+
+
+def readings(block, per_sensor, start, end, seed=0):
+    """
+    Reading rows of the sensors of ``block`` (see sensor_blocks()) between
+    the datetimes ``start`` and ``end``, in sensor then time order.
+    """
+    random = np.random.RandomState(seed)
+    span = (end - start).total_seconds()
+    step = span / per_sensor
+    count = len(block)
+    offsets = (np.arange(per_sensor) + random.random_sample((count, per_sensor))) * step
+    seconds = np.minimum(offsets, span - 1).astype(np.int64) + (start - datetime.datetime.combine(
+        start.date(), datetime.time())).seconds
+    days = seconds // 86400
+    in_day = seconds % 86400
+    base = random.uniform(18.0, 26.0, size=(count, 1))
+    temperature = np.round(base + 3 * np.sin((in_day - 32400) / 86400.0 * 2 * np.pi)
+                           + random.normal(0, 1.0, size=(count, per_sensor)), 2)
+    status = random.random_sample((count, per_sensor)) >= OFF_RATIO
+
+    first_day = start.date().toordinal()
+    dates = {}
+    times = {}
+    rows = []
+    for i, (sensor_id, cluster_id, building_id, floor, room) in enumerate(block):
+        for day, second, temp, on in zip(days[i].tolist(), in_day[i].tolist(), temperature[i].tolist(),
+                                         status[i].tolist()):
+            date = dates.get(day)
+            if date is None:
+                date = dates[day] = datetime.date.fromordinal(first_day + day)
+            time = times.get(second)
+            if time is None:
+                time = times[second] = datetime.time(second // 3600, second // 60 % 60, second % 60)
+            rows.append({'sensor_id': sensor_id, 'building_id': building_id, 'cluster_id': cluster_id,
+                         'temperature': temp, 'floor': floor, 'room': room, 'date': date, 'time': time,
+                         'status': 'ON' if on else 'OFF'})
+    return rows
+
+
+def _readings(args):
+    return readings(*args)
+
+
+def generate(blocks, per_sensor, start, end, seed=0, workers=1):
+    """
+    Yield the readings of every block, one list per block, generated by
+    ``workers`` processes.
+    """
+    tasks = [(block, per_sensor, start, end, seed + index) for index, block in enumerate(blocks)]
+    if workers <= 1:
+        for task in tasks:
+            yield _readings(task)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    try:
+        for rows in pool.imap(_readings, tasks):
+            yield rows
+    finally:
+        pool.terminate()
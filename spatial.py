@@ -0,0 +1,166 @@
+"""
+In-memory spatial index of the sites shown on the map.
+
+Buildings, clusters and sensors with coordinates are bucketed into a grid of
+``cell_degrees`` square cells keyed by ``(row, col)``. A bounding box query
+only visits the cells the box overlaps (or the occupied cells, when those
+are fewer), and a nearest-site search visits rings of cells around the query
+point until no unvisited cell can hold anything closer. Boxes whose west edge
+is east of their east edge cross the antimeridian.
+
+The index is rebuilt from scratch, which takes milliseconds for thousands of
+sites; the app rebuilds it whenever the topology revision moves.
+"""
+import collections
+import math
+
+EARTH_RADIUS_KM = 6371.0
+
+Site = collections.namedtuple('Site', 'kind id lat lng data')
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distance between two points, in kilometres.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _in_box(lat, lng, south, west, north, east):
+    if not south <= lat <= north:
+        return False
+    return west <= lng <= east if west <= east else lng >= west or lng <= east
+
+
+class GridIndex(object):
+
+    def __init__(self, cell_degrees=0.05):
+        self.cell_degrees = cell_degrees
+        self.columns = int(round(360.0 / cell_degrees))
+        self.revision = None
+        self._cells = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _cell(self, lat, lng):
+        return (int(math.floor((lat + 90.0) / self.cell_degrees)),
+                int(math.floor((lng + 180.0) / self.cell_degrees)) % self.columns)
+
+    def rebuild(self, sites, revision=None):
+        """
+        Replace the contents with ``sites``; ones without coordinates are
+        left out.
+        """
+        cells = {}
+        size = 0
+        for site in sites:
+            if site.lat is None or site.lng is None:
+                continue
+            cells.setdefault(self._cell(site.lat, site.lng), []).append(site)
+            size += 1
+        self._cells, self._size, self.revision = cells, size, revision
+
+    def _boxed_cells(self, south, west, north, east):
+        first_row, first_col = self._cell(south, west)
+        last_row, last_col = self._cell(north, east)
+        width = (last_col - first_col) % self.columns + 1
+        if west > east and width == 1:
+            width = self.columns
+        cells = self._cells
+        if (last_row - first_row + 1) * width > len(cells):
+            return list(cells.values())
+        found = []
+        for row in range(first_row, last_row + 1):
+            for offset in range(width):
+                sites = cells.get((row, (first_col + offset) % self.columns))
+                if sites:
+                    found.append(sites)
+        return found
+
+    def within(self, south, west, north, east, kinds=None):
+        """
+        Sites inside the box, optionally only of the given ``kinds``.
+        """
+        return [site for sites in self._boxed_cells(south, west, north, east) for site in sites
+                if (kinds is None or site.kind in kinds)
+                and _in_box(site.lat, site.lng, south, west, north, east)]
+
+    def clusters(self, south, west, north, east, cell_degrees, kinds=None):
+        """
+        Sites inside the box grouped into ``cell_degrees`` cells. Returns
+        ``(sites, groups)``: the sites alone in their cell, and a dict per
+        cell of several with their count, centroid and bounds.
+        """
+        grouped = collections.OrderedDict()
+        for site in self.within(south, west, north, east, kinds):
+            key = (math.floor(site.lat / cell_degrees), math.floor(site.lng / cell_degrees))
+            grouped.setdefault(key, []).append(site)
+        singles, groups = [], []
+        for members in grouped.values():
+            if len(members) == 1:
+                singles.append(members[0])
+                continue
+            lats = [site.lat for site in members]
+            lngs = [site.lng for site in members]
+            groups.append({'count': len(members), 'lat': sum(lats) / len(lats), 'lng': sum(lngs) / len(lngs),
+                           'south': min(lats), 'west': min(lngs), 'north': max(lats), 'east': max(lngs)})
+        return singles, groups
+
+    def _ring(self, row, col, radius):
+        if radius == 0:
+            yield row, col
+            return
+        for offset in range(-radius, radius + 1):
+            yield row - radius, (col + offset) % self.columns
+            yield row + radius, (col + offset) % self.columns
+        for offset in range(-radius + 1, radius):
+            yield row + offset, (col - radius) % self.columns
+            yield row + offset, (col + radius) % self.columns
+
+    def _unvisited_bound(self, lat, radius):
+        """
+        Lower bound on the distance from a point at ``lat`` to any site
+        outside the first ``radius`` rings around its cell.
+        """
+        degrees = radius * self.cell_degrees
+        widest = math.radians(min(90.0, abs(lat) + (radius + 1) * self.cell_degrees))
+        along_meridian = EARTH_RADIUS_KM * math.radians(degrees)
+        along_parallel = 2 * EARTH_RADIUS_KM * math.asin(
+            min(1.0, math.cos(widest) * math.sin(math.radians(min(degrees, 180.0)) / 2)))
+        return min(along_meridian, along_parallel)
+
+    def nearest(self, lat, lng, limit=1, kinds=None, max_km=None):
+        """
+        Up to ``limit`` ``(distance_km, site)`` pairs closest to the point,
+        nearest first, optionally only of the given ``kinds`` and within
+        ``max_km``.
+        """
+        cells = self._cells
+        row, col = self._cell(lat, lng)
+        found = []
+        radius = 0
+        while True:
+            exhaustive = (2 * radius + 1) ** 2 > len(cells) or 2 * radius + 1 > self.columns
+            if exhaustive:
+                # the rings outgrew the occupied cells: check all of them
+                candidates = [site for sites in cells.values() for site in sites]
+                found = []
+            else:
+                candidates = [site for cell in self._ring(row, col, radius) for site in cells.get(cell, ())]
+            for site in candidates:
+                if kinds is None or site.kind in kinds:
+                    distance = distance_km(lat, lng, site.lat, site.lng)
+                    if max_km is None or distance <= max_km:
+                        found.append((distance, site))
+            found.sort(key=lambda pair: pair[0])
+            if exhaustive:
+                return found[:limit]
+            bound = self._unvisited_bound(lat, radius)
+            if (len(found) >= limit and found[limit - 1][0] <= bound) or (max_km is not None and bound > max_km):
+                return found[:limit]
+            radius += 1
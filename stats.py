@@ -0,0 +1,240 @@
+"""
+Summaries of SensorData kept up to date as readings are written.
+
+SummaryStats holds the counts shown on the admin landing page (distinct
+sensors, sensors whose latest reading is ON, distinct clusters and
+buildings); FacetIndex holds the distinct building, floor and room values
+offered by the data view filters. Both are built from reading counters that
+are adjusted on every insert, update and delete instead of rescanning
+SensorData.
+
+Each process keeps its own copy, so writes made by other workers are only
+picked up when the copy is rebuilt. A rebuild loads the new counts while the
+current ones keep being read and updated. Writes applied during the load are
+then replayed on the new counts, unless they were committed before the load
+started and are therefore part of it.
+"""
+import collections
+import itertools
+import threading
+
+
+def _get(row, key):
+    return row[key] if isinstance(row, dict) else getattr(row, key)
+
+
+class _Summary(object):
+
+    def __init__(self, loader):
+        self.loader = loader
+        self._lock = threading.RLock()
+        self._rebuild_lock = threading.RLock()
+        self._loaded = False
+        # numbers the writes in the order apply() sees them
+        self._writes = itertools.count(1)
+        self._recorded = None
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            with self._rebuild_lock:
+                if not self._loaded:
+                    self.rebuild()
+
+    def rebuild(self):
+        """
+        Recount from scratch.
+        """
+        with self._rebuild_lock:
+            with self._lock:
+                self._recorded = []
+                # writes numbered below this were committed before the load
+                high_water = next(self._writes)
+            try:
+                state = self._load()
+            except Exception:
+                with self._lock:
+                    self._recorded = None
+                raise
+            with self._lock:
+                recorded, self._recorded = self._recorded, None
+                self._install(state)
+                for write, inserted, deleted in recorded:
+                    if write > high_water:
+                        self._apply(inserted, deleted)
+                self._loaded = True
+
+    def apply(self, inserted=(), deleted=()):
+        """
+        Account for writes, right after they are committed; an update is a
+        delete of the old values plus an insert of the new ones.
+        """
+        write = next(self._writes)
+        with self._lock:
+            if self._recorded is not None:
+                inserted, deleted = list(inserted), list(deleted)
+                self._recorded.append((write, inserted, deleted))
+            if self._loaded:
+                self._apply(inserted, deleted)
+
+    def _apply(self, inserted, deleted):
+        for row in deleted:
+            self._remove(row)
+        for row in inserted:
+            self._add(row)
+
+
+class SummaryStats(_Summary):
+
+    def __init__(self, loader, latest_loader):
+        """
+        ``loader()`` yields ``(sensor_id, cluster_id, building_id, count, date,
+        time, status)`` groups, the last three being the sensor's latest
+        reading. ``latest_loader(sensor_ids)`` maps sensor ids to the
+        ``(date, time, status)`` of their latest reading, and is used when
+        that reading is deleted.
+        """
+        super(SummaryStats, self).__init__(loader)
+        self.latest_loader = latest_loader
+        self._stale = set()
+
+    def _load(self):
+        sensors = collections.Counter()
+        clusters = collections.Counter()
+        buildings = collections.Counter()
+        latest = {}
+        for sensor_id, cluster_id, building_id, count, date, time_, status in self.loader():
+            for counter, key in ((sensors, sensor_id), (clusters, cluster_id), (buildings, building_id)):
+                if key is not None:
+                    counter[key] += count
+            # a sensor can appear in several groups, each with its own
+            # latest reading when the loader reads several shards
+            if sensor_id is not None and date is not None and \
+                    (sensor_id not in latest or (date, time_) >= latest[sensor_id][:2]):
+                latest[sensor_id] = (date, time_, status)
+        return sensors, clusters, buildings, latest
+
+    def _install(self, state):
+        self._sensors, self._clusters, self._buildings, self._latest = state
+        self._active = sum(1 for _, _, status in self._latest.values() if status == 'ON')
+        self._stale = set()
+
+    def _set_latest(self, sensor_id, value):
+        previous = self._latest.pop(sensor_id, None)
+        if previous is not None and previous[2] == 'ON':
+            self._active -= 1
+        if value is not None:
+            self._latest[sensor_id] = value
+            if value[2] == 'ON':
+                self._active += 1
+
+    def _add(self, row):
+        sensor_id = _get(row, 'sensor_id')
+        for counter, key in ((self._sensors, sensor_id), (self._clusters, _get(row, 'cluster_id')),
+                             (self._buildings, _get(row, 'building_id'))):
+            if key is not None:
+                counter[key] += 1
+        date, time_ = _get(row, 'date'), _get(row, 'time')
+        if sensor_id is None or date is None or sensor_id in self._stale:
+            return
+        current = self._latest.get(sensor_id)
+        if current is None or (date, time_) >= current[:2]:
+            self._set_latest(sensor_id, (date, time_, _get(row, 'status')))
+
+    def _remove(self, row):
+        sensor_id = _get(row, 'sensor_id')
+        for counter, key in ((self._sensors, sensor_id), (self._clusters, _get(row, 'cluster_id')),
+                             (self._buildings, _get(row, 'building_id'))):
+            if key is not None:
+                counter[key] -= 1
+                if counter[key] <= 0:
+                    del counter[key]
+        if sensor_id is None:
+            return
+        if sensor_id not in self._sensors:
+            self._set_latest(sensor_id, None)
+            self._stale.discard(sensor_id)
+        elif (_get(row, 'date'), _get(row, 'time')) == self._latest.get(sensor_id, (None, None))[:2]:
+            # the latest reading went away; look the new one up lazily
+            self._stale.add(sensor_id)
+
+    def snapshot(self):
+        self._ensure_loaded()
+        with self._lock:
+            if self._stale:
+                stale, self._stale = self._stale, set()
+                found = self.latest_loader(stale)
+                for sensor_id in stale:
+                    self._set_latest(sensor_id, found.get(sensor_id))
+            return {
+                'sensors': len(self._sensors),
+                'active_sensors': self._active,
+                'clusters': len(self._clusters),
+                'buildings': len(self._buildings),
+            }
+
+    def check(self, recount):
+        """
+        Compare the maintained counts with ``recount``, a dict of the same
+        keys computed from scratch. Returns the keys that differ, mapped to
+        ``(maintained, recounted)``.
+        """
+        current = self.snapshot()
+        return dict((key, (current[key], recount[key])) for key in current if current[key] != recount[key])
+
+
+def _sort_key(value):
+    # numeric values in numeric order, anything else after them
+    try:
+        return (0, int(value), '')
+    except (TypeError, ValueError):
+        return (1, 0, str(value))
+
+
+class FacetIndex(_Summary):
+    """
+    Distinct building, floor and room values with their reading counts.
+    ``loader()`` yields ``(building_id, floor, room, count)`` groups.
+    """
+
+    FACETS = (('buildings', 'building_id'), ('floors', 'floor'), ('rooms', 'room'))
+
+    def _load(self):
+        counters = dict((name, collections.Counter()) for name, _ in self.FACETS)
+        for building_id, floor, room, count in self.loader():
+            for name, value in zip(('buildings', 'floors', 'rooms'), (building_id, floor, room)):
+                if value is not None:
+                    counters[name][value] += count
+        return counters
+
+    def _install(self, counters):
+        self._counters = counters
+        self._sorted = None
+
+    def _add(self, row):
+        for name, key in self.FACETS:
+            value = _get(row, key)
+            if value is not None:
+                if value not in self._counters[name]:
+                    self._sorted = None
+                self._counters[name][value] += 1
+
+    def _remove(self, row):
+        for name, key in self.FACETS:
+            value = _get(row, key)
+            counter = self._counters[name]
+            if value is not None and value in counter:
+                counter[value] -= 1
+                if counter[value] <= 0:
+                    del counter[value]
+                    self._sorted = None
+
+    def values(self):
+        """
+        Dict of sorted string values per facet, ready for the dropdowns.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = dict((name, [str(v) for v in sorted(self._counters[name], key=_sort_key)])
+                                    for name, _ in self.FACETS)
+            return self._sorted
@@ -0,0 +1,475 @@
+"""
+Storage backends for sensor readings.
+
+The reading queries go through a store instead of the SensorData table
+directly. TableStore keeps readings in the SensorData table of the app
+database. ShardedStore partitions them over SQLite files, one per building
+and month, so writers to different buildings or months don't contend for
+one lock and each file stays small. Queries only open the shards their
+building and date filters can match, and results are merged back into
+(date, time, id) order.
+
+Filters are passed as ``criteria`` dicts with any of ``building_id``,
+``floor``, ``room``, ``date_after`` and ``date_before`` (both dates
+exclusive), and ``id_after`` and ``id_before`` (exclusive too).
+
+Both stores delete expired readings in bounded chunks, each in its own short
+transaction, and give the space back with SQLite's incremental vacuum where
+the database was created with ``auto_vacuum = INCREMENTAL``.
+"""
+import datetime
+import heapq
+import itertools
+import os
+import re
+import sqlite3
+
+from sqlalchemy import and_, create_engine, func, or_, select
+
+SHARD_PATTERN = re.compile(r'^readings_(none|\d+)_(\d{4})(\d{2})\.sqlite$')
+
+
+def reading_conditions(table, criteria, after=None):
+    """
+    WHERE clauses of ``criteria``, plus the keyset condition for rows after
+    the ``(date, time, id)`` position ``after``.
+    """
+    conditions = []
+    for key in ('building_id', 'floor', 'room'):
+        if criteria.get(key) is not None:
+            conditions.append(table.c[key] == criteria[key])
+    if criteria.get('date_after') is not None:
+        conditions.append(table.c.date > criteria['date_after'])
+    if criteria.get('date_before') is not None:
+        conditions.append(table.c.date < criteria['date_before'])
+    if criteria.get('id_after') is not None:
+        conditions.append(table.c.id > criteria['id_after'])
+    if criteria.get('id_before') is not None:
+        conditions.append(table.c.id < criteria['id_before'])
+    if after is not None:
+        date, time, id = after
+        conditions.append(or_(
+            table.c.date > date,
+            and_(table.c.date == date, or_(
+                table.c.time > time,
+                and_(table.c.time == time, table.c.id > id)))))
+    return conditions
+
+
+def select_readings(table, criteria, columns=None, after=None, limit=None):
+    columns = [table.c[name] for name in columns] if columns else [table]
+    query = select(columns).where(and_(*reading_conditions(table, criteria, after)))
+    if after is not None or limit is not None:
+        query = query.order_by(table.c.date, table.c.time, table.c.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def sort_key(row):
+    return (row['date'], row['time'], row['id'])
+
+
+def sqlite_size(connection):
+    """
+    Size in bytes of the SQLite database of ``connection``, free pages
+    included.
+    """
+    page_size = connection.execute('PRAGMA page_size').scalar()
+    return page_size * connection.execute('PRAGMA page_count').scalar()
+
+
+def sqlite_compact(connection, pages=1000):
+    """
+    Return the free pages of an ``auto_vacuum = INCREMENTAL`` database to
+    the file system, ``pages`` at a time so the write lock is only held
+    briefly. Returns False if the database does not use incremental vacuum.
+    """
+    if connection.execute('PRAGMA auto_vacuum').scalar() != 2:
+        return False
+    while connection.execute('PRAGMA freelist_count').scalar():
+        connection.execute('PRAGMA incremental_vacuum(%d)' % pages)
+    return True
+
+
+def sqlite_vacuum(connection):
+    """
+    Rebuild the SQLite database of ``connection`` with a full VACUUM,
+    switching it to ``auto_vacuum = INCREMENTAL`` on the way. The database
+    is locked meanwhile.
+    """
+    connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    connection.execute('VACUUM')
+
+
+def _delete_chunks(execute, table, conditions, chunk):
+    """
+    Delete the rows matching ``conditions`` ``chunk`` ids at a time;
+    ``execute(statement)`` runs one statement in its own transaction.
+    """
+    deleted = 0
+    while True:
+        ids = [row[0] for row in execute(select([table.c.id]).where(and_(*conditions)).limit(chunk))]
+        if not ids:
+            return deleted
+        execute(table.delete().where(table.c.id.in_(ids)))
+        deleted += len(ids)
+
+
+class TableStore(object):
+    """
+    Readings in a table of the app database. Writes join the session's
+    transaction.
+    """
+
+    def __init__(self, session, table):
+        self.session = session
+        self.table = table
+
+    def insert(self, rows):
+        self.session.execute(self.table.insert(), rows)
+
+    def page(self, criteria, after=None, limit=500):
+        """
+        Up to ``limit`` rows matching ``criteria`` after the ``(date, time,
+        id)`` position ``after``, in that order.
+        """
+        return self.session.execute(select_readings(self.table, criteria, after=after, limit=limit)).fetchall()
+
+    def iter_rows(self, criteria, columns=None):
+        """
+        Every matching row, in no particular order, fetched as it is read
+        (through a server-side cursor where the driver has them).
+        """
+        query = select_readings(self.table, criteria, columns).execution_options(stream_results=True)
+        return iter(self.session.execute(query))
+
+    def execute_all(self, statement, criteria=None):
+        """
+        Rows of ``statement`` run against every part of the store that
+        ``criteria`` can match; results from different parts are not
+        combined.
+        """
+        return self.session.execute(statement).fetchall()
+
+    def max_id(self):
+        return self.session.execute(select([func.max(self.table.c.id)])).scalar() or 0
+
+    def id_chunks(self, first, last, columns=None, chunk=50000):
+        """
+        The rows with ids in (``first``, ``last``] as ``(rows, through)``
+        lists of up to ``chunk`` ids each; every row up to the id
+        ``through`` has been yielded by then.
+        """
+        for start in range(first, last, chunk):
+            through = min(start + chunk, last)
+            query = select_readings(self.table, {'id_after': start, 'id_before': through + 1}, columns)
+            yield self.session.execute(query).fetchall(), through
+
+    def _execute(self, statement):
+        rows = self.session.execute(statement)
+        rows = rows.fetchall() if rows.returns_rows else None
+        self.session.commit()
+        return rows
+
+    def delete_before(self, building_id, before, chunk=5000):
+        """
+        Delete the readings of a building dated before ``before``, ``chunk``
+        at a time, committing after each chunk. Returns the number deleted.
+        """
+        conditions = [self.table.c.building_id == building_id, self.table.c.date < before]
+        return _delete_chunks(self._execute, self.table, conditions, chunk)
+
+    def _is_sqlite(self):
+        return self.session.get_bind().dialect.name == 'sqlite'
+
+    def size(self):
+        """
+        Bytes the store takes on disk, or None if that is unknown.
+        """
+        return sqlite_size(self.session.connection()) if self._is_sqlite() else None
+
+    def compact(self, pages=1000):
+        """
+        Give the space freed by deletes back to the file system. Returns
+        False if the database cannot do that incrementally.
+        """
+        if not self._is_sqlite():
+            return False
+        self.session.commit()
+        return sqlite_compact(self.session.connection(), pages)
+
+    def vacuum(self):
+        """
+        Switch the database to incremental vacuum with a full VACUUM. Returns
+        False if the database is not SQLite.
+        """
+        if not self._is_sqlite():
+            return False
+        self.session.commit()
+        # VACUUM cannot run inside the session's transaction
+        with self.session.get_bind().connect() as connection:
+            sqlite_vacuum(connection)
+        return True
+
+    def clear(self):
+        """
+        Delete every reading.
+        """
+        self.session.execute(self.table.delete())
+        self.session.commit()
+
+
+class IdAllocator(object):
+    """
+    Hands out reading ids from a counter in its own SQLite file, so ids stay
+    unique across every shard and process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS ids (name TEXT PRIMARY KEY, next INTEGER)')
+            connection.execute("INSERT OR IGNORE INTO ids VALUES ('reading', 1)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def checkpoint(self, name, value=None):
+        """
+        Read, or with ``value`` store, a named progress marker.
+        """
+        with self._connect() as connection:
+            if value is not None:
+                connection.execute('INSERT OR REPLACE INTO ids VALUES (?, ?)', (name, value))
+                return value
+            row = connection.execute('SELECT next FROM ids WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def allocate(self, count, at_least=1):
+        """
+        First of ``count`` consecutive ids, never below ``at_least``.
+        """
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            first = max(connection.execute("SELECT next FROM ids WHERE name = 'reading'").fetchone()[0], at_least)
+            connection.execute("UPDATE ids SET next = ? WHERE name = 'reading'", (first + count,))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        return first
+
+
+class ShardedStore(object):
+    """
+    Readings partitioned into ``readings_<building>_<YYYYMM>.sqlite`` files
+    in ``directory``, each holding ``table``. Every insert commits on its own
+    shards; it is not part of the caller's transaction.
+    """
+
+    def __init__(self, directory, table):
+        self.directory = directory
+        self.table = table
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.ids = IdAllocator(os.path.join(directory, 'ids.sqlite'))
+        self._engines = {}
+        self._deleted_from = set()
+
+    @staticmethod
+    def shard_name(building_id, date):
+        return 'readings_%s_%04d%02d.sqlite' % ('none' if building_id is None else building_id,
+                                                date.year, date.month)
+
+    def _engine(self, name):
+        engine = self._engines.get(name)
+        if engine is None:
+            engine = create_engine('sqlite:///' + os.path.join(self.directory, name))
+            # only takes effect while the file is still empty
+            engine.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.table.create(engine, checkfirst=True)
+            engine = self._engines.setdefault(name, engine)
+        return engine
+
+    def shards(self, criteria=None):
+        """
+        ``(month, building_id, name)`` of the shards ``criteria`` can match,
+        in month order; building_id is None for readings without one.
+        """
+        criteria = criteria or {}
+        first = last = None
+        if criteria.get('date_after') is not None:
+            first = (criteria['date_after'].year, criteria['date_after'].month)
+        if criteria.get('date_before') is not None:
+            before = criteria['date_before'] - datetime.timedelta(days=1)
+            last = (before.year, before.month)
+        found = []
+        for name in os.listdir(self.directory):
+            match = SHARD_PATTERN.match(name)
+            if match is None:
+                continue
+            building, year, month = match.groups()
+            building_id = None if building == 'none' else int(building)
+            month = (int(year), int(month))
+            if criteria.get('building_id') is not None and building_id != criteria['building_id']:
+                continue
+            if (first is not None and month < first) or (last is not None and month > last):
+                continue
+            found.append((month, building_id, name))
+        found.sort(key=lambda shard: (shard[0], shard[1] is None, shard[1] or 0))
+        return found
+
+    def insert(self, rows, replace=False):
+        """
+        Write rows to their shards, allocating ids for rows without one.
+        ``replace`` overwrites rows whose id already exists, for copies that
+        may be repeated.
+        """
+        insert = self.table.insert().prefix_with('OR REPLACE') if replace else self.table.insert()
+        missing = [row for row in rows if row.get('id') is None]
+        if missing:
+            first = self.ids.allocate(len(missing))
+            for offset, row in enumerate(missing):
+                row['id'] = first + offset
+        by_shard = {}
+        for row in rows:
+            by_shard.setdefault(self.shard_name(row['building_id'], row['date']), []).append(row)
+        for name, shard_rows in by_shard.items():
+            with self._engine(name).begin() as connection:
+                connection.execute(insert, shard_rows)
+
+    def page(self, criteria, after=None, limit=500):
+        """
+        Up to ``limit`` rows matching ``criteria`` after the ``(date, time,
+        id)`` position ``after``, in that order. Months are read in order
+        and later ones are only opened if the page is not full yet.
+        """
+        result = []
+        start = (after[0].year, after[0].month) if after is not None else None
+        for month, shards in itertools.groupby(self.shards(criteria), key=lambda shard: shard[0]):
+            if start is not None and month < start:
+                continue
+            wanted = limit - len(result)
+            query = select_readings(self.table, criteria, after=after, limit=wanted)
+            parts = [self._engine(name).execute(query).fetchall() for _, _, name in shards]
+            result.extend(itertools.islice(heapq.merge(*parts, key=sort_key), wanted))
+            if len(result) >= limit:
+                break
+        return result
+
+    def iter_rows(self, criteria, columns=None):
+        """
+        Every matching row, shard by shard.
+        """
+        query = select_readings(self.table, criteria, columns)
+        for _, _, name in self.shards(criteria):
+            for row in self._engine(name).execute(query):
+                yield row
+
+    def execute_all(self, statement, criteria=None):
+        rows = []
+        for _, _, name in self.shards(criteria):
+            rows.extend(self._engine(name).execute(statement).fetchall())
+        return rows
+
+    def max_id(self):
+        return max([row[0] or 0 for row in self.execute_all(select([func.max(self.table.c.id)]))] or [0])
+
+    def id_chunks(self, first, last, columns=None, chunk=50000):
+        """
+        The rows with ids in (``first``, ``last``] as ``(rows, through)``
+        lists of up to ``chunk`` rows, read shard by shard in id order so
+        each shard is listed and opened once. Ids are not ordered across
+        shards, so ``through`` is None until a last, empty chunk.
+        """
+        if columns and 'id' not in columns:
+            columns = ('id',) + tuple(columns)
+        for _, _, name in self.shards():
+            engine = self._engine(name)
+            after = first
+            while True:
+                query = select_readings(self.table, {'id_after': after, 'id_before': last + 1}, columns)
+                rows = engine.execute(query.order_by(self.table.c.id).limit(chunk)).fetchall()
+                if not rows:
+                    break
+                yield rows, None
+                if len(rows) < chunk:
+                    break
+                after = rows[-1]['id']
+        yield [], last
+
+    def delete_before(self, building_id, before, chunk=5000):
+        """
+        Delete the readings of a building dated before ``before``. Shards of
+        months that ended before it are removed as whole files; the shard of
+        the month ``before`` falls in is deleted from ``chunk`` rows at a
+        time. Returns the number deleted.
+        """
+        deleted = 0
+        cutoff = (before.year, before.month)
+        for month, _, name in self.shards({'building_id': building_id, 'date_before': before}):
+            if building_id is None and not name.startswith('readings_none_'):
+                continue
+            engine = self._engine(name)
+            if month < cutoff:
+                deleted += engine.execute(select([func.count()]).select_from(self.table)).scalar()
+                self._remove(name)
+                continue
+
+            def execute(statement):
+                with engine.begin() as connection:
+                    rows = connection.execute(statement)
+                    return rows.fetchall() if rows.returns_rows else None
+            deleted += _delete_chunks(execute, self.table, [self.table.c.date < before], chunk)
+            self._deleted_from.add(name)
+        return deleted
+
+    def _remove(self, name):
+        engine = self._engines.pop(name, None)
+        if engine is not None:
+            engine.dispose()
+        self._deleted_from.discard(name)
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            path = os.path.join(self.directory, name + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(self.directory, name))
+                   for name in os.listdir(self.directory) if SHARD_PATTERN.match(name.split('-')[0]))
+
+    def compact(self, pages=1000):
+        """
+        Vacuum the shards rows were deleted from, removing the ones left
+        empty.
+        """
+        compacted = True
+        for name in list(self._deleted_from):
+            engine = self._engine(name)
+            if not engine.execute(select([func.count()]).select_from(self.table)).scalar():
+                self._remove(name)
+                continue
+            with engine.connect() as connection:
+                compacted = sqlite_compact(connection, pages) and compacted
+            self._deleted_from.discard(name)
+        return compacted
+
+    def vacuum(self):
+        """
+        Switch every shard to incremental vacuum with a full VACUUM, one
+        shard at a time.
+        """
+        for _, _, name in self.shards():
+            with self._engine(name).connect() as connection:
+                sqlite_vacuum(connection)
+        return True
+
+    def clear(self):
+        """
+        Remove every shard, and start the ids and checkpoints over.
+        """
+        for _, _, name in self.shards():
+            self._remove(name)
+        os.remove(self.ids.path)
+        self.ids = IdAllocator(self.ids.path)
@@ -0,0 +1,25 @@
+"""
+WSGI entry point for a multi-worker server, using the production profile
+unless GREENBUILDING_PROFILE says otherwise:
+
+    export GREENBUILDING_SECRET_KEY=... GREENBUILDING_PASSWORD_SALT=...
+    FLASK_APP=wsgi.py flask init-db
+    gunicorn wsgi:application
+
+gunicorn.conf.py runs GREENBUILDING_WORKERS (4) processes, each serving
+requests on GREENBUILDING_THREADS (64) threads with the gthread worker: a sync
+worker would be held by the first /api/events stream it served.
+
+Each worker starts its own ingest writer and geocoding threads on first use,
+and its retention, metering and replica sync threads (when their intervals
+are set) with its first request, so the app can be imported before the
+server forks, e.g. with ``gunicorn --preload``. Those three jobs only run in
+the worker holding BACKGROUND_LOCK_FILE.
+"""
+import os
+
+os.environ.setdefault('GREENBUILDING_PROFILE', 'production')
+
+from app import app as application  # noqa: E402
+
+app = application